@@ -1,31 +1,49 @@
 # Aigenerator Service
 import os
+import json
 import logging
-import ast
-from io import BytesIO
 from datetime import datetime
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
 
 import markdown
 from docx import Document
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
 from dotenv import load_dotenv
 import google.generativeai as genai
 
 # ── Configuration ──
 load_dotenv()
+
+from LlmCache import cached_generate, cached_generate_stream, cached_generate_async, cached_generate_stream_async
+from Analyzer import analyze_source, analyze_repository, language_for
+from Summarizer import condense, CODE_TOKEN_BUDGET
+from Sections import code_units, iter_sections, sectioned, summary_units
+from MdParser import parse as parse_markdown
+from DocxEmitter import BodySpool, DocxEmitter, spooled_file
+from PdfEmitter import PdfEmitter
+from Metrics import instrument
+from Singleflight import Singleflight, request_key
+from Asgi import (AsgiApp, SERVER_MODE, offload, iterate_in_thread, json_body, body_response, json_response,
+                  file_response, serve)
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 
 app = Flask(__name__)
 CORS(app)
+instrument(app, "aiagent")
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_API_KEY  = os.getenv("GEMINI_API_KEY")
+GEMINI_ENDPOINT = os.getenv("GEMINI_ENDPOINT")   # another API host, e.g. benchmarks/fakes.py
 if not GEMINI_API_KEY:
     raise RuntimeError("GEMINI_API_KEY not set")
-genai.configure(api_key=GEMINI_API_KEY)
+if GEMINI_ENDPOINT:
+    genai.configure(api_key=GEMINI_API_KEY, transport="rest", client_options={"api_endpoint": GEMINI_ENDPOINT})
+else:
+    genai.configure(api_key=GEMINI_API_KEY)
+GEMINI_MODEL = "gemini-2.5-flash"
+# "single": one call for the whole report; "sections": one concurrent call per TOC section
+REPORT_MODE  = os.getenv("REPORT_MODE", "single")
 
 # ── Default Prompt for Agent ──
 DEFAULT_INSTRUCTIONS = """
@@ -83,26 +101,21 @@ For **each** section below, produce **3–5 formal paragraphs** (at least **15 l
 # ── Code Analyzer ──
 def parse_code(code: str, ext: str):
     logging.info(f"Parsing code with extension '{ext}'")
-    if ext == ".py":
-        try:
-            tree = ast.parse(code)
-        except SyntaxError:
-            logging.error("Invalid Python syntax detected")
-            return {"error": "Invalid Python syntax"}
-        funcs, classes = [], []
-        for node in ast.walk(tree):
-            if isinstance(node, ast.FunctionDef):
-                funcs.append(node.name)
-            elif isinstance(node, ast.ClassDef):
-                classes.append(node.name)
-        return {"functions": funcs, "classes": classes, "lines": len(code.splitlines())}
-    return {"functions": [], "classes": [], "lines": len(code.splitlines())}
+    result = analyze_source(code, language_for(f"source{ext}") or "other")
+    if "error" in result:
+        logging.error("Invalid Python syntax detected")
+        return {"error": "Invalid Python syntax"}
+    return {
+        "functions": [fn["name"] for fn in result["functions"]],
+        "classes":   [c["name"] for c in result["classes"]],
+        "imports":   result["imports"],
+        "lines":     result["lines"],
+        "units":     code_units(code, result),
+    }
 
 # ── Gemini Agent ──
-def call_gemini(code: str, project_info: str, instructions: str, pages: int = 1):
-    logging.info(f"Calling Gemini AI to generate ~{pages} page(s) of documentation")
-
-    full_prompt = f"""
+def build_prompt(code: str, project_info: str, instructions: str, pages: int = 1):
+    return f"""
 Use the following to generate a **Markdown** technical report of approximately {pages} page{'s' if pages > 1 else ''}:
 
 **Project Description:**
@@ -116,123 +129,362 @@ Use the following to generate a **Markdown** technical report of approximately {
 
 Produce only the final well-structured Markdown text with bolded headings, numbered sections, and consistent formatting.
 """
-    model = genai.GenerativeModel("gemini-2.5-flash")
-    response = model.generate_content(full_prompt)
-    return response.text.strip()
+
+def build_section_context(code: str, project_info: str):
+    # shared by every section prompt, so all sections see the same project context
+    return f"""
+You are writing one part of a **Markdown** technical report.
+
+**Project Description:**
+\"\"\"{project_info}\"\"\"
+
+**Source Code (for context):**
+\"\"\"{code}\"\"\"
+"""
+
+def call_gemini(code: str, project_info: str, instructions: str, pages: int = 1,
+                mode: str = "single", report: dict = None, units: dict = None):
+    if mode == "sections" and sectioned(instructions):
+        return "".join(stream_gemini(code, project_info, instructions, pages, mode, report, units)).strip()
+    logging.info(f"Calling Gemini AI to generate ~{pages} page(s) of documentation")
+    model = genai.GenerativeModel(GEMINI_MODEL)
+    return cached_generate(model, build_prompt(code, project_info, instructions, pages)).strip()
+
+def stream_gemini(code: str, project_info: str, instructions: str, pages: int = 1,
+                  mode: str = "single", report: dict = None, units: dict = None):
+    model = genai.GenerativeModel(GEMINI_MODEL)
+    if mode == "sections" and sectioned(instructions):
+        logging.info(f"Generating ~{pages} page(s) of documentation section by section")
+        # units: only the sections whose code changed since the last submission are regenerated
+        yield from iter_sections(model, build_section_context(code, project_info),
+                                 instructions, pages, report=report, units=units, project=project_info)
+        return
+    logging.info(f"Streaming ~{pages} page(s) of documentation from Gemini AI")
+    yield from cached_generate_stream(model, build_prompt(code, project_info, instructions, pages))
+
+def sse_event(chunk):
+    # one SSE event per model chunk; multi-line chunks become multiple data: fields
+    return "".join(f"data: {line}\n" for line in chunk.split("\n")) + "\n"
+
+def sse_events(chunks):
+    try:
+        for chunk in chunks:
+            yield sse_event(chunk)
+        yield "event: done\ndata: \n\n"
+    except Exception as e:
+        logging.error(f"Streaming generation failed: {e}")
+        yield f"event: error\ndata: {e}\n\n"
+
+# ── Async variants (ASGI mode) ──
+async def call_gemini_async(code: str, project_info: str, instructions: str, pages: int = 1,
+                            mode: str = "single", report: dict = None, units: dict = None):
+    if mode == "sections" and sectioned(instructions):
+        # sections fan out on their own pool, one offloaded call waits for all of them
+        return await offload(call_gemini, code, project_info, instructions, pages, mode, report, units)
+    logging.info(f"Calling Gemini AI to generate ~{pages} page(s) of documentation")
+    model = genai.GenerativeModel(GEMINI_MODEL)
+    return (await cached_generate_async(model, build_prompt(code, project_info, instructions, pages))).strip()
+
+async def stream_gemini_async(code: str, project_info: str, instructions: str, pages: int = 1,
+                              mode: str = "single", report: dict = None, units: dict = None):
+    model = genai.GenerativeModel(GEMINI_MODEL)
+    if mode == "sections" and sectioned(instructions):
+        # sections already fan out on their own pool; their in-order output is relayed from a thread
+        logging.info(f"Generating ~{pages} page(s) of documentation section by section")
+        async for chunk in iterate_in_thread(iter_sections(model, build_section_context(code, project_info),
+                                                           instructions, pages, report=report,
+                                                           units=units, project=project_info)):
+            yield chunk
+        return
+    logging.info(f"Streaming ~{pages} page(s) of documentation from Gemini AI")
+    async for chunk in cached_generate_stream_async(model, build_prompt(code, project_info, instructions, pages)):
+        yield chunk
+
+async def sse_events_async(chunks):
+    try:
+        async for chunk in chunks:
+            yield sse_event(chunk)
+        yield "event: done\ndata: \n\n"
+    except Exception as e:
+        logging.error(f"Streaming generation failed: {e}")
+        yield f"event: error\ndata: {e}\n\n"
 
 # ── Output Generators ──
+# Both return a spooled temp file at position 0: large documents spill to disk
+# (OUTPUT_SPOOL_MB) rather than sitting in memory, and are sent from there in chunks
 def generate_pdf_from_text(text: str):
     logging.info("Generating PDF from Markdown text")
-    buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
-    width, height = A4
-    x, y = 40, height - 40
-    for line in text.splitlines():
-        if y < 50:
-            c.showPage()
-            y = height - 40
-        c.drawString(x, y, line.strip())
-        y -= 15
-    c.save()
-    buffer.seek(0)
-    return buffer
+    output = spooled_file()
+    pdf = PdfEmitter(output, title="Documentation")
+    pdf.emit(parse_markdown(text.splitlines()))
+    pdf.close()
+    output.seek(0)
+    return output
 
 def generate_docx_from_text(text: str):
     logging.info("Generating DOCX from Markdown text")
     doc = Document()
-    for line in text.splitlines():
-        if line.startswith("# "):
-            doc.add_heading(line[2:], level=1)
-        elif line.startswith("## "):
-            doc.add_heading(line[3:], level=2)
-        elif line.startswith("### "):
-            doc.add_heading(line[4:], level=3)
-        else:
-            doc.add_paragraph(line)
-    buffer = BytesIO()
-    doc.save(buffer)
-    buffer.seek(0)
-    return buffer
+    spool = BodySpool(doc)
+    DocxEmitter(doc, spool=spool).emit(parse_markdown(text.splitlines()))
+    output = spooled_file()
+    spool.save(output)
+    output.seek(0)
+    return output
+
+def send_output(output, mimetype, download_name):
+    # send_file streams a file object in blocks but only sizes BytesIO; the spool's size is known
+    size = output.seek(0, os.SEEK_END)
+    output.seek(0)
+    response = send_file(output, mimetype=mimetype, as_attachment=True, download_name=download_name)
+    response.content_length = size
+    return response
+
+def save_text(filename: str, text: str):
+    save_dir = "saved_docs"
+    os.makedirs(save_dir, exist_ok=True)
+    file_path = os.path.join(save_dir, filename)
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return file_path
+
+def render_output(return_format: str, text: str):
+    """-> (body, content type, filename) of a generated report, or None for an unknown format.
+    body is the text itself, or a spooled file for pdf/docx."""
+    if return_format == "markdown":
+        return text, "text/markdown", "documentation.md"
+    elif return_format == "pdf":
+        return generate_pdf_from_text(text), "application/pdf", "documentation.pdf"
+    elif return_format == "docx":
+        return (generate_docx_from_text(text),
+                "application/vnd.openxmlformats-officedocument.wordprocessingml.document", "documentation.docx")
+    elif return_format == "text":
+        filename = f"documentation_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        save_text(filename, text)
+        return text, "text/plain", filename
+    logging.error(f"Unsupported return format: {return_format}")
+    return None
+
+# ── Request preparation ──
+def parse_pages(pages):
+    try:
+        return max(1, int(pages))
+    except Exception:
+        return 1
 
-# ── API Endpoint ──
-@app.route("/generate-doc", methods=["POST"])
-def generate_doc():
-    data = request.get_json()
-    logging.info(f"Received POST data keys: {list(data.keys())}")
+def output_format(data):
+    """-> (return_format, stream) of a /generate-doc body"""
+    return data.get("return_format", "pdf").lower(), bool(data.get("stream", False))
 
+def prepare_request(data):
+    """Validate a /generate-doc body and fit its source into the prompt -> (params, None) or (None, (error, status))."""
     file_path     = data.get("file_path")
     code          = data.get("code")
     extension     = data.get("extension", ".txt").lower()
     project_info  = data.get("project_info")
     instructions  = data.get("instructions", DEFAULT_INSTRUCTIONS)
-    return_format = data.get("return_format", "pdf").lower()
-    pages         = data.get("pages", 1)
-
-    try:
-        pages = max(1, int(pages))
-    except Exception:
-        pages = 1
+    return_format, stream = output_format(data)
+    pages         = parse_pages(data.get("pages", 1))
+    mode          = data.get("mode", REPORT_MODE)
 
     if file_path:
         if not os.path.isfile(file_path):
             logging.error(f"File not found: {file_path}")
-            return jsonify({"error": "File not found"}), 400
+            return None, ({"error": "File not found"}, 400)
         with open(file_path, "r", encoding="utf-8") as f:
             code = f.read()
         extension = os.path.splitext(file_path)[1].lower()
         logging.info(f"Loaded code from: {file_path}")
 
+    # Whole repositories (base64 zip/tar, [{path, content}], or paths below ANALYZER_ROOT) are
+    # replaced by their structural summary, so the prompt never carries raw source
+    units        = None
+    repo_path    = data.get("repo_path")
+    archive      = data.get("archive")
+    archive_path = data.get("archive_path")
+    files        = data.get("files")
+    if repo_path or archive or archive_path or files:
+        try:
+            analysis = analyze_repository(repo_path=repo_path, archive=archive, files=files,
+                                          archive_path=archive_path)
+        except (ValueError, OSError) as e:
+            logging.error(f"Repository analysis failed: {e}")
+            return None, ({"error": f"Could not read repository: {e}"}, 400)
+        if not analysis["files"]:
+            return None, ({"error": "No source files found"}, 400)
+        code, extension = analysis["summary"], ".txt"
+        units = summary_units(analysis["files"])
+        logging.info(f"Analyzed {len(analysis['files'])} files into a {len(code)}-char summary")
+
     if not code or not project_info:
         logging.error("Missing required fields: 'code' or 'project_info'")
-        return jsonify({"error": "Missing code or project_info"}), 400
+        return None, ({"error": "Missing code or project_info"}, 400)
 
     parse_info = parse_code(code, extension)
     if "error" in parse_info:
-        return jsonify(parse_info), 400
+        return None, (parse_info, 400)
 
-    markdown_text = call_gemini(code, project_info, instructions, pages)
+    # Oversized sources are map-reduced into a summary that fits the token budget
+    try:
+        token_budget = max(1000, int(data.get("token_budget", CODE_TOKEN_BUDGET)))
+    except (TypeError, ValueError):
+        token_budget = CODE_TOKEN_BUDGET
+    code, context_report = condense(genai.GenerativeModel(GEMINI_MODEL), code, extension, token_budget)
+
+    return {
+        "code":           code,
+        "project_info":   project_info,
+        "instructions":   instructions,
+        "return_format":  return_format,
+        "pages":          pages,
+        "stream":         stream,
+        "mode":           mode,
+        "context_report": context_report,
+        "units":          parse_info["units"] if units is None else units,
+    }, None
+
+# ── Coalescing: identical requests in flight share one preparation and generation ──
+generations = Singleflight("generate-doc")
+
+def generation_key(data, streamed):
+    # everything that shapes the Markdown; the output format is applied per request
+    return request_key(
+        streamed=streamed, file_path=data.get("file_path"), code=data.get("code"),
+        extension=data.get("extension", ".txt").lower(), project_info=data.get("project_info"),
+        instructions=data.get("instructions", DEFAULT_INSTRUCTIONS), pages=parse_pages(data.get("pages", 1)),
+        mode=data.get("mode", REPORT_MODE), token_budget=data.get("token_budget"),
+        repo_path=data.get("repo_path"), archive=data.get("archive"), files=data.get("files"),
+        archive_path=data.get("archive_path"),
+    )
+
+def add_section_report(params, section_report):
+    if section_report.get("failed"):
+        params["context_report"]["failed_sections"] = section_report["failed"]
+    if section_report.get("reused"):
+        params["context_report"]["reused_sections"] = section_report["reused"]
+
+def generate_text(data):
+    """-> (params, error, markdown_text) for a non-streamed request"""
+    params, error = prepare_request(data)
+    if error:
+        return None, error, None
+    section_report = {}
+    markdown_text = call_gemini(params["code"], params["project_info"], params["instructions"],
+                                params["pages"], params["mode"], section_report, params["units"])
+    add_section_report(params, section_report)
+    return params, None, markdown_text
+
+def generate_chunks(data):
+    """Yields (params, error), then the streamed Markdown chunks"""
+    params, error = prepare_request(data)
+    yield params, error
+    if not error:
+        yield from stream_gemini(params["code"], params["project_info"], params["instructions"],
+                                 params["pages"], params["mode"], units=params["units"])
+
+def context_header(params):
+    return json.dumps(params["context_report"], separators=(",", ":"))
+
+def streaming(data):
+    return_format, stream = output_format(data)
+    return return_format == "sse" or (return_format == "markdown" and stream)
+
+def stream_headers(params, return_format):
+    """-> (content type, headers) of a streamed response"""
+    headers = {"X-Context-Report": context_header(params), "X-Accel-Buffering": "no"}
+    if return_format == "sse":
+        return "text/event-stream", dict(headers, **{"Cache-Control": "no-cache"})
+    return "text/markdown", headers
 
-    if return_format == "markdown":
-        return (
-            markdown_text,
-            200,
-            {
-                "Content-Type": "text/markdown",
-                "Content-Disposition": "attachment; filename=documentation.md"
-            }
-        )
-    elif return_format == "pdf":
-        return send_file(
-            generate_pdf_from_text(markdown_text),
-            mimetype="application/pdf",
-            as_attachment=True,
-            download_name="documentation.pdf"
-        )
-    elif return_format == "docx":
-        return send_file(
-            generate_docx_from_text(markdown_text),
-            mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            as_attachment=True,
-            download_name="documentation.docx"
-        )
-    elif return_format == "text":
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"documentation_{timestamp}.txt"
-        save_dir = "saved_docs"
-        os.makedirs(save_dir, exist_ok=True)
-        file_path = os.path.join(save_dir, filename)
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(markdown_text)
-        return send_file(
-            file_path,
-            mimetype="text/plain",
-            as_attachment=True,
-            download_name=filename
-        )
-    else:
-        logging.error(f"Unsupported return format: {return_format}")
+# ── API Endpoint ──
+@app.route("/generate-doc", methods=["POST"])
+def generate_doc():
+    data = request.get_json()
+    logging.info(f"Received POST data keys: {list(data.keys())}")
+    return_format, _ = output_format(data)
+
+    # Streaming: chunked Markdown (stream=true) or server-sent events
+    if streaming(data):
+        chunks = generations.stream(generation_key(data, streamed=True), generate_chunks, data)
+        params, error = next(chunks)
+        if error:
+            return jsonify(error[0]), error[1]
+        mimetype, headers = stream_headers(params, return_format)
+        if return_format == "sse":
+            chunks = sse_events(chunks)
+        return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
+    (params, error, markdown_text), _ = generations.call(generation_key(data, streamed=False), generate_text, data)
+    if error:
+        return jsonify(error[0]), error[1]
+    output = render_output(return_format, markdown_text)
+    if output is None:
         return jsonify({"error": f"Unsupported format: {return_format}"}), 400
 
+    body, mimetype, filename = output
+    if isinstance(body, str):
+        response = Response(body, mimetype=mimetype,
+                            headers={"Content-Disposition": f"attachment; filename={filename}"})
+    else:
+        response = send_output(body, mimetype, filename)
+    response.headers["X-Context-Report"] = context_header(params)
+    return response
+
+async def generate_text_async(data):
+    params, error = await offload(prepare_request, data)
+    if error:
+        return None, error, None
+    section_report = {}
+    markdown_text = await call_gemini_async(params["code"], params["project_info"], params["instructions"],
+                                            params["pages"], params["mode"], section_report, params["units"])
+    add_section_report(params, section_report)
+    return params, None, markdown_text
+
+async def generate_chunks_async(data):
+    params, error = await offload(prepare_request, data)
+    yield params, error
+    if not error:
+        async for chunk in stream_gemini_async(params["code"], params["project_info"], params["instructions"],
+                                               params["pages"], params["mode"], units=params["units"]):
+            yield chunk
+
+async def generate_doc_async(req):
+    # /generate-doc in ASGI mode; validation and condensing (file and repository reads,
+    # map-reduce over oversized sources) and rendering still block, so they run on the offload pool
+    data = await json_body(req)
+    logging.info(f"Received POST data keys: {list(data.keys())}")
+    return_format, _ = output_format(data)
+
+    if streaming(data):
+        chunks = generations.stream_async(generation_key(data, streamed=True), generate_chunks_async, data)
+        params, error = await chunks.__anext__()
+        if error:
+            await chunks.aclose()
+            return json_response(*error)
+        content_type, headers = stream_headers(params, return_format)
+        if return_format == "sse":
+            chunks = sse_events_async(chunks)
+        return body_response(chunks, content_type, headers)
+
+    (params, error, markdown_text), _ = await generations.call_async(
+        generation_key(data, streamed=False), generate_text_async, data)
+    if error:
+        return json_response(*error)
+    output = await offload(render_output, return_format, markdown_text)
+    if output is None:
+        return json_response({"error": f"Unsupported format: {return_format}"}, 400)
+
+    body, content_type, filename = output
+    headers = {"X-Context-Report": context_header(params),
+               "Content-Disposition": f"attachment; filename={filename}"}
+    if isinstance(body, str):
+        return body_response(body, content_type, headers)
+    return file_response(body, content_type, headers)
+
+asgi = AsgiApp(app, {("POST", "/generate-doc"): generate_doc_async})
+
 if __name__ == "__main__":
     port = int(os.environ["PORT"])
-    app.run(host="0.0.0.0", port=port, debug=False)
+    if SERVER_MODE == "asgi":
+        serve(asgi, port)
+    else:
+        app.run(host="0.0.0.0", port=port, debug=False)
@@ -0,0 +1,497 @@
+# Repository analyzer: per-file structure extraction for Python and JavaScript
+import os
+import io
+import re
+import ast
+import json
+import base64
+import hashlib
+import logging
+import tarfile
+import zipfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from CacheDir import CacheDir
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+ANALYZER_VERSION        = "1"
+ANALYZER_WORKERS        = int(os.getenv("ANALYZER_WORKERS", os.cpu_count() or 2))
+ANALYZER_MAX_FILE_BYTES = int(os.getenv("ANALYZER_MAX_FILE_BYTES", 1024 * 1024))
+ANALYZER_MAX_FILES      = int(os.getenv("ANALYZER_MAX_FILES", 5000))         # per request
+ANALYZER_MAX_TOTAL_MB   = float(os.getenv("ANALYZER_MAX_TOTAL_MB", 64))      # source text per request
+ANALYZER_MAX_UNPACK_MB  = float(os.getenv("ANALYZER_MAX_UNPACK_MB", 256))    # declared archive contents
+ANALYZER_ROOT           = os.getenv("ANALYZER_ROOT", "")                     # server paths only below this; empty = none
+ANALYSIS_CACHE_DIR      = os.getenv("ANALYSIS_CACHE_DIR", os.path.join("cache", "analysis"))
+ANALYSIS_CACHE_SIZE     = int(os.getenv("ANALYSIS_CACHE_SIZE", 4096))        # in-memory entries
+ANALYSIS_CACHE_MAX_MB   = float(os.getenv("ANALYSIS_CACHE_MAX_MB", 128))     # on-disk bound
+# below this many uncached files the pool start-up costs more than it saves
+PARALLEL_MIN_FILES      = 8
+
+LANGUAGES = {
+    ".py": "python",
+    ".js": "javascript", ".jsx": "javascript", ".mjs": "javascript", ".cjs": "javascript",
+    ".ts": "javascript", ".tsx": "javascript",
+}
+OTHER_SOURCE_EXTS = {".java", ".kt", ".go", ".rs", ".c", ".h", ".cpp", ".hpp", ".cs", ".rb",
+                     ".php", ".swift", ".scala", ".sql", ".html", ".css", ".vue", ".sh"}
+SKIP_DIRS = {".git", "node_modules", "__pycache__", ".venv", "venv", "dist", "build",
+             ".next", ".idea", ".vscode", "coverage", ".pytest_cache"}
+
+
+# ── Per-file analysis ──
+def _first_line(doc, limit=100):
+    if not doc:
+        return ""
+    line = doc.strip().splitlines()[0].strip()
+    return line if len(line) <= limit else line[:limit - 1] + "…"
+
+
+def _call_name(func, owner):
+    if isinstance(func, ast.Name):
+        return func.id
+    if isinstance(func, ast.Attribute):
+        # self.x() is resolvable to a method of the enclosing class
+        if owner and isinstance(func.value, ast.Name) and func.value.id in ("self", "cls"):
+            return f"{owner}.{func.attr}"
+        return func.attr
+    return None
+
+
+def _analyze_python(code):
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return {"error": f"Invalid Python syntax (line {e.lineno})"}
+
+    imports, classes, functions = [], [], []
+
+    def visit_function(node, owner=None):
+        qualname = f"{owner}.{node.name}" if owner else node.name
+        signature = f"{node.name}({ast.unparse(node.args)})"
+        if node.returns is not None:
+            signature += f" -> {ast.unparse(node.returns)}"
+        if isinstance(node, ast.AsyncFunctionDef):
+            signature = "async " + signature
+        calls = sorted({name for sub in ast.walk(node) if isinstance(sub, ast.Call)
+                        for name in [_call_name(sub.func, owner)] if name})
+        functions.append({"name": qualname, "signature": signature, "line": node.lineno,
+                          "doc": _first_line(ast.get_docstring(node)), "calls": calls})
+
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            visit_function(node)
+        elif isinstance(node, ast.ClassDef):
+            methods = [n for n in node.body if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef))]
+            classes.append({"name": node.name, "line": node.lineno,
+                            "bases": [ast.unparse(b) for b in node.bases],
+                            "doc": _first_line(ast.get_docstring(node)),
+                            "methods": [m.name for m in methods]})
+            for m in methods:
+                visit_function(m, owner=node.name)
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imports.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            imports.append("." * node.level + (node.module or ""))
+
+    return {"imports": sorted(set(imports)), "classes": classes, "functions": functions,
+            "doc": _first_line(ast.get_docstring(tree))}
+
+
+_JS_IMPORT   = re.compile(r"""import\s+(?:[\w*{}\s,$]+\s+from\s+)?['"]([^'"]+)['"]|require\(\s*['"]([^'"]+)['"]\s*\)""")
+_JS_CLASS    = re.compile(r"\bclass\s+([A-Za-z_$][\w$]*)(?:\s+extends\s+([\w$.]+))?")
+_JS_FUNCTION = re.compile(
+    r"\bfunction\s*\*?\s+([A-Za-z_$][\w$]*)\s*\(([^)]*)\)"
+    r"|\b(?:const|let|var)\s+([A-Za-z_$][\w$]*)\s*=\s*(?:async\s+)?(?:function\s*\*?\s*)?\(([^)]*)\)\s*(?:=>|\{)"
+    r"|\b(?:const|let|var)\s+([A-Za-z_$][\w$]*)\s*=\s*(?:async\s+)?([A-Za-z_$][\w$]*)\s*=>"
+)
+_JS_CALL     = re.compile(r"([A-Za-z_$][\w$]*)\s*\(")
+_JS_KEYWORDS = {"if", "for", "while", "switch", "catch", "function", "return", "typeof",
+                "new", "await", "super", "import", "require"}
+
+
+def _jsdoc_before(code, pos):
+    head = code[:pos].rstrip()
+    if not head.endswith("*/"):
+        return ""
+    start = head.rfind("/**")
+    if start < 0:
+        return ""
+    lines = [l.strip().lstrip("*").strip() for l in head[start + 3:-2].splitlines()]
+    return _first_line("\n".join(l for l in lines if l and not l.startswith("@")))
+
+
+def _js_body(code, pos):
+    # text of the brace-balanced block starting at the first '{' after pos
+    open_at = code.find("{", pos)
+    if open_at < 0:
+        return ""
+    depth = 0
+    for i in range(open_at, len(code)):
+        ch = code[i]
+        if ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return code[open_at:i + 1]
+    return code[open_at:]
+
+
+def _analyze_javascript(code):
+    imports = sorted({a or b for a, b in _JS_IMPORT.findall(code)})
+    classes = [{"name": m.group(1), "line": code.count("\n", 0, m.start()) + 1,
+                "bases": [m.group(2)] if m.group(2) else [],
+                "doc": _jsdoc_before(code, m.start()), "methods": []}
+               for m in _JS_CLASS.finditer(code)]
+    functions = []
+    for m in _JS_FUNCTION.finditer(code):
+        name = m.group(1) or m.group(3) or m.group(5)
+        params = m.group(2) if m.group(1) else m.group(4) if m.group(3) else m.group(6)
+        if m.group(0).endswith("=>") and not code[m.end():].lstrip().startswith("{"):
+            eol = code.find("\n", m.end())
+            body = code[m.end():eol if eol >= 0 else None]    # expression-bodied arrow
+        else:
+            body = _js_body(code, m.end() - 1)
+        calls = sorted({c for c in _JS_CALL.findall(body) if c not in _JS_KEYWORDS and c != name})
+        functions.append({"name": name, "signature": f"{name}({' '.join((params or '').split())})",
+                          "line": code.count("\n", 0, m.start()) + 1,
+                          "doc": _jsdoc_before(code, m.start()), "calls": calls})
+    return {"imports": imports, "classes": classes, "functions": functions, "doc": ""}
+
+
+def language_for(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in LANGUAGES:
+        return LANGUAGES[ext]
+    return "other" if ext in OTHER_SOURCE_EXTS else None
+
+
+def analyze_source(code, language):
+    result = {"language": language, "lines": len(code.splitlines())}
+    if language == "python":
+        result.update(_analyze_python(code))
+    elif language == "javascript":
+        result.update(_analyze_javascript(code))
+    else:
+        result.update({"imports": [], "classes": [], "functions": [], "doc": ""})
+    return result
+
+
+def _analyze_job(job):
+    path, code, digest = job
+    return digest, analyze_source(code, language_for(path))
+
+
+# ── Content-hash cache ──
+class AnalysisCache:
+    def __init__(self, cache_dir=ANALYSIS_CACHE_DIR, max_entries=ANALYSIS_CACHE_SIZE,
+                 max_bytes=int(ANALYSIS_CACHE_MAX_MB * 1024 * 1024)):
+        self.cache_dir   = cache_dir
+        self.max_entries = max_entries
+        self._mem  = OrderedDict()   # digest -> result, least recently used first
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        self._dir = CacheDir(cache_dir, max_bytes) if cache_dir else None
+
+    def _path(self, digest):
+        return os.path.join(self.cache_dir, f"{digest}.json")
+
+    def get(self, digest):
+        with self._lock:
+            if digest in self._mem:
+                self._mem.move_to_end(digest)
+                self.hits += 1
+                return self._mem[digest]
+        if self.cache_dir and os.path.isfile(self._path(digest)):
+            try:
+                with open(self._path(digest), encoding="utf-8") as f:
+                    result = json.load(f)
+                self._dir.touch(self._path(digest))
+                with self._lock:
+                    self._remember(digest, result)
+                    self.hits += 1
+                return result
+            except (OSError, ValueError):
+                pass
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, digest, result):
+        with self._lock:
+            self._remember(digest, result)
+        if self.cache_dir:
+            tmp = self._path(digest) + f".{os.getpid()}.tmp"
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(result, f)
+                    size = f.tell()
+                os.replace(tmp, self._path(digest))
+            except OSError as e:
+                log.warning("Analysis cache write failed: %s", e)
+                return
+            self._dir.added(size)
+
+    def _remember(self, digest, result):
+        self._mem[digest] = result
+        self._mem.move_to_end(digest)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+
+cache = AnalysisCache()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=ANALYZER_WORKERS)
+        return _pool
+
+
+# ── Input collection ──
+def _decode(raw):
+    if len(raw) > ANALYZER_MAX_FILE_BYTES or b"\x00" in raw[:1024]:
+        return None
+    return raw.decode("utf-8", errors="replace")
+
+
+def _skipped(path):
+    parts = path.replace("\\", "/").split("/")
+    return any(p in SKIP_DIRS for p in parts[:-1]) or language_for(path) is None
+
+
+class _Limits:
+    """Running file count and byte total across every input of one request."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+
+    def add(self, nbytes):
+        self.files += 1
+        self.bytes += nbytes
+        if self.files > ANALYZER_MAX_FILES:
+            raise ValueError(f"Too many files (limit {ANALYZER_MAX_FILES})")
+        if self.bytes > ANALYZER_MAX_TOTAL_MB * 1024 * 1024:
+            raise ValueError(f"Sources exceed {ANALYZER_MAX_TOTAL_MB:g} MB")
+
+
+def server_path(path):
+    """Resolve a caller-supplied path, refusing anything outside ANALYZER_ROOT."""
+    if not ANALYZER_ROOT:
+        raise ValueError("Server paths are disabled (ANALYZER_ROOT is not set)")
+    root = os.path.realpath(ANALYZER_ROOT)
+    full = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, full]) != root:
+        raise ValueError(f"Path outside ANALYZER_ROOT: {path}")
+    return full
+
+
+def _read_file(full, limits):
+    with open(full, "rb") as f:
+        raw = f.read(ANALYZER_MAX_FILE_BYTES + 1)
+    limits.add(len(raw))
+    return _decode(raw)
+
+
+def collect_directory(root, limits=None):
+    limits = limits or _Limits()
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in SKIP_DIRS)
+        for name in sorted(filenames):
+            full = os.path.join(dirpath, name)
+            rel  = os.path.relpath(full, root).replace(os.sep, "/")
+            # symlinks could point anywhere, the walk itself stays inside root
+            if _skipped(rel) or os.path.islink(full) or os.path.getsize(full) > ANALYZER_MAX_FILE_BYTES:
+                continue
+            text = _read_file(full, limits)
+            if text is not None:
+                files.append((rel, text))
+    return files
+
+
+def _check_unpacked(sizes, name):
+    # declared sizes bound what gets decompressed: zipfile stops at file_size and
+    # fails the CRC on a member that lies, tarfile never reads past member.size
+    if sum(sizes) > ANALYZER_MAX_UNPACK_MB * 1024 * 1024:
+        raise ValueError(f"Archive {name} unpacks to more than {ANALYZER_MAX_UNPACK_MB:g} MB")
+
+
+def collect_archive(data, name="", limits=None):
+    # members are read in memory, nothing is extracted to disk
+    limits, name = limits or _Limits(), name or "upload"
+    if len(data) > ANALYZER_MAX_TOTAL_MB * 1024 * 1024:
+        raise ValueError(f"Archive {name} exceeds {ANALYZER_MAX_TOTAL_MB:g} MB")
+    files = []
+    if zipfile.is_zipfile(io.BytesIO(data)):
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                infos = [i for i in zf.infolist() if not i.is_dir()]
+                _check_unpacked((i.file_size for i in infos), name)
+                for info in infos:
+                    if _skipped(info.filename) or info.file_size > ANALYZER_MAX_FILE_BYTES:
+                        continue
+                    limits.add(info.file_size)
+                    text = _decode(zf.read(info))
+                    if text is not None:
+                        files.append((info.filename, text))
+        except zipfile.BadZipFile as e:
+            raise ValueError(f"Corrupt archive {name}: {e}") from e
+        return files
+    try:
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as tf:
+            unpacked = []
+            for member in tf:
+                unpacked.append(member.size)
+                _check_unpacked(unpacked, name)
+                if not member.isfile() or _skipped(member.name) or member.size > ANALYZER_MAX_FILE_BYTES:
+                    continue
+                limits.add(member.size)
+                text = _decode(tf.extractfile(member).read())
+                if text is not None:
+                    files.append((member.name, text))
+    except (tarfile.TarError, EOFError, OSError) as e:
+        raise ValueError(f"Unsupported archive {name}: {e}") from e
+    return files
+
+
+def collect_inputs(repo_path=None, archive=None, files=None, archive_path=None):
+    """Normalise a server directory, an archive (base64 or bytes, or a server path) or a file list.
+
+    Uploaded content is always taken as content; server paths are only read below ANALYZER_ROOT.
+    files: [{"path", "content"}] uploaded, or [{"server_path"}] read from ANALYZER_ROOT.
+    """
+    limits, collected = _Limits(), []
+    if repo_path:
+        full = server_path(repo_path)
+        if not os.path.isdir(full):
+            raise ValueError(f"Not a directory: {repo_path}")
+        collected.extend(collect_directory(full, limits))
+    if archive_path:
+        full = server_path(archive_path)
+        if not os.path.isfile(full):
+            raise ValueError(f"Not a file: {archive_path}")
+        if os.path.getsize(full) > ANALYZER_MAX_TOTAL_MB * 1024 * 1024:
+            raise ValueError(f"Archive {archive_path} exceeds {ANALYZER_MAX_TOTAL_MB:g} MB")
+        with open(full, "rb") as f:
+            collected.extend(collect_archive(f.read(), archive_path, limits))
+    if archive:
+        if isinstance(archive, str):
+            try:
+                archive = base64.b64decode(archive, validate=True)
+            except ValueError as e:
+                raise ValueError("archive must be base64; use archive_path for a server file") from e
+        collected.extend(collect_archive(archive, limits=limits))
+    for item in files or []:
+        if not isinstance(item, dict):
+            raise ValueError("files entries must be objects with path and content, or server_path")
+        if "server_path" in item:
+            path = item["server_path"]
+            if _skipped(path):
+                continue
+            full = server_path(path)
+            if os.path.getsize(full) > ANALYZER_MAX_FILE_BYTES:
+                continue
+            content = _read_file(full, limits) or ""
+        else:
+            path, content = str(item.get("path", "file")), str(item.get("content", ""))
+            if _skipped(path):
+                continue
+            limits.add(len(content.encode("utf-8")))
+        collected.append((path, content))
+    return collected
+
+
+# ── Repository analysis ──
+def analyze_files(files):
+    """files: [(path, text)] -> per-file results in input order, cached by content hash."""
+    results, pending = [None] * len(files), []
+    for i, (path, text) in enumerate(files):
+        digest = hashlib.sha256(f"{ANALYZER_VERSION}:{language_for(path)}:".encode() + text.encode("utf-8")).hexdigest()
+        cached = cache.get(digest)
+        if cached is not None:
+            results[i] = cached
+        else:
+            pending.append((i, (path, text, digest)))
+
+    jobs = [job for _, job in pending]
+    if len(jobs) >= PARALLEL_MIN_FILES and ANALYZER_WORKERS > 1:
+        done = _get_pool().map(_analyze_job, jobs, chunksize=max(1, len(jobs) // (ANALYZER_WORKERS * 4)))
+    else:
+        done = map(_analyze_job, jobs)
+    for (i, _), (digest, result) in zip(pending, done):
+        cache.put(digest, result)
+        results[i] = result
+
+    return [dict(result, path=path) for (path, _), result in zip(files, results)]
+
+
+def call_graph(results):
+    # edges between functions defined in the analysed files: plain calls resolve to
+    # top-level functions by name, self.x() calls to methods of the same class
+    defined = set()
+    for r in results:
+        defined.update(fn["name"] for fn in r.get("functions", []))
+    edges = []
+    for r in results:
+        for fn in r.get("functions", []):
+            for callee in fn.get("calls", []):
+                if callee in defined and callee != fn["name"]:
+                    edges.append((fn["name"], callee))
+    return edges
+
+
+def summarize(results, max_calls=8):
+    """Compact Markdown-ish outline of the repository for the report prompt."""
+    by_lang = {}
+    for r in results:
+        by_lang[r["language"]] = by_lang.get(r["language"], 0) + 1
+    lines = [f"Repository summary: {len(results)} files, "
+             f"{sum(r['lines'] for r in results)} lines "
+             f"({', '.join(f'{lang}: {n}' for lang, n in sorted(by_lang.items()))})"]
+    for r in results:
+        lines.append(f"\n## {r['path']} ({r['lines']} lines)")
+        if r.get("error"):
+            lines.append(f"! {r['error']}")
+            continue
+        if r.get("doc"):
+            lines.append(r["doc"])
+        if r.get("imports"):
+            lines.append("imports: " + ", ".join(r["imports"]))
+        functions = r.get("functions", [])
+        for c in r.get("classes", []):
+            bases = f"({', '.join(c['bases'])})" if c["bases"] else ""
+            lines.append(f"class {c['name']}{bases}" + (f": {c['doc']}" if c["doc"] else ""))
+            for fn in functions:
+                if fn["name"].startswith(c["name"] + "."):
+                    lines.append(f"  def {fn['signature']}" + (f": {fn['doc']}" if fn["doc"] else ""))
+        for fn in functions:
+            if "." not in fn["name"]:
+                lines.append(f"def {fn['signature']}" + (f": {fn['doc']}" if fn["doc"] else ""))
+    edges = call_graph(results)
+    if edges:
+        lines.append("\n## Call graph")
+        fan = {}
+        for caller, callee in edges:
+            fan.setdefault(caller, []).append(callee)
+        for caller, callees in fan.items():
+            more = f" (+{len(callees) - max_calls})" if len(callees) > max_calls else ""
+            lines.append(f"{caller} -> {', '.join(callees[:max_calls])}{more}")
+    return "\n".join(lines)
+
+
+def analyze_repository(repo_path=None, archive=None, files=None, archive_path=None):
+    results = analyze_files(collect_inputs(repo_path, archive, files, archive_path))
+    log.info("Analyzed %d files (cache hits=%d misses=%d)", len(results), cache.hits, cache.misses)
+    return {"files": results, "call_graph": call_graph(results), "summary": summarize(results)}
@@ -0,0 +1,256 @@
+# ASGI serving mode: native async routes in front of a Flask app
+#
+#   asgi = AsgiApp(app, {("POST", "/build-document"): build_document_async})
+#
+#   uvicorn Docbuilder:asgi --port 5002        or   SERVER_MODE=asgi python Docbuilder.py
+#
+# The routes given here are Starlette endpoints on the event loop and must not block:
+# upstream HTTP goes through client() (pooled httpx), blocking or CPU-bound work through
+# offload(). Every other route of the Flask app is mounted behind a2wsgi on its own threads.
+# Starlette and a2wsgi are only imported once an AsgiApp serves its first request.
+import os
+import json
+import time
+import asyncio
+import logging
+import functools
+import contextlib
+import contextvars
+from queue import SimpleQueue
+from concurrent.futures import ThreadPoolExecutor
+
+import Metrics
+from Metrics import HTTP_SECONDS, TRACE_HEADER, trace
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+SERVER_MODE           = os.getenv("SERVER_MODE", "wsgi")              # "asgi" serves through uvicorn
+ASGI_OFFLOAD_WORKERS  = int(os.getenv("ASGI_OFFLOAD_WORKERS", 32))    # threads for blocking/CPU work
+ASGI_HTTP_CONNECTIONS = int(os.getenv("ASGI_HTTP_CONNECTIONS", 64))   # upstream requests in flight, per host
+ASGI_WSGI_WORKERS     = int(os.getenv("ASGI_WSGI_WORKERS", 32))       # threads for the Flask routes
+ASGI_FILE_CHUNK       = 256 * 1024                                    # file responses are sent in pieces this big
+
+_offload_pool = ThreadPoolExecutor(max_workers=ASGI_OFFLOAD_WORKERS, thread_name_prefix="offload")
+_client = None
+_client_loop = None
+
+
+# ── Event-loop helpers ──
+async def offload(fn, *args, **kwargs):
+    """Run a blocking call on the offload pool under the caller's context (trace id included)."""
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(_offload_pool, call)
+
+
+def offloaded(fn):
+    """fn as a coroutine function running on the offload pool, e.g. for a Flows I/O table."""
+    return functools.partial(offload, fn)
+
+
+_DONE = object()
+
+
+async def iterate_in_thread(iterable):
+    """Async iteration over a blocking iterator, one next() per offloaded call."""
+    it = iter(iterable)
+    while True:
+        item = await offload(next, it, _DONE)
+        if item is _DONE:
+            return
+        yield item
+
+
+async def consume_in_thread(fn, items):
+    """fn(iterator) on the offload pool, fed from the async iterable `items` as they arrive -> fn's result.
+
+    The loop hands items over without waiting on fn, so e.g. parsing overlaps a download.
+    """
+    queue = SimpleQueue()
+
+    def drain():
+        while (item := queue.get()) is not _DONE:
+            yield item
+
+    consumer = asyncio.ensure_future(offload(fn, drain()))
+    try:
+        async for item in items:
+            if consumer.done():   # fn returned or failed without reading everything
+                break
+            queue.put(item)
+    except BaseException:
+        queue.put(_DONE)
+        await asyncio.wait([consumer])   # fn sees the end of its input before the error goes on
+        raise
+    queue.put(_DONE)
+    return await consumer
+
+
+def _bounded_client(slots):
+    import httpx
+
+    # Requests beyond the per-host bound wait on a semaphore rather than in httpx's own pool,
+    # which rescans every queued request on each change and burns seconds of loop CPU in a
+    # burst. Per host, so a slow upstream (PlantUML) cannot starve calls to a fast one.
+    class BoundedClient(httpx.AsyncClient):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self._slots = {}
+
+        def _slot(self, url):
+            url = httpx.URL(url)
+            return self._slots.setdefault((url.scheme, url.host, url.port), asyncio.Semaphore(slots))
+
+        async def send(self, request, *, stream=False, **kwargs):
+            if stream:   # only reached through stream(), which already holds a slot
+                return await super().send(request, stream=True, **kwargs)
+            async with self._slot(request.url):
+                return await super().send(request, **kwargs)
+
+        @contextlib.asynccontextmanager
+        async def stream(self, method, url, **kwargs):
+            async with self._slot(url):
+                async with super().stream(method, url, **kwargs) as response:
+                    yield response
+
+    # httpcore traces every phase of every request at DEBUG, synchronously on the loop
+    logging.getLogger("httpcore").setLevel(max(logging.INFO, logging.getLogger().level))
+    # idle connections expire before uvicorn's 5s keep-alive, or a reused one can be
+    # closed under a request that is already on its way
+    return BoundedClient(limits=httpx.Limits(max_connections=None, max_keepalive_connections=slots,
+                                             keepalive_expiry=4),
+                         timeout=30)
+
+
+def client():
+    """The process's shared httpx.AsyncClient, bound to the running event loop."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        _client = _bounded_client(ASGI_HTTP_CONNECTIONS)
+        _client_loop = loop
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+# ── Requests and responses ──
+class BadRequest(Exception):
+    pass
+
+
+async def json_body(request):
+    # like Flask's get_json(force=True): the body is JSON whatever the Content-Type says
+    try:
+        return json.loads(await request.body() or b"null")
+    except ValueError as e:
+        raise BadRequest(f"Invalid JSON body: {e}") from e
+
+
+def body_response(body, content_type, headers=None, status=200):
+    """str or bytes as one body; an async iterator of either is streamed as it is produced."""
+    from starlette.responses import Response, StreamingResponse
+    if isinstance(body, (str, bytes)):
+        return Response(body, status, headers, content_type)
+    return StreamingResponse(body, status, headers, content_type)
+
+
+def json_response(obj, status=200, headers=None):
+    return body_response(json.dumps(obj), "application/json", headers, status)
+
+
+async def _file_chunks(file, chunk_size):
+    try:
+        while True:
+            chunk = await offload(file.read, chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        file.close()
+
+
+def file_response(file, content_type, headers=None, chunk_size=ASGI_FILE_CHUNK):
+    """Send a binary file object (e.g. a SpooledTemporaryFile) in chunks and close it; never read whole."""
+    size = file.seek(0, os.SEEK_END)
+    file.seek(0)
+    return body_response(_file_chunks(file, chunk_size), content_type,
+                         dict(headers or {}, **{"Content-Length": str(size)}))
+
+
+# ── App ──
+def _endpoint(handler):
+    async def endpoint(request):
+        try:
+            response = await handler(request)
+        except BadRequest as e:
+            response = json_response({"error": str(e)}, 400)
+        except Exception:
+            log.exception("%s %s failed", request.method, request.url.path)
+            response = json_response({"error": "Internal server error"}, 500)
+        # same headers flask-cors and Metrics.instrument add on the WSGI routes
+        response.headers.setdefault("Access-Control-Allow-Origin", "*")
+        if request.headers.get(TRACE_HEADER):
+            response.headers.setdefault(TRACE_HEADER, request.headers[TRACE_HEADER])
+        return response
+    return endpoint
+
+
+@contextlib.asynccontextmanager
+async def _lifespan(app):
+    yield
+    await close_client()
+
+
+class AsgiApp:
+    """Serves `routes` {(method, path): async handler(Request) -> Response} natively, the rest via Flask."""
+
+    def __init__(self, flask_app, routes):
+        self.flask_app = flask_app
+        self.routes    = routes
+        self._app      = None
+
+    def _build(self):
+        from a2wsgi import WSGIMiddleware
+        from starlette.applications import Starlette
+        from starlette.routing import Mount, Route
+
+        routes = [Route(path, _endpoint(handler), methods=[method])
+                  for (method, path), handler in self.routes.items()]
+        routes.append(Mount("/", WSGIMiddleware(self.flask_app, workers=ASGI_WSGI_WORKERS)))
+        return Starlette(routes=routes, lifespan=_lifespan)
+
+    async def __call__(self, scope, receive, send):
+        if self._app is None:
+            self._app = self._build()
+        if scope["type"] != "http" or (scope["method"], scope["path"]) not in self.routes:
+            return await self._app(scope, receive, send)
+
+        # the Flask routes are traced and timed by Metrics.instrument, the native ones here;
+        # the trace covers a streamed body too
+        started, status = time.perf_counter(), 500
+        trace_id = dict(scope["headers"]).get(TRACE_HEADER.lower().encode("latin-1"))
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        with trace(trace_id.decode("latin-1") if trace_id else None):
+            try:
+                await self._app(scope, receive, send_status)
+            finally:
+                HTTP_SECONDS.observe(time.perf_counter() - started, service=Metrics.SERVICE,
+                                     endpoint=scope["path"], method=scope["method"], status=status)
+
+
+def serve(asgi_app, port):
+    import uvicorn
+    log.info("Serving on port %d in ASGI mode", port)
+    uvicorn.run(asgi_app, host="0.0.0.0", port=port, log_level="info")
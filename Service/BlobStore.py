@@ -0,0 +1,185 @@
+# Content-addressed diagram store shared by the UML agent and DocBuilder
+#
+#   <root>/objects/ab/abcdef….png     one file per distinct PNG, named by sha256
+#   <root>/manifests/<build_id>.json  which blobs belong to a build, in order
+#
+# When both services point BLOB_DIR at the same directory, diagrams are handed
+# over by digest instead of being uploaded and written a second time.
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+BLOB_DIR   = os.getenv("BLOB_DIR", os.path.join("cache", "blobs"))
+BLOB_GRACE = float(os.getenv("BLOB_GRACE", 3600))   # unreferenced blobs younger than this are kept
+BLOB_SWEEP = float(os.getenv("BLOB_SWEEP", 600))    # seconds between collector passes
+# manifests of builds that failed or were abandoned before they exported anything are
+# dropped once they are this old; defaults to the export TTL
+BLOB_MANIFEST_TTL = float(os.getenv("BLOB_MANIFEST_TTL", os.getenv("EXPORT_TTL", 7 * 24 * 3600)))
+
+_DIGEST   = re.compile(r"^[0-9a-f]{64}$")
+_BUILD_ID = re.compile(r"^[A-Za-z0-9_.-]{1,128}$")
+
+
+def _atomic_write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class BlobStore:
+    def __init__(self, root=BLOB_DIR, in_use=None, manifest_ttl=BLOB_MANIFEST_TTL):
+        self.root = root
+        # in_use(build_id) -> whether the build still exists; manifests are only expired
+        # by the process that owns the builds, i.e. that passes it
+        self.in_use       = in_use
+        self.manifest_ttl = manifest_ttl
+        self._lock = threading.Lock()   # serializes manifest read-modify-writes and counters
+        self.writes = self.dedup = self.expired = 0
+        self._collector = None
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root, "manifests"), exist_ok=True)
+
+    # ── Blobs ──
+    def path(self, digest):
+        if not _DIGEST.match(digest or ""):
+            raise ValueError(f"bad digest {digest!r}")
+        return os.path.join(self.root, "objects", digest[:2], f"{digest}.png")
+
+    def has(self, digest):
+        return bool(_DIGEST.match(digest or "")) and os.path.isfile(self.path(digest))
+
+    def put(self, data):
+        """Store bytes once; returns their sha256 digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        exists = self.has(digest)
+        if exists:
+            os.utime(self.path(digest))   # fresh for the GC grace period
+        else:
+            _atomic_write(self.path(digest), data)
+        with self._lock:
+            if exists:
+                self.dedup += 1
+            else:
+                self.writes += 1
+        return digest
+
+    def get(self, digest):
+        with open(self.path(digest), "rb") as f:
+            return f.read()
+
+    # ── Manifests ──
+    def _manifest_path(self, build_id):
+        if not _BUILD_ID.match(build_id or ""):
+            raise ValueError(f"bad build_id {build_id!r}")
+        return os.path.join(self.root, "manifests", f"{build_id}.json")
+
+    def manifest(self, build_id):
+        try:
+            with open(self._manifest_path(build_id), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"build_id": build_id, "diagrams": []}
+
+    def record(self, build_id, digest, **meta):
+        """Add (or replace, by diagramType/index) a blob in the build's manifest."""
+        entry = dict(meta, blob=digest)
+        with self._lock:
+            manifest = self.manifest(build_id)
+            key = (entry.get("diagramType"), str(entry.get("index")))
+            manifest["diagrams"] = [d for d in manifest["diagrams"]
+                                    if (d.get("diagramType"), str(d.get("index"))) != key] + [entry]
+            _atomic_write(self._manifest_path(build_id),
+                          json.dumps(manifest, indent=1).encode("utf-8"))
+        return entry
+
+    def lookup(self, build_id, diagram_type, index):
+        for entry in self.manifest(build_id)["diagrams"]:
+            if entry.get("diagramType") == diagram_type and str(entry.get("index")) == str(index):
+                return entry.get("blob")
+        return None
+
+    # ── Cleanup ──
+    def forget(self, build_ids):
+        """Drop the manifests of these builds, then any blobs no other manifest still references."""
+        removed = 0
+        with self._lock:
+            for build_id in build_ids:
+                try:
+                    os.remove(self._manifest_path(build_id))
+                    removed += 1
+                except (OSError, ValueError):
+                    continue
+        return self.collect() if removed else 0
+
+    def _expired(self, name, path, now):
+        if self.in_use is None or now - os.path.getmtime(path) <= self.manifest_ttl:
+            return False
+        return not self.in_use(name[:-len(".json")])
+
+    def collect(self, grace=BLOB_GRACE):
+        """Remove unreferenced blobs older than grace, and expired manifests first."""
+        referenced, expired, now = set(), 0, time.time()
+        manifests = os.path.join(self.root, "manifests")
+        for name in os.listdir(manifests):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(manifests, name)
+            try:
+                if self._expired(name, path, now):
+                    with self._lock:
+                        os.remove(path)
+                    expired += 1
+                    continue
+                with open(path, encoding="utf-8") as f:
+                    referenced.update(d.get("blob") for d in json.load(f)["diagrams"])
+            except (OSError, ValueError, KeyError):
+                continue
+        removed, cutoff = 0, now - grace
+        for parent, _, files in os.walk(os.path.join(self.root, "objects")):
+            for name in files:
+                path = os.path.join(parent, name)
+                if name[:-4] not in referenced and os.path.getmtime(path) < cutoff:
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        pass
+        with self._lock:
+            self.expired += expired
+        if removed or expired:
+            log.info("Blob store: removed %d unreferenced diagram(s), %d expired manifest(s)", removed, expired)
+        return removed
+
+    def _collect_forever(self, interval):
+        while True:
+            try:
+                self.collect()
+            except Exception:
+                log.exception("Blob collector pass failed")
+            time.sleep(interval)
+
+    def start_collector(self, interval=BLOB_SWEEP):
+        """Collect on a timer: unreferenced blobs, and expired manifests when in_use is set."""
+        if self._collector is None:
+            self._collector = threading.Thread(target=self._collect_forever, args=(interval,),
+                                               name="blob-collector", daemon=True)
+            self._collector.start()
+        return self
+
+    def stats(self):
+        return {"writes": self.writes, "dedup": self.dedup, "expired_manifests": self.expired}
@@ -0,0 +1,72 @@
+# Size-bounded directory of cache files, one file per key
+#
+# A file's mtime is its last use: hits touch it. Once writes push the directory
+# past max_bytes, the least recently used files are removed until it is back
+# under 90% of the bound, so a busy cache doesn't sweep on every write.
+import os
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class CacheDir:
+    def __init__(self, root, max_bytes):
+        self.root      = root
+        self.max_bytes = max_bytes
+        self._lock     = threading.Lock()
+        self._sweeping = threading.Lock()   # one sweep at a time, other writers go on
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        self._total = sum(size for _, size, _ in self._entries())
+        if self._total > max_bytes:
+            self.sweep()
+
+    def _entries(self):
+        for parent, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".tmp"):   # a write in progress
+                    continue
+                path = os.path.join(parent, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def added(self, nbytes):
+        """Account for a file just written; sweeps when the bound is crossed."""
+        with self._lock:
+            self._total += nbytes
+            over = self._total > self.max_bytes
+        if over and self._sweeping.acquire(blocking=False):
+            try:
+                self.sweep()
+            finally:
+                self._sweeping.release()
+
+    def sweep(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target, removed = self.max_bytes * 0.9, 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        with self._lock:
+            self._total = total
+            self.evictions += removed
+        if removed:
+            log.info("Cache %s: evicted %d file(s), %.1f MB in use", self.root, removed, total / 1024 / 1024)
+        return removed
@@ -0,0 +1,47 @@
+# Intermediate document model shared by every export format
+#
+# A build collects its Markdown blocks (MdParser nodes) and diagrams into one
+# DocModel; the DOCX, PDF and PPTX renderers all read from it. Everything in it
+# is plain tuples and strings so it pickles cheaply into export worker processes.
+import time
+from collections import namedtuple
+
+from MdParser import plain_text
+
+# image is the PNG to embed or None; source the PNG it was prepared from (ImagePrep), or None
+Diagram = namedtuple("Diagram", "title description image source", defaults=(None,))
+
+
+class DocModel:
+    def __init__(self, title, tenant=None, generated=None):
+        self.title     = title
+        self.tenant    = tenant
+        self.generated = generated or time.strftime('%B %d, %Y')
+        self.blocks    = []      # MdParser nodes, in document order
+        self.diagrams  = []
+
+    def extend(self, nodes):
+        """Consume a (possibly live) node stream; returns the number of blocks added."""
+        before = len(self.blocks)
+        self.blocks.extend(nodes)
+        return len(self.blocks) - before
+
+    def add_diagram(self, title, description="", image=None, source=None):
+        self.diagrams.append(Diagram(title, description, image, source))
+
+    def sections(self):
+        """Split blocks on the top heading level -> [(title, [nodes])]; text before it is untitled."""
+        levels = [level for kind, level, _ in self.blocks if kind == "heading"]
+        top = min(levels) if levels else None
+        sections, current = [], ("", [])
+        for node in self.blocks:
+            if node.kind == "heading" and node.level == top:
+                if current[0] or current[1]:
+                    sections.append(current)
+                current = (plain_text(node.content), [])
+            else:
+                current[1].append(node)
+        if current[0] or current[1]:
+            sections.append(current)
+        return sections
+
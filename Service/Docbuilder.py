@@ -4,24 +4,34 @@ import time
 import logging
 import requests
 import uuid
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeout
 from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 from dotenv import load_dotenv
-from docx2pdf import convert
-from PIL import Image
-from docx import Document
-from docx.shared import Inches, Pt, RGBColor
-from docx.enum.text import WD_PARAGRAPH_ALIGNMENT, WD_BREAK
-from docx.oxml.ns import qn
-from docx.oxml import OxmlElement
-
-from pptx import Presentation
-from pptx.util import Inches as PPTInches, Pt as PPTPt
-from pptx.enum.text import PP_PARAGRAPH_ALIGNMENT
+from Jobs import JobQueue, QueueFull
+from MdParser import parse as parse_markdown
+from DocModel import DocModel
+from ImagePrep import ImagePrep
+from BlobStore import BlobStore
+from Exporters import export, export_all, export_all_async, warm as warm_exporter
+from ExportStore import ExportStore
+from Metrics import instrument, trace, stage, carry, observe, trace_headers, trace_stages
+from Asgi import AsgiApp, SERVER_MODE, client, offload, consume_in_thread, json_body, json_response, serve
 
 # ── Load env ──
 load_dotenv()
 PORT = int(os.getenv("PORT", 5002))
+PARENT_AGENT_URL  = os.getenv("PARENT_AGENT_URL", "https://aiagent-xyq4.onrender.com")
+UML_AGENT_URL     = os.getenv("UML_AGENT_URL", "https://umlgenerator.onrender.com")
+STREAM_MARKDOWN   = os.getenv("STREAM_MARKDOWN", "1") != "0"
+MARKDOWN_TIMEOUT  = float(os.getenv("MARKDOWN_TIMEOUT", 120))   # per-read timeout on the stream
+MARKDOWN_DEADLINE = float(os.getenv("MARKDOWN_DEADLINE", 300))  # overall budget for the Markdown
+UML_DEADLINE      = float(os.getenv("UML_DEADLINE", 180))       # overall budget for diagrams
+EXPORT_WORKERS    = int(os.getenv("EXPORT_WORKERS", 3))         # 0 renders formats inline
+EXPORT_FORMATS    = ("docx", "pdf", "pptx")
+EXPORT_EAGER      = os.getenv("EXPORT_EAGER", "requested")     # "all", or only the requested format
 
 # ── Logging ──
 logging.basicConfig(
@@ -32,38 +42,114 @@ log = logging.getLogger(__name__)
 
 # ── Flask & CORS ──
 app = Flask(__name__)
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "0") == "1"   # behind nginx/apache
 CORS(app)
+instrument(app, "docbuilder")
 
 # ── Directories ──
 BASE_DIR   = os.path.dirname(__file__)
-EXPORT_DIR = os.path.join(BASE_DIR, "exports")
-DIAGR_DIR  = os.path.join(EXPORT_DIR, "diagrams")
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(BASE_DIR, "exports"))
 os.makedirs(EXPORT_DIR, exist_ok=True)
-os.makedirs(DIAGR_DIR, exist_ok=True)
+
+# ── Diagram blobs + per-build manifests, shared with the UML agent via BLOB_DIR ──
+# Evicted builds drop their manifests at once; the collector expires those of builds
+# that never got an export directory (failed or abandoned) after BLOB_MANIFEST_TTL
+blobs = BlobStore(in_use=lambda build_id: exports.in_use(build_id))
+
+# ── Artifacts per build_id, bounded by EXPORT_QUOTA_MB / EXPORT_TTL ──
+exports = ExportStore(EXPORT_DIR, on_evict=blobs.forget).start_janitor()
+blobs.start_collector()
+
+# ── Diagram preparation (RGB, print size), cached by content hash ──
+images = ImagePrep()
+
+# ── Export workers ──
+# DOCX, PDF and PPTX are rendered from one DocModel side by side; each worker
+# process builds its DOCX skeletons once at start-up
+exporter = (ProcessPoolExecutor(max_workers=EXPORT_WORKERS, initializer=warm_exporter)
+            if EXPORT_WORKERS > 0 else None)
 
 # ── Helpers ──
-def sanitize_image(path):
-    try:
-        with Image.open(path) as img:
-            rgb = img.convert("RGB")
-            directory, filename = os.path.split(path)
-            name, ext = os.path.splitext(filename)
-            safe_filename = f"{name}_safe.png"
-            safe_path = os.path.join(directory, safe_filename)
-            rgb.save(safe_path, format="PNG", optimize=True)
-            return safe_path
-    except Exception as e:
-        log.warning("Failed to sanitize %s: %s", path, e)
-        return None
-
-def set_shading_for_paragraph(paragraph, fill_color):
-    p_element = paragraph._p
-    p_pr = p_element.get_or_add_pPr()
-    shd = OxmlElement('w:shd')
-    shd.set(qn('w:val'), 'clear')
-    shd.set(qn('w:color'), 'auto')
-    shd.set(qn('w:fill'), fill_color)
-    p_pr.append(shd)
+def project_title(data):
+    return (data.get("instructions") or "AI-Generated Documentation").split('\n')[0]
+
+def add_markdown(model, lines):
+    # Consumes Markdown line by line, so `lines` may be a live stream; returns the block count
+    return model.extend(parse_markdown(lines))
+
+def markdown_payload(data, stream):
+    return {
+        "code":          data.get("code"),
+        "project_info":  data.get("project_info"),
+        "instructions":  data.get("instructions"),
+        "pages":         data.get("pages", 1),
+        "return_format": "markdown",
+        "stream":        stream
+    }
+
+def diagrams_payload(data, build_id):
+    return {
+        "build_id":     build_id,
+        "abstract":     data.get("abstract",""),
+        "instructions": data.get("uml_instructions","")
+    }
+
+def markdown_request(data, stream):
+    return requests.post(
+        PARENT_AGENT_URL + "/generate-doc", json=markdown_payload(data, stream),
+        headers=trace_headers(), timeout=(10, MARKDOWN_TIMEOUT), stream=stream
+    )
+
+def request_diagrams(data, build_id):
+    uml_resp = requests.post(
+        UML_AGENT_URL + "/generate-uml-image", json=diagrams_payload(data, build_id),
+        headers=trace_headers(build_id), timeout=(10, UML_DEADLINE)
+    )
+    uml_resp.raise_for_status()
+    return uml_resp.json().get("diagrams", [])
+
+def stream_markdown_lines(md_resp, deadline):
+    md_resp.encoding = md_resp.encoding or "utf-8"
+    for line in md_resp.iter_lines(decode_unicode=True):
+        if time.time() > deadline:
+            md_resp.close()
+            raise TimeoutError(f"markdown stream exceeded {MARKDOWN_DEADLINE:.0f}s")
+        yield line
+
+def read_markdown(model, data, deadline):
+    """Markdown from the parent agent into model -> its block count"""
+    md_resp = markdown_request(data, STREAM_MARKDOWN)
+    md_resp.raise_for_status()
+    if STREAM_MARKDOWN:
+        return add_markdown(model, stream_markdown_lines(md_resp, deadline))
+    return add_markdown(model, (md_resp.text or "").splitlines())
+
+async def markdown_lines_async(md_resp, deadline):
+    async for line in md_resp.aiter_lines():
+        if time.time() > deadline:
+            raise TimeoutError(f"markdown stream exceeded {MARKDOWN_DEADLINE:.0f}s")
+        yield line
+
+async def read_markdown_async(model, data, deadline):
+    """Markdown from the parent agent into model -> its block count; parsed on the offload
+    pool line by line as it streams in, like the threaded build"""
+    url = PARENT_AGENT_URL + "/generate-doc"
+    if not STREAM_MARKDOWN:
+        md_resp = await client().post(url, json=markdown_payload(data, False),
+                                      headers=trace_headers(), timeout=MARKDOWN_TIMEOUT)
+        md_resp.raise_for_status()
+        return await offload(add_markdown, model, (md_resp.text or "").splitlines())
+    async with client().stream("POST", url, json=markdown_payload(data, True),
+                               headers=trace_headers(), timeout=MARKDOWN_TIMEOUT) as md_resp:
+        md_resp.raise_for_status()
+        return await consume_in_thread(lambda lines: add_markdown(model, lines),
+                                       markdown_lines_async(md_resp, deadline))
+
+async def request_diagrams_async(data, build_id):
+    uml_resp = await client().post(UML_AGENT_URL + "/generate-uml-image", json=diagrams_payload(data, build_id),
+                                   headers=trace_headers(build_id), timeout=UML_DEADLINE)
+    uml_resp.raise_for_status()
+    return uml_resp.json().get("diagrams", [])
 
 # ── Proxy to UML Agent ──
 @app.route('/generate-uml', methods=['POST'])
@@ -71,7 +157,7 @@ def proxy_uml():
     # This endpoint is kept for potential direct testing but is not used in the main flow.
     payload = request.get_json(force=True)
     resp = requests.post(
-        os.getenv("UML_AGENT_URL", "https://umlgenerator.onrender.com") + "/generate-uml-image",
+        UML_AGENT_URL + "/generate-uml-image",
         json={
             "build_id":     payload.get("build_id", "default"),
             "abstract":     payload.get("abstract", ""),
@@ -89,223 +175,298 @@ def ingest_diagram():
 
     diagramType = request.form.get('diagramType', 'diagram')
     index       = request.form.get('index', '1')
+    description = request.form.get('description', '')
+    digest      = request.form.get('blob')
     img_file    = request.files.get('image')
-    if not img_file:
+
+    # A digest we already hold is ingested by reference; otherwise the bytes are required
+    if img_file:
+        digest = blobs.put(img_file.read())
+    elif not digest:
         return jsonify({"error": "no image"}), 400
+    elif not blobs.has(digest):
+        return jsonify({"error": "unknown blob", "blob": digest}), 404
 
-    target_dir = os.path.join(DIAGR_DIR, build_id)
-    os.makedirs(target_dir, exist_ok=True)
-    filename = f"{diagramType}_{index}.png"
-    path     = os.path.join(target_dir, filename)
-    img_file.save(path)
-    log.info("Ingested diagram for build [%s] -> %s", build_id, path)
-    return jsonify({"path": path}), 200
+    try:
+        blobs.record(build_id, digest, diagramType=diagramType, index=index, description=description)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    log.info("Ingested diagram for build [%s] -> %s", build_id, digest[:12])
+    return jsonify({"blob": digest, "path": blobs.path(digest)}), 200
 
 # ── Build document ──
+jobs = JobQueue()
+
+def enqueue_build(data, build_id):
+    # Job mode: enqueue and return immediately, clients poll /build-status/<build_id>
+    try:
+        jobs.submit(build_id, run_build, data, data.get("callback_url"))
+    except QueueFull as e:
+        log.warning("Rejected build [%s]: %s", build_id, e)
+        return {"error": "Build queue is full, retry later"}, 503
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    log.info("Queued build [%s]", build_id)
+    return {
+        "build_id":   build_id,
+        "status":     "queued",
+        "status_url": f"/build-status/{build_id}"
+    }, 202
+
+def start_build(data, headers, args):
+    """Fill in a /build-document body -> (build_id, whether it goes to the job queue)"""
+    data.setdefault("tenant", headers.get("X-Tenant"))
+    return str(uuid.uuid4()), bool(data.get("async") or args.get("async") == "1")
+
 @app.route('/build-document', methods=['POST'])
 def build_document():
+    data = request.get_json(force=True)
+    build_id, queued = start_build(data, request.headers, request.args)
+    result, status = enqueue_build(data, build_id) if queued else run_build(data, build_id)
+    return jsonify(result), status
+
+async def build_document_async(req):
+    # /build-document in ASGI mode: the build waits on the event loop, not on a thread
+    data = await json_body(req)
+    build_id, queued = start_build(data, req.headers, req.query_params)
+    result, status = enqueue_build(data, build_id) if queued else await run_build_async(data, build_id)
+    return json_response(result, status)
+
+@app.route('/build-status/<build_id>', methods=['GET'])
+def build_status(build_id):
+    job = jobs.status(build_id)
+    if job is None:
+        return jsonify({"error": "Unknown build_id"}), 404
+    return jsonify(job), 200
+
+# Steps shared by the threaded and the async build
+def resolve_diagrams(diagram_specs, build_id):
+    # Resolve each diagram to a blob: the digest in the UML response when we hold it
+    # (shared BLOB_DIR), else whatever /ingest-diagram recorded in the build manifest
+    img_paths, digests = [], []
+    for spec in diagram_specs:
+        dtype, index = spec.get('diagramType', 'Diagram'), spec.get('index', 1)
+        digest = spec.get('blob')
+        if not blobs.has(digest):
+            digest = blobs.lookup(build_id, dtype, index)
+        if digest and blobs.has(digest):
+            img_paths.append(blobs.path(digest))
+            digests.append(digest)
+        else:
+            log.warning("Missing image for spec: %s #%s", dtype, index)
+            img_paths.append(None)
+            digests.append(None)
+    return img_paths, digests
+
+def add_diagrams(model, diagram_specs, safe_paths, img_paths):
+    for spec, safe_path, img_path in zip(diagram_specs, safe_paths, img_paths):
+        diagram_type_raw = spec.get('diagramType', 'Diagram')
+        title = diagram_type_raw.replace('_', ' ').replace('-', ' ').title()
+        model.add_diagram(title, spec.get('description', ''), safe_path, img_path)
+
+def attach_diagrams(model, diagram_specs, build_id):
+    img_paths, digests = resolve_diagrams(diagram_specs, build_id)
+    with stage("image_prep"):
+        safe_paths = images.prepare_all(img_paths, digests)
+    add_diagrams(model, diagram_specs, safe_paths, img_paths)
+
+def eager_formats(data):
+    # the requested format(s) are rendered now; the others from the saved model on first download
+    return [f for f in EXPORT_FORMATS if EXPORT_EAGER == "all" or f == data.get("format", "docx")] \
+        or ["docx"]
+
+def build_response(build_id, diagram_specs, formats, results, export_seconds, start):
+    # formats render in worker processes, so their timings are observed here
+    for fmt, r in results.items():
+        if "seconds" in r:
+            observe(f"render_{fmt}", r["seconds"])
+    if all("error" in r for r in results.values()):
+        return {"error": f"{formats[0].upper()} save failed"}, 500
+
+    log.info("Completed build %s in %.2fs", build_id, time.time() - start)
+
+    response_data = {
+        "build_id":       build_id,
+        "diagrams_count": len(diagram_specs),
+        "timings":        {fmt: r.get("seconds") for fmt, r in results.items()},
+        "export_seconds": export_seconds,
+        "images":         images.stats(),
+        "lazy":           [fmt for fmt in EXPORT_FORMATS if fmt not in results],
+        "stages":         trace_stages(build_id),
+    }
+    for fmt in EXPORT_FORMATS:
+        if "error" not in results.get(fmt, {}):
+            response_data[fmt] = f"{build_id}.{fmt}"
+
+    return response_data, 200
+
+# Upstream calls for different builds share one pool
+fanout = ThreadPoolExecutor(max_workers=int(os.getenv("FANOUT_WORKERS", 8)), thread_name_prefix="fanout")
+
+def run_build(data, build_id, progress=lambda stage: None):
+    # Every stage below, and the upstream calls it makes, is traced under the build_id
+    with trace(build_id), stage("build"):
+        return _run_build(data, build_id, progress)
+
+def _run_build(data, build_id, progress):
     start = time.time()
-    data  = request.get_json(force=True)
-    build_id = str(uuid.uuid4())
 
-    # 1) Get Markdown
-    log.info("Requesting markdown from parent agent for build [%s]", build_id)
+    # Diagrams are independent of the Markdown, so request them first and let them
+    # render while the Markdown streams into the DOCX
+    log.info("Requesting diagrams from UML agent for build [%s]", build_id)
+    uml_future = fanout.submit(carry(request_diagrams), data, build_id)
+
+    # 1) Get Markdown, streamed straight into the DOCX as it is generated
+    log.info("Requesting markdown from parent agent for build [%s] (stream=%s)", build_id, STREAM_MARKDOWN)
+    progress("markdown")
+    model = DocModel(project_title(data), data.get("tenant"))
     try:
-        md_resp = requests.post(
-            os.getenv("PARENT_AGENT_URL", "https://aiagent-xyq4.onrender.com") + "/generate-doc",
-            json={
-                "code":          data.get("code"),
-                "project_info":  data.get("project_info"),
-                "instructions":  data.get("instructions"),
-                "pages":         data.get("pages", 1),
-                "return_format": "markdown"
-            }, timeout=120
-        )
-        md_resp.raise_for_status()
-        raw_md = md_resp.text or ""
-        if not raw_md.strip():
-            return jsonify({"error":"Empty markdown response"}), 500
+        with stage("markdown"):
+            md_lines = read_markdown(model, data, start + MARKDOWN_DEADLINE)
+        if not md_lines:
+            return {"error":"Empty markdown response"}, 500
+        log.info("Markdown for build [%s]: %d lines in %.2fs", build_id, md_lines, time.time() - start)
     except Exception as e:
         log.error("Failed to get markdown: %s", e)
-        return jsonify({"error": "Failed to generate document content"}), 500
+        return {"error": "Failed to generate document content"}, 500
 
-    # 2) Get UML diagrams
-    log.info("Requesting diagrams from UML agent for build [%s]", build_id)
-    build_diagrams_dir = os.path.join(DIAGR_DIR, build_id)
-    os.makedirs(build_diagrams_dir, exist_ok=True)
+    # 2) Collect UML diagrams; a late or failed UML agent only costs us the diagrams
+    progress("diagrams")
     try:
-        uml_resp = requests.post(
-            os.getenv("UML_AGENT_URL", "https://umlgenerator.onrender.com") + "/generate-uml-image",
-            json={
-                "build_id":     build_id,
-                "abstract":     data.get("abstract",""),
-                "instructions": data.get("uml_instructions","")
-            }, timeout=120
-        )
-        uml_resp.raise_for_status()
-        diagram_specs = uml_resp.json().get("diagrams", [])
+        remaining = max(0.0, UML_DEADLINE - (time.time() - start))
+        with stage("diagrams_wait"):
+            diagram_specs = uml_future.result(timeout=remaining)
         log.info("Got %d diagram specifications", len(diagram_specs))
+    except FutureTimeout:
+        log.error("Diagrams for build [%s] missed the %.0fs deadline", build_id, UML_DEADLINE)
+        diagram_specs = []
     except Exception as e:
         log.error("Failed to get diagrams: %s", e)
         diagram_specs = []
- 
-    # 3) Build Polished DOCX
-    doc = Document()
-
-    # Define Styles
-    style_normal = doc.styles['Normal']
-    font = style_normal.font
-    font.name = 'Poppins'
-    font.size = Pt(11)
-
-    style_h1 = doc.styles['Heading 1']
-    style_h1.font.name = 'Poppins'
-    style_h1.font.size = Pt(18)
-    style_h1.font.bold = True
-    style_h1.font.color.rgb = RGBColor(0x3B, 0x4B, 0x64)
-    style_h1.paragraph_format.space_after = Pt(12)
-
-    style_h2 = doc.styles['Heading 2']
-    style_h2.font.name = 'Poppins'
-    style_h2.font.size = Pt(14)
-    style_h2.font.bold = True
-    style_h2.paragraph_format.space_after = Pt(10)
-
-    # Add Cover Page
-    project_title = data.get("instructions", "AI-Generated Documentation").split('\n')[0]
-    cover_title = doc.add_heading('Technical Report', level=0)
-    cover_title.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    p = doc.add_paragraph()
-    p.add_run(project_title).bold = True
-    p.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    doc.add_paragraph(f"Generated on: {time.strftime('%B %d, %Y')}", style='Caption').alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    doc.add_page_break()
-
-    # Add Footer with Page Numbers
-    section = doc.sections[0]
-    footer = section.footer
-    p = footer.paragraphs[0] if footer.paragraphs else footer.add_paragraph()
-    p.text = " DocuAgent | Confidential\t"
-    run = p.add_run()
-    fldChar1 = OxmlElement('w:fldChar')
-    fldChar1.set(qn('w:fldCharType'), 'begin')
-    instrText = OxmlElement('w:instrText')
-    instrText.set(qn('xml:space'), 'preserve')
-    instrText.text = 'PAGE'
-    fldChar2 = OxmlElement('w:fldChar')
-    fldChar2.set(qn('w:fldCharType'), 'end')
-    run._r.append(fldChar1)
-    run._r.append(instrText)
-    run._r.append(fldChar2)
-    p.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
-
-    # Process Markdown into Document Body
-    is_code_block = False
-    for line in raw_md.splitlines():
-        clean_line = line.strip()
-
-        if '```' in clean_line:
-            is_code_block = not is_code_block
-            continue
-
-        if is_code_block:
-            p = doc.add_paragraph()
-            run = p.add_run(clean_line)
-            run.font.name = 'Courier New'
-            run.font.size = Pt(10)
-            set_shading_for_paragraph(p, "F1F1F1")
-            p.paragraph_format.space_after = Pt(4)
-        elif clean_line.startswith('# '):
-            doc.add_heading(clean_line[2:].strip(), level=1)
-        elif clean_line.startswith('## '):
-            doc.add_heading(clean_line[3:].strip(), level=2)
-        elif clean_line.startswith('### '):
-            doc.add_heading(clean_line[4:].strip(), level=3)
-        elif clean_line:
-            p = doc.add_paragraph(clean_line.replace('*', ''))
-            p.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
-            p.paragraph_format.space_after = Pt(8)
-
-    # Add Diagrams
-    if diagram_specs:
-        doc.add_heading("Diagrams", level=1)
 
-    for spec in diagram_specs:
-        diagram_type_raw = spec.get('diagramType', 'Diagram')
-        description = spec.get('description', '')
-        title = diagram_type_raw.replace('_', ' ').replace('-', ' ').title()
-        doc.add_heading(title, level=2)
-
-        p = doc.add_paragraph(description)
-        p.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
-        p.paragraph_format.space_after = Pt(8)
-
-        img_filename = f"{diagram_type_raw}_{spec.get('index', 1)}.png"
-        img_path = os.path.join(build_diagrams_dir, img_filename)
-
-        if os.path.isfile(img_path):
-            safe_path = sanitize_image(img_path)
-            if safe_path:
-                try:
-                    p_img = doc.add_paragraph()
-                    p_img.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-                    p_img.add_run().add_picture(safe_path, width=Inches(5.5))
-                except Exception as e:
-                    log.warning("Embed %s failed: %s", safe_path, e)
-        else:
-            log.warning("Missing image for spec: %s", img_path)
-        doc.add_paragraph()
-
-    # Save Files
-    ts        = int(time.time())
-    docx_file = f"combined_{ts}.docx"
-    pdf_file  = f"combined_{ts}.pdf"
-    pptx_file = f"combined_{ts}.pptx"
-
-    docx_path = os.path.join(EXPORT_DIR, docx_file)
-    pdf_path  = os.path.join(EXPORT_DIR, pdf_file)
-    pptx_path = os.path.join(EXPORT_DIR, pptx_file)
+    attach_diagrams(model, diagram_specs, build_id)
+
+    # 3) Persist the model and render the requested format(s)
+    progress("export")
+    formats = eager_formats(data)
+    with exports.pinned(build_id):
+        exports.save_model(build_id, model)
+        t0 = time.time()
+        results = export_all(model, {fmt: exports.path(build_id, fmt) for fmt in formats}, exporter)
+        export_seconds = round(time.time() - t0, 3)
+    exports.nudge()
+    return build_response(build_id, diagram_specs, formats, results, export_seconds, start)
+
+async def run_build_async(data, build_id):
+    with trace(build_id), stage("build"):
+        return await _run_build_async(data, build_id)
+
+async def _run_build_async(data, build_id):
+    # Same steps as _run_build; waits are awaits and file/CPU work is offloaded
+    start = time.time()
+    log.info("Requesting diagrams from UML agent for build [%s]", build_id)
+    uml_task = asyncio.ensure_future(request_diagrams_async(data, build_id))
 
+    log.info("Requesting markdown from parent agent for build [%s] (stream=%s)", build_id, STREAM_MARKDOWN)
+    model = DocModel(project_title(data), data.get("tenant"))
     try:
-        doc.save(docx_path)
-        log.info("DOCX saved → %s (%d bytes)", docx_path, os.path.getsize(docx_path))
+        with stage("markdown"):
+            md_lines = await read_markdown_async(model, data, start + MARKDOWN_DEADLINE)
+        if not md_lines:
+            uml_task.cancel()
+            return {"error":"Empty markdown response"}, 500
+        log.info("Markdown for build [%s]: %d lines in %.2fs", build_id, md_lines, time.time() - start)
     except Exception as e:
-        log.error("DOCX save failed: %s", e)
-        return jsonify({"error":"DOCX save failed"}), 500
-
-    if os.path.exists(docx_path) and os.path.getsize(docx_path) > 1000:
-        try:
-            convert(docx_path, pdf_path)
-            log.info("PDF saved → %s", pdf_path)
-        except Exception as e:
-            log.error("PDF conversion failed: %s", e)
+        uml_task.cancel()
+        log.error("Failed to get markdown: %s", e)
+        return {"error": "Failed to generate document content"}, 500
 
-    # Note: PPTX generation is not implemented yet
-    prs = Presentation()
     try:
-        prs.save(pptx_path)
-        log.info("PPTX (empty) saved → %s", pptx_path)
+        remaining = max(0.0, UML_DEADLINE - (time.time() - start))
+        with stage("diagrams_wait"):
+            diagram_specs = await asyncio.wait_for(uml_task, remaining)
+        log.info("Got %d diagram specifications", len(diagram_specs))
+    except asyncio.TimeoutError:
+        log.error("Diagrams for build [%s] missed the %.0fs deadline", build_id, UML_DEADLINE)
+        diagram_specs = []
     except Exception as e:
-        log.error("PPTX failed: %s", e)
-
-    log.info("Completed build %s in %.2fs", build_id, time.time() - start)
-
-    response_data = { "diagrams_count": len(diagram_specs) }
-    if os.path.exists(docx_path): response_data["docx"] = docx_file
-    if os.path.exists(pdf_path): response_data["pdf"] = pdf_file
-    if os.path.exists(pptx_path): response_data["pptx"] = pptx_file
+        log.error("Failed to get diagrams: %s", e)
+        diagram_specs = []
 
-    return jsonify(response_data), 200
+    await offload(attach_diagrams, model, diagram_specs, build_id)
+
+    formats = eager_formats(data)
+    with exports.pinned(build_id):
+        await offload(exports.save_model, build_id, model)
+        t0 = time.time()
+        results = await export_all_async(model, {fmt: exports.path(build_id, fmt) for fmt in formats}, exporter)
+        export_seconds = round(time.time() - t0, 3)
+    exports.nudge()
+    return build_response(build_id, diagram_specs, formats, results, export_seconds, start)
+
+# Concurrent downloads of a format that is not rendered yet share one render
+_renders = {}
+_renders_lock = threading.Lock()
+
+def materialize(build_id, fmt):
+    key, owner = (build_id, fmt), False
+    with _renders_lock:
+        future = _renders.get(key)
+    if future is None:
+        # unpickling is disk I/O, keep it out of the lock other downloads wait on
+        model = exports.load_model(build_id)
+        if model is None:
+            return False
+        images.restore(model)   # prepared images are a bounded cache and may be gone by now
+        with _renders_lock:
+            future = _renders.get(key)
+            if future is None:
+                owner = True
+                log.info("Rendering %s for build [%s] on demand", fmt.upper(), build_id)
+                future = (exporter or fanout).submit(export, fmt, model, exports.path(build_id, fmt))
+                _renders[key] = future
+                future.add_done_callback(lambda _: _renders.pop(key, None))
+    result = future.result()
+    if owner:
+        observe(f"render_{fmt}", result["seconds"], build_id)
+    return True
 
 # ── Download Generated Files ──
 @app.route('/download/<filetype>/<filename>', methods=['GET'])
 def download_file(filetype, filename):
-    full_path = os.path.join(EXPORT_DIR, filename)
-    if not os.path.isfile(full_path):
+    build_id, ext = os.path.splitext(filename)
+    if filetype not in EXPORT_FORMATS or ext != f".{filetype}":
         return jsonify({"error":"File not found on server"}), 404
-    return send_file(full_path, as_attachment=True, download_name=filename)
+
+    legacy_path = os.path.join(EXPORT_DIR, os.path.basename(filename))
+    if os.path.isfile(legacy_path):
+        full_path = legacy_path        # combined_<ts>.* from before the export store
+    else:
+        try:
+            full_path = exports.path(build_id, filetype)
+        except ValueError:
+            return jsonify({"error":"File not found on server"}), 404
+        with exports.pinned(build_id):
+            try:
+                if not os.path.isfile(full_path) and not materialize(build_id, filetype):
+                    return jsonify({"error":"File not found on server"}), 404
+            except Exception as e:
+                log.error("On-demand %s render for build [%s] failed: %s", filetype.upper(), build_id, e)
+                return jsonify({"error":"Failed to render file"}), 500
+        exports.touch(build_id)
+
+    # conditional=True gives ETag/If-None-Match, Last-Modified and Range support; the
+    # file itself goes out through the server's file wrapper (sendfile) or X-Sendfile
+    return send_file(full_path, as_attachment=True, download_name=filename,
+                     conditional=True, etag=True, max_age=3600)
+
 
 
+# ── ASGI mode: builds run on the event loop, every other route through the Flask app ──
+asgi = AsgiApp(app, {("POST", "/build-document"): build_document_async})
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=PORT, debug=True)
+    if SERVER_MODE == "asgi":
+        serve(asgi, PORT)
+    else:
+        app.run(host="0.0.0.0", port=PORT, debug=True)
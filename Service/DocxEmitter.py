@@ -0,0 +1,225 @@
+# DOCX emitter for MdParser node streams
+#
+# Everything that used to be applied per paragraph (code font, shading, body
+# spacing) lives in paragraph styles created once per document, so emitting a
+# node is just add_paragraph(text, style) plus runs for inline formatting.
+#
+# With a BodySpool, emitted body XML moves out of the lxml tree into a temp file
+# every DOCX_SPOOL_NODES nodes and is spliced back in while the file is written,
+# so a long report never holds its whole document tree in memory.
+import os
+import re
+import shutil
+import zipfile
+from copy import deepcopy
+from tempfile import SpooledTemporaryFile
+
+from lxml import etree
+from docx.enum.style import WD_STYLE_TYPE
+from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from docx.shared import Pt
+
+from MdParser import BOLD, ITALIC, CODE
+
+# ── Config ──
+DOCX_SPOOL_NODES = int(os.getenv("DOCX_SPOOL_NODES", 500))              # 0 keeps the whole tree
+OUTPUT_SPOOL_MB  = float(os.getenv("OUTPUT_SPOOL_MB", 8))               # spooled files spill to disk beyond this
+
+CODE_STYLE = "Code Block"
+BODY_STYLE = "Report Body"
+LIST_STYLES = {
+    "bullet": ["List Bullet", "List Bullet 2", "List Bullet 3"],
+    "number": ["List Number", "List Number 2", "List Number 3"],
+}
+
+
+def _ensure_style(doc, name, base="Normal"):
+    styles = doc.styles
+    if name in [s.name for s in styles]:
+        return styles[name], False
+    style = styles.add_style(name, WD_STYLE_TYPE.PARAGRAPH)
+    style.base_style = styles[base]
+    return style, True
+
+
+def spooled_file():
+    """A binary temp file kept in memory up to OUTPUT_SPOOL_MB, on disk beyond."""
+    return SpooledTemporaryFile(max_size=int(OUTPUT_SPOOL_MB * 1024 * 1024))
+
+
+_XMLNS  = re.compile(rb'\sxmlns:(\w+)="([^"]*)"')
+_MARKER = "docx-body-spool"
+
+
+class BodySpool:
+    """Body elements of a document parked in a temp file until save().
+
+        spool = BodySpool(doc)
+        DocxEmitter(doc, spool=spool).emit(nodes)    # flushes every DOCX_SPOOL_NODES nodes
+        spool.save(path_or_file)               # instead of doc.save()
+    """
+
+    def __init__(self, doc):
+        self.doc   = doc
+        self.file  = spooled_file()
+        self.size  = 0
+        # a detached fragment repeats every namespace of the document root; those go
+        self._root_ns = {prefix.encode(): uri.encode() for prefix, uri in doc.element.nsmap.items() if prefix}
+        self._sect_pr = qn("w:sectPr")
+
+    def _fragment(self, element):
+        xml = etree.tostring(element)
+        end = xml.index(b">")
+        head = _XMLNS.sub(lambda m: b"" if self._root_ns.get(m.group(1)) == m.group(2) else m.group(0),
+                          xml[:end])
+        return head + xml[end:]
+
+    def flush(self):
+        """Move everything in the body so far (but the section properties) to the spool."""
+        body = self.doc.element.body
+        for element in list(body):
+            if element.tag == self._sect_pr:
+                continue
+            xml = self._fragment(element)
+            self.file.write(xml)
+            self.size += len(xml)
+            body.remove(element)
+
+    def save(self, target):
+        """doc.save(target) with the spooled elements back in front of the rest of the body."""
+        if not self.size:
+            self.doc.save(target)
+            self.file.close()
+            return
+        body = self.doc.element.body
+        body.insert(0, etree.Comment(_MARKER))
+        with spooled_file() as skeleton:
+            self.doc.save(skeleton)
+            body.remove(body[0])
+            skeleton.seek(0)
+            with zipfile.ZipFile(skeleton) as src, \
+                    zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED) as out:
+                for info in src.infolist():
+                    entry = zipfile.ZipInfo(info.filename, info.date_time)
+                    entry.compress_type = zipfile.ZIP_DEFLATED
+                    with out.open(entry, "w", force_zip64=self.size > 1 << 30) as part:
+                        if info.filename != "word/document.xml":
+                            with src.open(info) as data:
+                                shutil.copyfileobj(data, part)
+                            continue
+                        head, tail = src.read(info).split(f"<!--{_MARKER}-->".encode(), 1)
+                        part.write(head)
+                        self.file.seek(0)
+                        shutil.copyfileobj(self.file, part, 1024 * 1024)
+                        part.write(tail)
+        self.file.close()
+
+
+class DocxEmitter:
+    def __init__(self, doc, code_font="Courier New", code_size=10, code_fill="F1F1F1",
+                 body_space_after=8, code_space_after=4, spool=None):
+        self.doc = doc
+        self.spool = spool
+        self.code_font = code_font
+
+        code, created = _ensure_style(doc, CODE_STYLE)
+        if created:
+            code.font.name = code_font
+            code.font.size = Pt(code_size)
+            code.paragraph_format.space_after = Pt(code_space_after)
+            # shading on the style means no w:shd element per code line
+            if code_fill:
+                shd = OxmlElement('w:shd')
+                shd.set(qn('w:val'), 'clear')
+                shd.set(qn('w:color'), 'auto')
+                shd.set(qn('w:fill'), code_fill)
+                code.element.get_or_add_pPr().append(shd)
+
+        body, created = _ensure_style(doc, BODY_STYLE)
+        if created:
+            body.paragraph_format.space_after = Pt(body_space_after)
+            body.paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
+
+        # resolve style ids once; assigning pStyle directly skips python-docx's
+        # per-paragraph style resolution, which rescans every style in the document
+        styles = {s.name: s for s in doc.styles}
+        self.code_style = code.style_id
+        self.body_style = body.style_id
+        self.list_styles = {kind: [styles[n].style_id if n in styles else body.style_id for n in levels]
+                            for kind, levels in LIST_STYLES.items()}
+        self.heading_styles = {lvl: styles[f"Heading {lvl}"].style_id
+                               for lvl in range(1, 10) if f"Heading {lvl}" in styles}
+        self.table_style = styles.get("Table Grid")
+        self._run_templates = {}
+
+    def _run_template(self, flags):
+        # <w:r><w:rPr>…</w:rPr><w:t xml:space="preserve"/></w:r>, built once per flag combination
+        r = OxmlElement('w:r')
+        if flags:
+            rpr = OxmlElement('w:rPr')
+            if flags & CODE:
+                fonts = OxmlElement('w:rFonts')
+                fonts.set(qn('w:ascii'), self.code_font)
+                fonts.set(qn('w:hAnsi'), self.code_font)
+                rpr.append(fonts)
+            if flags & BOLD:
+                rpr.append(OxmlElement('w:b'))
+            if flags & ITALIC:
+                rpr.append(OxmlElement('w:i'))
+            r.append(rpr)
+        t = OxmlElement('w:t')
+        t.set(qn('xml:space'), 'preserve')
+        r.append(t)
+        return r
+
+    def _runs(self, paragraph, spans):
+        p = paragraph._p
+        for text, flags in spans:
+            template = self._run_templates.get(flags)
+            if template is None:
+                template = self._run_templates[flags] = self._run_template(flags)
+            r = deepcopy(template)
+            r[-1].text = text
+            p.append(r)
+        return paragraph
+
+    def _add(self, spans, style_id):
+        paragraph = self._runs(self.doc.add_paragraph(), spans)
+        paragraph._p.style = style_id
+        return paragraph
+
+    def emit(self, nodes):
+        """Render nodes into the document; returns the number of nodes emitted."""
+        count = 0
+        for kind, level, content in nodes:
+            count += 1
+            if self.spool is not None and DOCX_SPOOL_NODES and count % DOCX_SPOOL_NODES == 0:
+                self.spool.flush()
+            if kind == "code":
+                self._add(((content, 0),), self.code_style)
+            elif kind == "para":
+                self._add(content, self.body_style)
+            elif kind == "heading":
+                style = self.heading_styles.get(min(level, 9))
+                if style is None:
+                    # the template lacks the heading style: a bold body paragraph
+                    self._add([(t, f | BOLD) for t, f in content], self.body_style)
+                else:
+                    self._add(content, style)
+            elif kind in self.list_styles:
+                self._add(content, self.list_styles[kind][level])
+            elif kind == "table":
+                self._table(content, level)
+        return count
+
+    def _table(self, rows, ncols):
+        table = self.doc.add_table(rows=len(rows), cols=ncols)
+        if self.table_style:
+            table.style = self.table_style
+        for r, row in enumerate(rows):
+            cells = table.rows[r].cells
+            for c, spans in enumerate(row[:ncols]):
+                paragraph = cells[c].paragraphs[0]
+                self._runs(paragraph, [(t, f | BOLD) for t, f in spans] if r == 0 else spans)
@@ -0,0 +1,239 @@
+# Build-scoped export store with a disk quota and a background janitor
+#
+#   <root>/<build_id>/model.pickle       the DocModel, so formats can be rendered on demand
+#   <root>/<build_id>/<build_id>.docx    rendered artifacts (written via temp file + rename)
+#
+# Flat combined_<ts>.* files and diagrams/<build_id>/ directories left by older
+# versions are swept by the same rules.
+#
+# A build directory's mtime is its last access; the janitor drops builds idle for
+# longer than EXPORT_TTL and then evicts least recently used builds over the quota.
+import os
+import re
+import time
+import pickle
+import shutil
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+EXPORT_QUOTA_MB  = float(os.getenv("EXPORT_QUOTA_MB", 2048))
+EXPORT_TTL       = float(os.getenv("EXPORT_TTL", 7 * 24 * 3600))   # seconds since last access
+JANITOR_INTERVAL = float(os.getenv("JANITOR_INTERVAL", 600))
+
+_BUILD_ID = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+_LEGACY   = re.compile(r"^combined_\d+\.(docx|pdf|pptx)$")   # flat names from before the store
+
+
+def _tree_size(path):
+    total = 0
+    for parent, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(parent, name))
+            except OSError:
+                pass
+    return total
+
+
+class ExportStore:
+    def __init__(self, root, quota_mb=EXPORT_QUOTA_MB, ttl=EXPORT_TTL, interval=JANITOR_INTERVAL,
+                 on_evict=None):
+        self.root     = root
+        self.quota    = int(quota_mb * 1024 * 1024)
+        self.ttl      = ttl
+        self.interval = interval
+        self.on_evict = on_evict          # called once per sweep with the removed build_ids
+        self._pinned  = {}                # build_id -> active users; never evicted
+        self._removing = set()            # build_ids being deleted; pinning them waits
+        self._lock    = threading.Lock()
+        self._removed = threading.Condition(self._lock)
+        self._wake    = threading.Event()
+        self._thread  = None
+        self.evicted = self.expired = 0
+        os.makedirs(root, exist_ok=True)
+
+    # ── Paths ──
+    def build_dir(self, build_id):
+        if not _BUILD_ID.match(build_id or ""):
+            raise ValueError(f"bad build_id {build_id!r}")
+        return os.path.join(self.root, build_id)
+
+    def path(self, build_id, fmt):
+        return os.path.join(self.build_dir(build_id), f"{build_id}.{fmt}")
+
+    def has(self, build_id, fmt):
+        return os.path.isfile(self.path(build_id, fmt))
+
+    def in_use(self, build_id):
+        """Whether a build is being built or rendered, or still has its directory."""
+        with self._lock:
+            if build_id in self._pinned:
+                return True
+        try:
+            return os.path.isdir(self.build_dir(build_id))
+        except ValueError:
+            return False
+
+    def touch(self, build_id):
+        try:
+            os.utime(self.build_dir(build_id))
+        except OSError:
+            pass
+
+    def temp_path(self, build_id, suffix=".part"):
+        """A fresh temp file inside the build directory, for writers that rename into place."""
+        directory = self.build_dir(build_id)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=suffix)
+        os.close(fd)
+        return tmp
+
+    # ── Models ──
+    def save_model(self, build_id, model):
+        tmp = self.temp_path(build_id)
+        try:
+            with open(tmp, "wb") as f:
+                pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, os.path.join(self.build_dir(build_id), "model.pickle"))
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def load_model(self, build_id):
+        try:
+            with open(os.path.join(self.build_dir(build_id), "model.pickle"), "rb") as f:
+                return pickle.load(f)
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            return None
+
+    @contextmanager
+    def pinned(self, build_id):
+        # keeps a build out of eviction while it is being built or rendered
+        with self._lock:
+            while build_id in self._removing:
+                self._removed.wait()
+            self._pinned[build_id] = self._pinned.get(build_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pinned[build_id] -= 1
+                if not self._pinned[build_id]:
+                    del self._pinned[build_id]
+
+    # ── Janitor ──
+    def _remove(self, path):
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError as e:
+            log.warning("Export cleanup of %s failed: %s", path, e)
+            return False
+        return True
+
+    def _remove_build(self, path, build_id):
+        """Remove a build unless it was pinned since the sweep looked; pinning it waits meanwhile."""
+        if build_id is None:
+            return self._remove(path)
+        with self._lock:
+            if build_id in self._pinned:
+                return False
+            self._removing.add(build_id)
+        try:
+            return self._remove(path)
+        finally:
+            with self._lock:
+                self._removing.discard(build_id)
+                self._removed.notify_all()
+
+    def sweep(self, now=None):
+        """Expire idle builds, then evict LRU builds until the store fits the quota."""
+        now = now or time.time()
+        with self._lock:
+            pinned = set(self._pinned)
+        entries = []   # (last_access, size, path, build_id)
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name == "diagrams" and os.path.isdir(path):
+                # per-build diagram directories written before the blob store
+                for sub in os.listdir(path):
+                    sub_path = os.path.join(path, sub)
+                    entries.append((os.path.getmtime(sub_path), _tree_size(sub_path), sub_path, None))
+            elif os.path.isdir(path) and _BUILD_ID.match(name):
+                entries.append((os.path.getmtime(path), _tree_size(path), path, name))
+            elif _LEGACY.match(name):
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path, None))
+
+        expired, kept = [], []
+        for entry in entries:
+            if entry[3] in pinned:
+                kept.append(entry)
+            elif now - entry[0] > self.ttl:
+                expired.append(entry)
+            else:
+                kept.append(entry)
+        # a build pinned since the listing is skipped now and counts as kept
+        gone = [entry for entry in expired if self._remove_build(entry[2], entry[3])]
+        kept += [entry for entry in expired if entry not in gone]
+        expired = gone
+        removed = [entry[3] for entry in expired if entry[3]]
+
+        evicted = []
+        total = sum(e[1] for e in kept)
+        for entry in sorted(kept):
+            if total <= self.quota:
+                break
+            if entry[3] in pinned:
+                continue
+            if not self._remove_build(entry[2], entry[3]):
+                continue
+            if entry[3]:
+                removed.append(entry[3])
+            total -= entry[1]
+            evicted.append(entry)
+
+        if removed and self.on_evict:
+            try:
+                self.on_evict(removed)
+            except Exception as e:
+                log.warning("Eviction hook for %d build(s) failed: %s", len(removed), e)
+
+        with self._lock:
+            self.expired += len(expired)
+            self.evicted += len(evicted)
+        if expired or evicted:
+            log.info("Export janitor: %d expired, %d evicted, %.1f MB in use",
+                     len(expired), len(evicted), total / 1024 / 1024)
+        return {"expired": len(expired), "evicted": len(evicted), "bytes": total}
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.sweep()
+            except Exception:
+                log.exception("Export janitor sweep failed")
+
+    def start_janitor(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="export-janitor", daemon=True)
+            self._thread.start()
+            self._wake.set()   # first sweep right away
+        return self
+
+    def nudge(self):
+        """Ask the janitor for a sweep now (e.g. after a build wrote new artifacts)."""
+        self._wake.set()
+
+    def stats(self):
+        with self._lock:
+            return {"expired": self.expired, "evicted": self.evicted, "pinned": len(self._pinned)}
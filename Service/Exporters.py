@@ -0,0 +1,224 @@
+# DOCX / PDF / PPTX renderers for a DocModel, run side by side on a process pool
+import os
+import time
+import asyncio
+import logging
+import tempfile
+
+from PIL import Image
+from docx.shared import Inches, Pt
+from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from pptx import Presentation
+from pptx.util import Inches as PPTInches, Pt as PPTPt
+from pptx.enum.text import MSO_AUTO_SIZE
+
+from MdParser import plain_text
+from DocxEmitter import BodySpool, DocxEmitter
+from PdfEmitter import PdfEmitter
+from Templates import TemplateCache
+from Asgi import offload
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+SLIDE_BULLETS = int(os.getenv("SLIDE_BULLETS", 6))     # bullets per slide before continuing
+SLIDE_CHARS   = int(os.getenv("SLIDE_CHARS", 160))     # longer paragraphs are cut on slides
+
+# Each worker process keeps its own tenant skeletons
+_templates = None
+
+def warm():
+    global _templates
+    if _templates is None:
+        _templates = TemplateCache()
+        _templates.warm()
+    return _templates
+
+
+# ── DOCX ──
+def _styled(doc, styles, text, style, **font):
+    # tenant templates may lack built-in styles: fall back to the default paragraph
+    # style with the look approximated by run formatting, as DocxEmitter does
+    if style in styles:
+        return doc.add_paragraph(text, style=style)
+    p = doc.add_paragraph()
+    run = p.add_run(text)
+    for name, value in font.items():
+        setattr(run.font, name, value)
+    return p
+
+
+def _heading(doc, styles, text, level):
+    style = "Title" if level == 0 else f"Heading {level}"
+    return _styled(doc, styles, text, style, bold=True, size=Pt(max(12, 24 - 4 * level)))
+
+
+def render_docx(model, path):
+    doc = warm().clone(model.tenant)
+    styles = {s.name for s in doc.styles}
+
+    # Cover Page
+    cover_title = _heading(doc, styles, 'Technical Report', 0)
+    cover_title.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+    p = doc.add_paragraph()
+    p.add_run(model.title).bold = True
+    p.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+    caption = _styled(doc, styles, f"Generated on: {model.generated}", 'Caption', italic=True)
+    caption.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+    doc.add_page_break()
+
+    spool = BodySpool(doc)
+    DocxEmitter(doc, spool=spool).emit(model.blocks)
+
+    if model.diagrams:
+        _heading(doc, styles, "Diagrams", 1)
+    for diagram in model.diagrams:
+        _heading(doc, styles, diagram.title, 2)
+        p = doc.add_paragraph(diagram.description)
+        p.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
+        p.paragraph_format.space_after = Pt(8)
+        if diagram.image:
+            try:
+                p_img = doc.add_paragraph()
+                p_img.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+                p_img.add_run().add_picture(diagram.image, width=Inches(5.5))
+            except Exception as e:
+                log.warning("Embed %s failed: %s", diagram.image, e)
+        doc.add_paragraph()
+    spool.save(path)
+
+
+# ── PDF ──
+def render_pdf(model, path):
+    pdf = PdfEmitter(path)
+    pdf.cover(model.title, generated=model.generated)
+    pdf.emit(model.blocks)
+    if model.diagrams:
+        pdf.heading("Diagrams", level=1)
+    for diagram in model.diagrams:
+        pdf.heading(diagram.title, level=2)
+        pdf.paragraph(diagram.description)
+        if diagram.image:
+            try:
+                pdf.image(diagram.image)
+            except Exception as e:
+                log.warning("Embed %s failed: %s", diagram.image, e)
+    pdf.close()
+
+
+# ── PPTX ──
+def _bullets(nodes):
+    # flatten a section into (level, text, bold) slide bullets; code and tables stay in the documents
+    heading = False
+    for kind, level, content in nodes:
+        if kind == "heading":
+            heading = True
+            yield 0, plain_text(content), True
+        elif kind == "para":
+            yield int(heading), plain_text(content), False
+        elif kind in ("bullet", "number"):
+            yield min(4, level + int(heading)), plain_text(content), False
+
+def _clip(text):
+    return text if len(text) <= SLIDE_CHARS else text[:SLIDE_CHARS - 1].rsplit(" ", 1)[0] + "…"
+
+def _content_slide(prs, title, bullets):
+    slide = prs.slides.add_slide(prs.slide_layouts[1])
+    slide.shapes.title.text = title
+    frame = slide.placeholders[1].text_frame
+    frame.word_wrap = True
+    frame.auto_size = MSO_AUTO_SIZE.TEXT_TO_FIT_SHAPE
+    for i, (level, text, bold) in enumerate(bullets):
+        para = frame.paragraphs[0] if i == 0 else frame.add_paragraph()
+        para.level = level
+        run = para.add_run()
+        run.text = _clip(text)
+        run.font.bold = bold
+        run.font.size = PPTPt(20 if level == 0 else 16)
+
+def _diagram_slide(prs, diagram):
+    slide = prs.slides.add_slide(prs.slide_layouts[5])
+    slide.shapes.title.text = diagram.title
+    if diagram.description:
+        slide.notes_slide.notes_text_frame.text = diagram.description
+    if not diagram.image:
+        return
+    # fit the picture into the area under the title, keeping its aspect ratio
+    left, top = PPTInches(0.5), PPTInches(1.5)
+    box_w, box_h = prs.slide_width - 2 * left, prs.slide_height - top - PPTInches(0.4)
+    try:
+        with Image.open(diagram.image) as img:
+            w, h = img.size
+        scale = min(box_w / w, box_h / h)
+        width, height = int(w * scale), int(h * scale)
+        slide.shapes.add_picture(diagram.image, left + (box_w - width) // 2, top,
+                                 width=width, height=height)
+    except Exception as e:
+        log.warning("Embed %s failed: %s", diagram.image, e)
+
+def render_pptx(model, path):
+    prs = Presentation()
+
+    slide = prs.slides.add_slide(prs.slide_layouts[0])
+    slide.shapes.title.text = model.title
+    slide.placeholders[1].text = f"Technical Report\nGenerated on: {model.generated}"
+
+    # one slide per top-level section, continued when it has more bullets than fit
+    for title, nodes in model.sections():
+        bullets = list(_bullets(nodes))
+        title = title or model.title
+        for start in range(0, max(1, len(bullets)), SLIDE_BULLETS):
+            _content_slide(prs, title if start == 0 else f"{title} (cont.)",
+                           bullets[start:start + SLIDE_BULLETS])
+
+    for diagram in model.diagrams:
+        _diagram_slide(prs, diagram)
+    prs.save(path)
+
+
+# ── Pipeline ──
+RENDERERS = {"docx": render_docx, "pdf": render_pdf, "pptx": render_pptx}
+
+def export(fmt, model, path):
+    """Render one format to path (atomically) -> {"seconds", "bytes"}."""
+    t0 = time.time()
+    fd, part = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=f".{fmt}.part")
+    os.close(fd)
+    try:
+        RENDERERS[fmt](model, part)
+        os.replace(part, path)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+    seconds = time.time() - t0
+    log.info("%s saved → %s (%d bytes) in %.2fs", fmt.upper(), path, os.path.getsize(path), seconds)
+    return {"seconds": round(seconds, 3), "bytes": os.path.getsize(path)}
+
+def export_all(model, paths, pool=None):
+    """Render every {fmt: path} concurrently on pool (inline when None) -> {fmt: result or {"error"}}."""
+    if pool is None:
+        futures = None
+    else:
+        futures = {fmt: pool.submit(export, fmt, model, path) for fmt, path in paths.items()}
+    results = {}
+    for fmt, path in paths.items():
+        try:
+            results[fmt] = futures[fmt].result() if futures else export(fmt, model, path)
+        except Exception as e:
+            log.error("%s export failed: %s", fmt.upper(), e)
+            results[fmt] = {"error": str(e)}
+    return results
+
+
+async def export_all_async(model, paths, pool=None):
+    """export_all() for the event loop: awaits the workers instead of blocking a thread on them."""
+    async def one(fmt, path):
+        try:
+            if pool is None:
+                return await offload(export, fmt, model, path)
+            return await asyncio.wrap_future(pool.submit(export, fmt, model, path))
+        except Exception as e:
+            log.error("%s export failed: %s", fmt.upper(), e)
+            return {"error": str(e)}
+    results = await asyncio.gather(*(one(fmt, path) for fmt, path in paths.items()))
+    return dict(zip(paths, results))
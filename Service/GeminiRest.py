@@ -0,0 +1,66 @@
+# Minimal asyncio client for the Gemini REST API, used in ASGI mode with GEMINI_ENDPOINT
+#
+# The SDK's async methods need its grpc transport; over REST they block. These two calls
+# cover what the services use (text in, text out) on the shared httpx client instead.
+import os
+import json
+
+from Asgi import client
+
+# ── Config ──
+GEMINI_ENDPOINT = os.getenv("GEMINI_ENDPOINT", "https://generativelanguage.googleapis.com")
+GEMINI_API_KEY  = os.getenv("GEMINI_API_KEY")
+GEMINI_TIMEOUT  = float(os.getenv("GEMINI_TIMEOUT", 300))
+
+
+class GeminiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Gemini {status}: {message}")
+        self.status = status
+
+
+def _url(model_name, method):
+    # the SDK's api_endpoint may be a bare host
+    base = GEMINI_ENDPOINT if "://" in GEMINI_ENDPOINT else f"https://{GEMINI_ENDPOINT}"
+    name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+    return f"{base.rstrip('/')}/v1beta/{name}:{method}"
+
+
+def _body(prompt):
+    return {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+
+
+def _text(response):
+    candidates = response.get("candidates") or []
+    parts = (candidates[0].get("content") or {}).get("parts", []) if candidates else []
+    return "".join(part.get("text", "") for part in parts)
+
+
+def _raise_for(status, body):
+    if status >= 400:
+        try:
+            message = json.loads(body)["error"]["message"]
+        except (ValueError, KeyError, TypeError):
+            message = body[:200]
+        raise GeminiError(status, message)
+
+
+async def generate(model_name, prompt):
+    r = await client().post(_url(model_name, "generateContent"), json=_body(prompt),
+                            headers={"x-goog-api-key": GEMINI_API_KEY or ""}, timeout=GEMINI_TIMEOUT)
+    _raise_for(r.status_code, r.text)
+    return _text(r.json())
+
+
+async def generate_stream(model_name, prompt):
+    """Yields text chunks from streamGenerateContent's server-sent events."""
+    async with client().stream("POST", _url(model_name, "streamGenerateContent") + "?alt=sse",
+                               json=_body(prompt), headers={"x-goog-api-key": GEMINI_API_KEY or ""},
+                               timeout=GEMINI_TIMEOUT) as r:
+        if r.status_code >= 400:
+            _raise_for(r.status_code, (await r.aread()).decode("utf-8", "replace"))
+        async for line in r.aiter_lines():
+            if line.startswith("data:"):
+                text = _text(json.loads(line[5:]))
+                if text:
+                    yield text
@@ -0,0 +1,485 @@
+# Admission control for Gemini calls, shared by every service of the project
+#
+#   text = scheduler.call(lambda: model.generate_content(prompt).text, prompt, "background")
+#   text = await scheduler.call_async(lambda: ..., prompt)      # same budget, from the event loop
+#
+# A call waits for (1) a concurrency slot, (2) one request from the requests-per-minute
+# bucket and (3) its estimated tokens from the tokens-per-minute bucket. Waiters are
+# served by priority: "interactive" (documents a user waits for) before "background"
+# (diagrams, summaries for later), a background call being treated as if it had arrived
+# GEMINI_PRIORITY_GAP seconds later, so it is outranked but never starved.
+#
+# The buckets and the queue of waiting calls live in a sqlite file (GEMINI_LIMITER_PATH,
+# next to the LLM cache), so AiAgent, the UML agent and their workers draw on one project
+# quota and rank against each other: a call is admitted only when the buckets also cover
+# every better-ranked call still waiting, in any process.
+#
+# The concurrency limit is per process and adapts (AIMD): +1/limit per success, halved on
+# 429/5xx. Those errors, and connection failures, are retried with full-jitter backoff.
+# A call not admitted within GEMINI_QUEUE_TIMEOUT raises QueueTimeout.
+import os
+import time
+import uuid
+import heapq
+import random
+import asyncio
+import sqlite3
+import logging
+import threading
+import itertools
+
+import Metrics
+from Metrics import GEMINI_RETRIES_TOTAL, observe
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+GEMINI_RPM             = float(os.getenv("GEMINI_RPM", 1000))        # requests per minute, 0 = unlimited
+GEMINI_TPM             = float(os.getenv("GEMINI_TPM", 1_000_000))   # tokens per minute, 0 = unlimited
+GEMINI_CONCURRENCY     = int(os.getenv("GEMINI_CONCURRENCY", 16))    # starting concurrency limit
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 64))
+GEMINI_RETRIES         = int(os.getenv("GEMINI_RETRIES", 4))
+GEMINI_BACKOFF         = float(os.getenv("GEMINI_BACKOFF", 1.0))     # seconds, doubled per attempt
+GEMINI_BACKOFF_MAX     = float(os.getenv("GEMINI_BACKOFF_MAX", 30))
+GEMINI_OUTPUT_TOKENS   = int(os.getenv("GEMINI_OUTPUT_TOKENS", 2048))  # reserved per call, settled after
+GEMINI_PRIORITY_GAP    = float(os.getenv("GEMINI_PRIORITY_GAP", 30))  # seconds a background call yields
+GEMINI_QUEUE_TIMEOUT   = float(os.getenv("GEMINI_QUEUE_TIMEOUT", 300))  # seconds a call may wait for admission, 0 = forever
+GEMINI_LIMITER_PATH    = os.getenv("GEMINI_LIMITER_PATH", os.path.join("cache", "gemini_limiter.sqlite3"))  # "" = this process only
+GEMINI_LIMITER_POLL    = 0.5   # seconds between re-checks while calls of other processes are ahead
+GEMINI_LIMITER_STALE   = 30    # waiters of a process not heard from for this long are dropped
+
+PRIORITIES = {"interactive": 0.0, "background": GEMINI_PRIORITY_GAP}
+RETRYABLE  = {429, 500, 502, 503, 504}
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def error_status(e):
+    """HTTP status of a failed call: google.api_core errors carry .code, GeminiRest's .status."""
+    for attr in ("status", "code"):
+        try:
+            return int(getattr(e, attr))
+        except (AttributeError, TypeError, ValueError):
+            continue
+    return None
+
+
+def _transient(e):
+    status = error_status(e)
+    if status is not None:
+        return status in RETRYABLE
+    # no status: a dropped connection or a timeout on the way
+    return isinstance(e, (ConnectionError, TimeoutError)) or type(e).__name__ in (
+        "ConnectError", "ReadError", "RemoteProtocolError", "ReadTimeout", "ConnectTimeout", "ConnectionError")
+
+
+class QueueTimeout(Exception):
+    """A call was not admitted before its deadline."""
+
+
+def check_priority(priority):
+    if priority not in PRIORITIES:
+        raise ValueError(f"unknown Gemini priority {priority!r}, expected one of {sorted(PRIORITIES)}")
+    return priority
+
+
+class SharedBudget:
+    """RPM/TPM token buckets and the queue of waiting calls, in a sqlite file every service opens.
+
+    Levels may go negative after a settle; the debt is paid before the next grant.
+    """
+
+    def __init__(self, path=GEMINI_LIMITER_PATH, rpm=GEMINI_RPM, tpm=GEMINI_TPM):
+        self.path  = path
+        self.rates = {"requests": rpm / 60.0, "tokens": tpm / 60.0}
+        self.caps  = {"requests": rpm, "tokens": tpm}
+        self.owner = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False, timeout=10,
+                                   isolation_level=None)
+        if path:
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL, stamp REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS waiters ("
+                         " id TEXT PRIMARY KEY, owner TEXT, rank REAL, cost INTEGER, seen REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS waiters_rank ON waiters(rank)")
+        for name, cap in self.caps.items():
+            self._db.execute("INSERT OR IGNORE INTO buckets VALUES (?, ?, ?)", (name, cap, time.time()))
+
+    def _transaction(self, fn, *args):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(time.time(), *args)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    def _levels(self, now):
+        levels = {}
+        for name, level, stamp in self._db.execute("SELECT name, level, stamp FROM buckets"):
+            if name in self.rates:
+                levels[name] = min(self.caps[name], level + max(0.0, now - stamp) * self.rates[name])
+        return levels
+
+    def _store(self, now, levels):
+        self._db.executemany("UPDATE buckets SET level = ?, stamp = ? WHERE name = ?",
+                             [(level, now, name) for name, level in levels.items()])
+
+    def join(self, wid, rank, cost):
+        self._transaction(lambda now: self._db.execute(
+            "INSERT INTO waiters VALUES (?, ?, ?, ?, ?)", (wid, self.owner, rank, cost, now)))
+
+    def leave(self, wid):
+        self._transaction(lambda now: self._db.execute("DELETE FROM waiters WHERE id = ?", (wid,)))
+
+    def admit(self, wid, rank, cost):
+        """Take one request and cost tokens for a waiter -> 0.0, or seconds to wait before asking again."""
+        return self._transaction(self._admit, wid, rank, cost)
+
+    def _touch(self, now):
+        self._db.execute("UPDATE waiters SET seen = ? WHERE owner = ?", (now, self.owner))
+        self._db.execute("DELETE FROM waiters WHERE seen < ?", (now - GEMINI_LIMITER_STALE,))
+
+    def touch(self):
+        """Keep this process's waiters from being dropped as stale."""
+        self._transaction(self._touch)
+
+    def _admit(self, now, wid, rank, cost):
+        self._touch(now)
+        ahead, ahead_cost = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(cost), 0) FROM waiters WHERE rank < ? OR (rank = ? AND id < ?)",
+            (rank, rank, wid)).fetchone()
+        levels = self._levels(now)
+        need = {"requests": ahead + 1, "tokens": ahead_cost + cost}
+        delay = 0.0
+        for name, level in levels.items():
+            rate = self.rates[name]
+            if rate:   # never more than a full bucket is asked for
+                delay = max(delay, (min(need[name], self.caps[name]) - level) / rate)
+        if delay > 0:
+            return delay
+        levels["requests"] -= 1
+        levels["tokens"]   -= cost
+        self._store(now, levels)
+        self._db.execute("DELETE FROM waiters WHERE id = ?", (wid,))
+        return 0.0
+
+    def refund(self, cost):
+        """Give back a grant that went unused (its waiter was cancelled while being admitted)."""
+        def apply(now):
+            levels = self._levels(now)
+            levels["requests"] += 1
+            levels["tokens"]   += cost
+            self._store(now, levels)
+        self._transaction(apply)
+
+    def settle(self, tokens):
+        """Charge (or refund, if negative) tokens after a call's real size is known."""
+        def apply(now):
+            levels = self._levels(now)
+            levels["tokens"] -= tokens
+            self._store(now, levels)
+        if tokens:
+            self._transaction(apply)
+
+    def queued(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM waiters").fetchone()[0]
+
+
+class _Waiter:
+    def __init__(self, cost, loop=None):
+        self.id        = uuid.uuid4().hex
+        self.rank      = 0.0
+        self.cost      = cost
+        self.loop      = loop
+        self.cancelled = False
+        self.granted   = False
+        self.event     = None if loop else threading.Event()
+        self.future    = loop.create_future() if loop else None
+
+    def grant(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(True))
+
+
+class GeminiScheduler:
+    def __init__(self, rpm=GEMINI_RPM, tpm=GEMINI_TPM, concurrency=GEMINI_CONCURRENCY,
+                 max_concurrency=GEMINI_MAX_CONCURRENCY, path=GEMINI_LIMITER_PATH):
+        self.budget   = SharedBudget(path, rpm, tpm)
+        self.limit    = float(max(1, min(concurrency, max_concurrency)))
+        self.max_concurrency = max_concurrency
+        self.active   = 0
+        self._queue   = []   # (rank, seq, waiter)
+        self._seq     = itertools.count()
+        self._lock    = threading.Lock()
+        self._timer   = None
+        self._timer_due = 0.0
+        self._pumping = self._repump = False
+        self.calls = self.retries = self.overloads = 0
+
+    # ── Admission ──
+    # The sqlite work (admit, touch, settle, leave) runs outside self._lock, which only
+    # guards the in-process queue and counters; one thread pumps at a time, and a _pump()
+    # called meanwhile makes it go round once more.
+    def _pump(self):
+        """Grant waiters in rank order while slots and budget allow."""
+        with self._lock:
+            if self._pumping:
+                self._repump = True
+                return
+            self._pumping = True
+        try:
+            while True:
+                if self._pump_one():
+                    continue
+                with self._lock:
+                    if not self._repump:
+                        self._pumping = False
+                        return
+        except BaseException:
+            with self._lock:
+                self._pumping = False
+            raise
+
+    def _pump_one(self):
+        """Admit the best-ranked waiter -> whether to try the next one."""
+        with self._lock:
+            self._repump = False
+            while self._queue and (self._queue[0][2].cancelled or self._queue[0][2].granted):
+                heapq.heappop(self._queue)
+            if not self._queue:
+                return False
+            if self.active >= int(self.limit):
+                # a release pumps again; meanwhile keep our waiters visible to other processes
+                self._wake_in(GEMINI_LIMITER_STALE / 3)
+                return False
+            waiter = self._queue[0][2]
+        try:
+            delay = self.budget.admit(waiter.id, waiter.rank, waiter.cost)
+        except sqlite3.Error as e:
+            log.warning("Gemini limiter unavailable (%s), retrying", e)
+            delay = GEMINI_LIMITER_POLL
+        with self._lock:
+            if delay > 0:
+                self._wake_in(min(delay, GEMINI_LIMITER_POLL))
+                return False
+            # popped lazily: a better-ranked waiter may have been pushed meanwhile
+            waiter.granted = not waiter.cancelled
+            if waiter.granted:
+                self.active += 1
+                waiter.grant()
+        if not waiter.granted:
+            self.budget.refund(waiter.cost)
+        return True
+
+    def _wake_in(self, delay):
+        due = time.monotonic() + delay
+        if self._timer is not None and self._timer.is_alive() and self._timer_due <= due:
+            return
+        self._timer, self._timer_due = threading.Timer(delay, self._tick), due
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _tick(self):
+        with self._lock:
+            self._timer = None   # this one has fired; let _pump arm the next
+            waiting = bool(self._queue)
+        if waiting:
+            try:
+                self.budget.touch()
+            except sqlite3.Error as e:
+                log.warning("Gemini limiter unavailable (%s)", e)
+        self._pump()
+
+    def _enqueue(self, waiter, priority):
+        # wall-clock ranks, so waiters of different processes compare
+        waiter.rank = time.time() + PRIORITIES[check_priority(priority)]
+        self.budget.join(waiter.id, waiter.rank, waiter.cost)
+        with self._lock:
+            heapq.heappush(self._queue, (waiter.rank, next(self._seq), waiter))
+        self._pump()
+
+    def _cancel(self, waiter):
+        """-> whether the waiter had been granted a slot (which the caller then releases)."""
+        with self._lock:
+            waiter.cancelled = True
+            granted = waiter.granted
+        if not granted:
+            self.budget.leave(waiter.id)
+        return granted
+
+    def _release(self, cost, used=None, overloaded=False):
+        """used: tokens of a completed call; None for one that failed or was abandoned."""
+        with self._lock:
+            self.active -= 1
+            if overloaded:
+                self.overloads += 1
+                self.limit = max(1.0, self.limit / 2)
+            elif used is not None:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+        if used is not None and not overloaded:
+            try:
+                self.budget.settle(used - cost)   # settle the reservation against the real size
+            except sqlite3.Error as e:
+                log.warning("Gemini limiter unavailable (%s), reservation not settled", e)
+        self._pump()
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF * 2 ** attempt))
+
+    def _retry(self, e, attempt):
+        """-> seconds to wait before another attempt, or None to give up."""
+        if attempt >= GEMINI_RETRIES or not _transient(e):
+            return None
+        delay = self._backoff(attempt)
+        with self._lock:
+            self.retries += 1
+        GEMINI_RETRIES_TOTAL.inc(service=Metrics.SERVICE, status=str(error_status(e) or type(e).__name__))
+        log.warning("Gemini call failed (%s), retry %d/%d in %.1fs", e, attempt + 1, GEMINI_RETRIES, delay)
+        return delay
+
+    # ── Threads ──
+    def _expired(self, waiter, cost, timeout):
+        if self._cancel(waiter):
+            self._release(cost)
+        log.warning("Gemini call not admitted within %gs (%d tokens)", timeout, cost)
+        return QueueTimeout(f"not admitted within {timeout:g}s")
+
+    def acquire(self, cost, priority="interactive", timeout=GEMINI_QUEUE_TIMEOUT):
+        waiter = _Waiter(cost)
+        started = time.perf_counter()
+        self._enqueue(waiter, priority)
+        if not waiter.event.wait(timeout or None):
+            raise self._expired(waiter, cost, timeout)
+        observe("gemini_queue", time.perf_counter() - started)
+
+    def call(self, fn, prompt, priority="interactive"):
+        """fn() under the scheduler; retried on transient errors. fn returns the response text."""
+        cost = estimate_tokens(prompt) + GEMINI_OUTPUT_TOKENS
+        for attempt in itertools.count():
+            self.acquire(cost, priority)
+            try:
+                text = fn()
+            except Exception as e:
+                self._release(cost, overloaded=error_status(e) in RETRYABLE)
+                delay = self._retry(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self._release(cost, estimate_tokens(prompt) + estimate_tokens(text or ""))
+            with self._lock:
+                self.calls += 1
+            return text
+
+    def stream(self, chunks_fn, prompt, priority="interactive"):
+        """Yields from chunks_fn() (text chunks) under one admission; retried only until the first chunk."""
+        cost = estimate_tokens(prompt) + GEMINI_OUTPUT_TOKENS
+        for attempt in itertools.count():
+            self.acquire(cost, priority)
+            size, released = 0, False
+            try:
+                for text in chunks_fn():
+                    size += len(text)
+                    yield text
+            except Exception as e:
+                self._release(cost, overloaded=error_status(e) in RETRYABLE)
+                released = True
+                delay = self._retry(e, attempt) if not size else None
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            finally:
+                if not released:   # finished, or the reader went away
+                    self._release(cost, estimate_tokens(prompt) + size // 4)
+            with self._lock:
+                self.calls += 1
+            return
+
+    # ── Event loop ──
+    async def acquire_async(self, cost, priority="interactive", timeout=GEMINI_QUEUE_TIMEOUT):
+        waiter = _Waiter(cost, asyncio.get_running_loop())
+        started = time.perf_counter()
+        self._enqueue(waiter, priority)
+        try:
+            await asyncio.wait_for(waiter.future, timeout or None)
+        except asyncio.TimeoutError:
+            raise self._expired(waiter, cost, timeout) from None
+        except asyncio.CancelledError:
+            if self._cancel(waiter):
+                self._release(cost)
+            raise
+        observe("gemini_queue", time.perf_counter() - started)
+
+    async def call_async(self, fn, prompt, priority="interactive"):
+        """call() for coroutines: fn() returns an awaitable of the response text."""
+        cost = estimate_tokens(prompt) + GEMINI_OUTPUT_TOKENS
+        for attempt in itertools.count():
+            await self.acquire_async(cost, priority)
+            try:
+                text = await fn()
+            except Exception as e:
+                self._release(cost, overloaded=error_status(e) in RETRYABLE)
+                delay = self._retry(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:   # cancelled mid-call
+                self._release(cost)
+                raise
+            self._release(cost, estimate_tokens(prompt) + estimate_tokens(text or ""))
+            with self._lock:
+                self.calls += 1
+            return text
+
+    async def stream_async(self, chunks_fn, prompt, priority="interactive"):
+        cost = estimate_tokens(prompt) + GEMINI_OUTPUT_TOKENS
+        for attempt in itertools.count():
+            await self.acquire_async(cost, priority)
+            size, released = 0, False
+            try:
+                async for text in chunks_fn():
+                    size += len(text)
+                    yield text
+            except Exception as e:
+                self._release(cost, overloaded=error_status(e) in RETRYABLE)
+                released = True
+                delay = self._retry(e, attempt) if not size else None
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                if not released:
+                    self._release(cost, estimate_tokens(prompt) + size // 4)
+            with self._lock:
+                self.calls += 1
+            return
+
+    def stats(self):
+        queued_all = self.budget.queued()
+        with self._lock:
+            return {
+                "limit":     round(self.limit, 2),
+                "active":    self.active,
+                "queued":    sum(1 for *_, w in self._queue if not (w.cancelled or w.granted)),
+                "queued_all": queued_all,
+                "calls":     self.calls,
+                "retries":   self.retries,
+                "overloads": self.overloads,
+            }
+
+
+scheduler = GeminiScheduler()
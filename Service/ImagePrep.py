@@ -0,0 +1,139 @@
+# Diagram preparation for embedding: flatten to RGB, downsample to print size, cache by content
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from CacheDir import CacheDir
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+IMAGE_DPI       = int(os.getenv("IMAGE_DPI", 150))            # target print resolution
+IMAGE_WIDTH_IN  = float(os.getenv("IMAGE_WIDTH_IN", 5.5))     # width diagrams are embedded at
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join("cache", "images"))
+IMAGE_CACHE_MAX_MB = float(os.getenv("IMAGE_CACHE_MAX_MB", 512))   # on-disk bound
+IMAGE_WORKERS   = int(os.getenv("IMAGE_WORKERS", 4))
+
+
+class ImagePrep:
+    """Prepared copies live under cache_dir keyed by the source's content hash and the target size."""
+
+    def __init__(self, cache_dir=IMAGE_CACHE_DIR, dpi=IMAGE_DPI, width_in=IMAGE_WIDTH_IN,
+                 workers=IMAGE_WORKERS, max_bytes=int(IMAGE_CACHE_MAX_MB * 1024 * 1024)):
+        self.cache_dir = cache_dir
+        self.max_px    = int(dpi * width_in)
+        self.dpi       = dpi
+        self.workers   = workers
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.passthrough = self.failed = 0
+        self.bytes_in = self.bytes_out = 0
+        self._dir = CacheDir(cache_dir, max_bytes)
+
+    def _count(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.png")
+
+    def prepare(self, path, digest=None):
+        """Return a path safe to embed (the source itself when it needs no work), or None.
+
+        digest, when the caller already knows the source's content hash, saves re-reading it.
+        """
+        if digest is None:
+            try:
+                with open(path, "rb") as f:
+                    digest = hashlib.file_digest(f, "sha256").hexdigest()
+            except OSError as e:
+                log.warning("Failed to read %s: %s", path, e)
+                self._count(failed=1)
+                return None
+
+        key    = hashlib.sha256(f"{digest}|{self.max_px}|{self.dpi}".encode()).hexdigest()
+        target = self._path(key)
+        if os.path.isfile(target):
+            self._dir.touch(target)
+            self._count(hits=1)
+            return target
+
+        try:
+            with Image.open(path) as img:
+                # a plain RGB image that already fits the print size is embedded as is
+                if img.mode == "RGB" and img.width <= self.max_px:
+                    img.verify()
+                    self._count(passthrough=1)
+                    return path
+                img.load()
+                if img.mode != "RGB":
+                    img = self._flatten(img)
+                if img.width > self.max_px:
+                    img = img.resize((self.max_px, max(1, round(img.height * self.max_px / img.width))),
+                                     Image.LANCZOS)
+                self._write(img, target)
+        except Exception as e:
+            log.warning("Failed to prepare %s: %s", path, e)
+            self._count(failed=1)
+            return None
+        size = os.path.getsize(target)
+        self._dir.added(size)
+        self._count(misses=1, bytes_in=os.path.getsize(path), bytes_out=size)
+        return target
+
+    @staticmethod
+    def _flatten(img):
+        # transparent diagram backgrounds become white rather than black
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            rgba = img.convert("RGBA")
+            canvas = Image.new("RGB", rgba.size, (255, 255, 255))
+            canvas.paste(rgba, mask=rgba.getchannel("A"))
+            return canvas
+        return img.convert("RGB")
+
+    def _write(self, img, target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                img.save(f, format="PNG", dpi=(self.dpi, self.dpi))
+            os.replace(tmp, target)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def prepare_all(self, paths, digests=None):
+        """prepare() every path on a thread pool, preserving order; None entries pass through."""
+        digests = digests or [None] * len(paths)
+        todo = [(p, d) for p, d in zip(paths, digests) if p]
+        if not todo:
+            return [None] * len(paths)
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(todo))),
+                                thread_name_prefix="imageprep") as pool:
+            done = iter(pool.map(lambda job: self.prepare(*job), todo))
+        return [next(done) if p else None for p in paths]
+
+    def restore(self, model):
+        """Prepare again any of a saved model's diagrams whose cached image was evicted since."""
+        for n, diagram in enumerate(model.diagrams):
+            if diagram.image and diagram.source and not os.path.isfile(diagram.image):
+                model.diagrams[n] = diagram._replace(image=self.prepare(diagram.source))
+        return model
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits":        self.hits,
+                "misses":      self.misses,
+                "passthrough": self.passthrough,
+                "failed":      self.failed,
+                "bytes_in":    self.bytes_in,
+                "bytes_out":   self.bytes_out,
+                "evictions":   self._dir.evictions,
+            }
@@ -0,0 +1,114 @@
+# Background build queue for DocBuilder
+import os
+import time
+import logging
+import threading
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+BUILD_WORKERS     = int(os.getenv("BUILD_WORKERS", 2))
+BUILD_QUEUE_DEPTH = int(os.getenv("BUILD_QUEUE_DEPTH", 32))      # queued + running
+JOB_RETENTION     = float(os.getenv("JOB_RETENTION", 24 * 3600))  # seconds to keep finished jobs
+CALLBACK_HOSTS    = {h.strip().lower() for h in os.getenv("CALLBACK_HOSTS", "").split(",") if h.strip()}  # empty = no callbacks
+CALLBACK_TIMEOUT  = float(os.getenv("CALLBACK_TIMEOUT", 5))      # seconds, connect and read each
+
+
+class QueueFull(Exception):
+    pass
+
+
+def check_callback(url):
+    """A callback URL must be http(s) to a host on CALLBACK_HOSTS; raises ValueError."""
+    parts = urlsplit(url) if isinstance(url, str) else None
+    if parts is None or parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("callback_url must be an http(s) URL")
+    if parts.hostname.lower() not in CALLBACK_HOSTS:
+        raise ValueError(f"callback_url host {parts.hostname!r} is not allowed")
+    return url
+
+
+class JobQueue:
+    def __init__(self, workers=BUILD_WORKERS, max_depth=BUILD_QUEUE_DEPTH, retention=JOB_RETENTION):
+        self.workers   = workers
+        self.max_depth = max_depth
+        self.retention = retention
+        self._pool   = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="build")
+        self._jobs   = {}
+        self._active = 0
+        self._lock   = threading.Lock()
+
+    def submit(self, build_id, fn, data, callback_url=None):
+        """Queue fn(data, build_id, progress) -> (result, status_code); raises QueueFull,
+        or ValueError for a callback_url that isn't allowed."""
+        if callback_url:
+            check_callback(callback_url)
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            if self._active >= self.max_depth:
+                raise QueueFull(f"{self._active} builds in flight (limit {self.max_depth})")
+            self._active += 1
+            self._jobs[build_id] = {
+                "build_id":    build_id,
+                "status":      "queued",
+                "stage":       "queued",
+                "stages":      [{"stage": "queued", "at": now}],
+                "result":      None,
+                "error":       None,
+                "queued_at":   now,
+                "started_at":  None,
+                "finished_at": None,
+            }
+        self._pool.submit(self._run, build_id, fn, data, callback_url)
+
+    def _run(self, build_id, fn, data, callback_url):
+        self._update(build_id, status="running", started_at=time.time())
+        progress = lambda stage: self._update(build_id, stage=stage)
+        try:
+            result, code = fn(data, build_id, progress)
+            if code < 400:
+                self._update(build_id, status="completed", stage="done", result=result)
+            else:
+                self._update(build_id, status="failed", stage="failed", error=result.get("error"))
+        except Exception as e:
+            log.exception("Build [%s] crashed", build_id)
+            self._update(build_id, status="failed", stage="failed", error=str(e))
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._jobs[build_id]["finished_at"] = time.time()
+
+        if callback_url:
+            try:
+                # redirects could lead off the allowlist
+                requests.post(callback_url, json=self.status(build_id), timeout=CALLBACK_TIMEOUT,
+                              allow_redirects=False)
+            except Exception as e:
+                log.warning("Callback for build [%s] to %s failed: %s", build_id, callback_url, e)
+
+    def _update(self, build_id, **fields):
+        with self._lock:
+            job = self._jobs[build_id]
+            if "stage" in fields and fields["stage"] != job["stage"]:
+                job["stages"].append({"stage": fields["stage"], "at": time.time()})
+            job.update(fields)
+
+    def _prune(self, now):
+        expired = [bid for bid, job in self._jobs.items()
+                   if job["finished_at"] and now - job["finished_at"] > self.retention]
+        for bid in expired:
+            del self._jobs[bid]
+
+    def status(self, build_id):
+        with self._lock:
+            job = self._jobs.get(build_id)
+            if job is None:
+                return None
+            snapshot = dict(job, stages=list(job["stages"]))
+            snapshot["queue"] = {"active": self._active, "depth": self.max_depth, "workers": self.workers}
+            return snapshot
@@ -0,0 +1,278 @@
+# Shared Gemini response cache: in-memory LRU in front of a sqlite file
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from Metrics import stage
+import GeminiRest
+from GeminiScheduler import scheduler
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") != "0"
+LLM_CACHE_PATH    = os.getenv("LLM_CACHE_PATH", os.path.join("cache", "llm.sqlite3"))
+LLM_CACHE_SIZE    = int(os.getenv("LLM_CACHE_SIZE", 512))            # in-memory entries
+LLM_CACHE_MAX_MB  = float(os.getenv("LLM_CACHE_MAX_MB", 256))        # on-disk bound
+LLM_CACHE_TTL     = float(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))  # seconds, 0 = never expire
+LLM_CACHE_TOUCH_BATCH = int(os.getenv("LLM_CACHE_TOUCH_BATCH", 64))  # disk hits per access-time write
+# grpc, the SDK's default transport, has a real asyncio client; its REST transport (used
+# with GEMINI_ENDPOINT) does not, so there the async variants go through GeminiRest
+GEMINI_NATIVE_ASYNC = not os.getenv("GEMINI_ENDPOINT")
+
+
+def cache_key(model_name: str, prompt: str) -> str:
+    h = hashlib.sha256()
+    h.update(model_name.encode("utf-8"))
+    h.update(b"\x00")
+    h.update(prompt.encode("utf-8"))
+    return h.hexdigest()
+
+
+class LlmCache:
+    """Readers use a connection per thread and never wait on a write (WAL). Writes go
+    through one connection; the byte total is kept in a meta row by triggers, so every
+    process sharing the file sees it without a scan. Disk access times are bumped in
+    batches, on the next put or once LLM_CACHE_TOUCH_BATCH hits have piled up."""
+
+    def __init__(self, path=LLM_CACHE_PATH, max_entries=LLM_CACHE_SIZE,
+                 max_bytes=int(LLM_CACHE_MAX_MB * 1024 * 1024), ttl=LLM_CACHE_TTL):
+        self.path        = path
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.ttl         = ttl
+        self._lru  = OrderedDict()   # key -> (created, text)
+        self._lock = threading.Lock()       # the in-memory LRU, counters and pending touches
+        self._db_lock = threading.Lock()    # the write connection
+        self._touched = {}                  # key -> access time not yet written
+        self._readers = threading.local()
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript("""
+                BEGIN IMMEDIATE;
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY, model TEXT, response TEXT,
+                    size INTEGER, created REAL, accessed REAL);
+                CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed);
+                CREATE INDEX IF NOT EXISTS responses_created ON responses(created);
+                CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER);
+                INSERT OR IGNORE INTO meta
+                    SELECT 'bytes', COALESCE(SUM(size), 0) FROM responses;
+                CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses BEGIN
+                    UPDATE meta SET value = value + NEW.size WHERE name = 'bytes'; END;
+                CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses BEGIN
+                    UPDATE meta SET value = value + NEW.size - OLD.size WHERE name = 'bytes'; END;
+                CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses BEGIN
+                    UPDATE meta SET value = value - OLD.size WHERE name = 'bytes'; END;
+                COMMIT;
+            """)
+
+    def _expired(self, created):
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def _reader(self):
+        db = getattr(self._readers, "db", None)
+        if db is None:
+            db = self._readers.db = sqlite3.connect(self.path, timeout=10)
+        return db
+
+    def get(self, key):
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._lru.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._lru[key]
+
+        row = None
+        if self._db is not None:
+            row = self._reader().execute(
+                "SELECT response, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        with self._lock:
+            if row is None or self._expired(row[1]):
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, row[1], row[0])
+            self._touched[key] = time.time()
+            flush = len(self._touched) >= LLM_CACHE_TOUCH_BATCH
+        if flush:
+            with self._db_lock:
+                self._write_touched()
+                self._db.commit()
+        return row[0]
+
+    def put(self, key, model_name, text):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, text)
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._write_touched()
+            self._db.execute(
+                "INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET"
+                " model = excluded.model, response = excluded.response, size = excluded.size,"
+                " created = excluded.created, accessed = excluded.accessed",
+                (key, model_name, text, len(text.encode("utf-8")), now, now)
+            )
+            self._evict_disk(now)
+            self._db.commit()
+
+    def _remember(self, key, created, text):
+        self._lru[key] = (created, text)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def _write_touched(self):
+        # call with the write lock held
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if touched:
+            self._db.executemany("UPDATE responses SET accessed = MAX(accessed, ?) WHERE key = ?",
+                                 [(at, key) for key, at in touched.items()])
+
+    def _evict_disk(self, now):
+        # call with the write lock held
+        evicted = 0
+        if self.ttl > 0:
+            evicted += max(self._db.execute("DELETE FROM responses WHERE created < ?",
+                                            (now - self.ttl,)).rowcount, 0)
+        total = self._db.execute("SELECT value FROM meta WHERE name = 'bytes'").fetchone()[0]
+        # over the bound, drop least recently used rows down to 90%, a batch sized
+        # from the average row at a time
+        target = self.max_bytes * 0.9 if total > self.max_bytes else total
+        while total > target:
+            rows = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if not rows:
+                break
+            batch = max(1, int((total - target) * rows / total) + 1)
+            evicted += max(self._db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                (batch,)).rowcount, 0)
+            total = self._db.execute("SELECT value FROM meta WHERE name = 'bytes'").fetchone()[0]
+        if evicted:
+            with self._lock:
+                self.evictions += evicted
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits":      self.hits,
+                "disk_hits": self.disk_hits,
+                "misses":    self.misses,
+                "evictions": self.evictions,
+                "entries":   len(self._lru),
+                "hit_rate":  round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+            }
+
+
+cache = LlmCache() if LLM_CACHE_ENABLED else None
+
+
+def _lookup(model, prompt):
+    model_name = getattr(model, "model_name", type(model).__name__)
+    key = cache_key(model_name, prompt)
+    text = cache.get(key) if cache is not None else None
+    if text is not None:
+        log.info("LLM cache hit (%s, %s…)", model_name, key[:12])
+    return model_name, key, text
+
+
+def _store(model_name, key, text):
+    # empty responses are usually blocked/failed generations, don't pin them
+    if cache is not None and text.strip():
+        cache.put(key, model_name, text)
+
+
+def cached_generate(model, prompt: str, priority: str = "interactive") -> str:
+    """model.generate_content(prompt).text, served from the shared cache when possible.
+
+    Misses go through the Gemini scheduler (rate limits, retries); priority is
+    "interactive" or "background".
+    """
+    model_name, key, text = _lookup(model, prompt)
+    if text is not None:
+        return text
+    with stage("gemini"):
+        text = scheduler.call(lambda: model.generate_content(prompt).text or "", prompt, priority)
+    _store(model_name, key, text)
+    return text
+
+
+def cached_generate_stream(model, prompt: str, priority: str = "interactive"):
+    """Streaming variant: yields text chunks, replaying a cached response as one chunk."""
+    model_name, key, text = _lookup(model, prompt)
+    if text is not None:
+        yield text
+        return
+
+    def chunks():
+        for chunk in model.generate_content(prompt, stream=True):
+            yield chunk.text or ""
+
+    parts = []
+    with stage("gemini_stream"):
+        for text in scheduler.stream(chunks, prompt, priority):
+            if text:
+                parts.append(text)
+                yield text
+    _store(model_name, key, "".join(parts))
+
+
+async def cached_generate_async(model, prompt: str, priority: str = "interactive") -> str:
+    """cached_generate() for the event loop."""
+    model_name, key, text = _lookup(model, prompt)
+    if text is not None:
+        return text
+
+    async def generate():
+        if GEMINI_NATIVE_ASYNC:
+            return (await model.generate_content_async(prompt)).text or ""
+        return await GeminiRest.generate(model.model_name, prompt)
+
+    with stage("gemini"):
+        text = await scheduler.call_async(generate, prompt, priority)
+    _store(model_name, key, text)
+    return text
+
+
+async def cached_generate_stream_async(model, prompt: str, priority: str = "interactive"):
+    """cached_generate_stream() for the event loop."""
+    model_name, key, text = _lookup(model, prompt)
+    if text is not None:
+        yield text
+        return
+
+    async def chunks():
+        if GEMINI_NATIVE_ASYNC:
+            async for chunk in await model.generate_content_async(prompt, stream=True):
+                yield chunk.text or ""
+        else:
+            async for text in GeminiRest.generate_stream(model.model_name, prompt):
+                yield text
+
+    parts = []
+    with stage("gemini_stream"):
+        async for text in scheduler.stream_async(chunks, prompt, priority):
+            if text:
+                parts.append(text)
+                yield text
+    _store(model_name, key, "".join(parts))
+
+
+def cache_stats():
+    return cache.stats() if cache is not None else {"enabled": False}
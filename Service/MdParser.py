@@ -0,0 +1,107 @@
+# Streaming Markdown parser shared by AiAgent and DocBuilder
+#
+# parse() consumes an iterable of lines (a list, a file or a live HTTP stream)
+# and yields compact Node tuples as soon as each block is complete:
+#
+#   Node("heading", level, spans)     Node("bullet", depth, spans)
+#   Node("para",    0,     spans)     Node("number", depth, spans)
+#   Node("code",    lang,  text)      Node("table",  ncols, [[spans, ...], ...])
+#
+# spans is a list of (text, flags) with flags a mix of BOLD | ITALIC | CODE.
+import re
+from collections import namedtuple
+
+Node = namedtuple("Node", "kind level content")
+
+BOLD, ITALIC, CODE = 1, 2, 4
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_BULLET  = re.compile(r"^(\s*)[-*+]\s+(.*)$")
+_NUMBER  = re.compile(r"^(\s*)\d+[.)]\s+(.*)$")
+_RULE    = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+_TABLE_SEP = re.compile(r"^\s*\|?\s*:?-{2,}:?\s*(\|\s*:?-{2,}:?\s*)*\|?\s*$")
+_INLINE  = re.compile(
+    r"`([^`]+)`"                                   # 1 code
+    r"|\*\*(.+?)\*\*|__(.+?)__"                    # 2,3 bold
+    r"|\*(?![\s*])(.+?)(?<!\s)\*"                  # 4 italic
+    r"|(?<![\w])_(?![\s_])(.+?)(?<!\s)_(?![\w])"   # 5 italic
+    r"|\[([^\]]+)\]\(([^)\s]+)\)"                  # 6,7 link -> text
+)
+
+
+def parse_inline(text, flags=0):
+    spans, pos = [], 0
+    for m in _INLINE.finditer(text):
+        if m.start() > pos:
+            spans.append((text[pos:m.start()], flags))
+        if m.group(1) is not None:
+            spans.append((m.group(1), flags | CODE))
+        elif m.group(2) is not None or m.group(3) is not None:
+            spans.extend(parse_inline(m.group(2) or m.group(3), flags | BOLD))
+        elif m.group(4) is not None or m.group(5) is not None:
+            spans.extend(parse_inline(m.group(4) or m.group(5), flags | ITALIC))
+        else:
+            spans.append((m.group(6), flags))
+        pos = m.end()
+    if pos < len(text):
+        spans.append((text[pos:], flags))
+    return spans
+
+
+def plain_text(spans):
+    return "".join(text for text, _ in spans)
+
+
+def _table_row(line):
+    cells = line.strip()
+    if cells.startswith("|"):
+        cells = cells[1:]
+    if cells.endswith("|"):
+        cells = cells[:-1]
+    return [parse_inline(c.strip()) for c in cells.split("|")]
+
+
+def parse(lines):
+    fence = None          # language of the open ``` block, "" when unnamed
+    table = []            # buffered '|' lines until we know whether they form a table
+
+    def flush_table():
+        if len(table) >= 2 and _TABLE_SEP.match(table[1]):
+            rows = [_table_row(table[0])] + [_table_row(l) for l in table[2:]]
+            yield Node("table", max(len(r) for r in rows), rows)
+        else:
+            for l in table:
+                yield Node("para", 0, parse_inline(l.strip()))
+        table.clear()
+
+    for raw in lines:
+        line = raw.rstrip("\r\n")
+        stripped = line.strip()
+
+        if fence is not None:
+            if stripped.startswith("```"):
+                fence = None
+            else:
+                yield Node("code", fence, line.rstrip())
+            continue
+
+        if table and not stripped.startswith("|"):
+            yield from flush_table()
+
+        if stripped.startswith("```"):
+            fence = stripped[3:].strip()
+        elif not stripped or _RULE.match(stripped):
+            continue
+        elif stripped.startswith("|"):
+            table.append(stripped)
+        elif (m := _HEADING.match(stripped)):
+            yield Node("heading", len(m.group(1)), parse_inline(m.group(2)))
+        elif (m := _BULLET.match(line)):
+            yield Node("bullet", min(len(m.group(1).expandtabs(4)) // 2, 2), parse_inline(m.group(2)))
+        elif (m := _NUMBER.match(line)):
+            yield Node("number", min(len(m.group(1).expandtabs(4)) // 2, 2), parse_inline(m.group(2)))
+        else:
+            yield Node("para", 0, parse_inline(stripped))
+
+    if table:
+        yield from flush_table()
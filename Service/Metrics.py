@@ -0,0 +1,208 @@
+# Per-stage latency metrics and build_id tracing shared by all three services
+#
+#   with stage("gemini"):            # observes docuagent_stage_seconds{service, stage}
+#       ...
+#   instrument(app, "docbuilder")    # request latency histogram, X-Build-Id, GET /metrics
+#
+# The trace id (a build_id) travels in the X-Build-Id header and lives in a
+# context variable for the request; seconds spent per stage are also totalled
+# per trace so a build can report exactly where its time went.
+import time
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+BUCKETS       = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+TRACE_HEADER  = "X-Build-Id"
+TRACES_KEPT   = 512
+CONTENT_TYPE  = "text/plain; version=0.0.4; charset=utf-8"
+
+SERVICE = "docuagent"
+_trace  = contextvars.ContextVar("trace", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, description):
+        self.name, self.description = name, description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, buckets=BUCKETS):
+        self.name, self.description, self.buckets = name, description, buckets
+        self._series = {}   # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_labels(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_labels(key + (('le', '+Inf'),))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_labels(key)} {series[-2]:.6f}")
+                lines.append(f"{self.name}_count{_labels(key)} {series[-1]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("docuagent_stage_seconds", "Time spent per pipeline stage")
+STAGE_ERRORS  = Counter("docuagent_stage_errors_total", "Pipeline stages that raised")
+HTTP_SECONDS  = Histogram("docuagent_http_request_seconds", "HTTP request latency")
+SINGLEFLIGHT_REQUESTS = Counter("docuagent_singleflight_requests_total",
+                                "Requests that ran a computation (leader) or joined an identical one in flight (follower)")
+GEMINI_RETRIES_TOTAL  = Counter("docuagent_gemini_retries_total",
+                                "Gemini calls retried after an overload or transport error")
+REPORT_SECTIONS       = Counter("docuagent_report_sections_total",
+                                "Report sections generated, or reused unchanged from the previous report")
+REGISTRY = [STAGE_SECONDS, STAGE_ERRORS, HTTP_SECONDS, SINGLEFLIGHT_REQUESTS, GEMINI_RETRIES_TOTAL,
+            REPORT_SECTIONS]
+
+_traces = OrderedDict()   # trace id -> {stage: seconds}
+_traces_lock = threading.Lock()
+
+
+# ── Traces ──
+def current_trace():
+    return _trace.get()
+
+
+@contextmanager
+def trace(trace_id):
+    token = _trace.set(trace_id)
+    try:
+        yield trace_id
+    finally:
+        _trace.reset(token)
+
+
+def carry(fn):
+    """Wrap fn so it runs under the caller's trace id, e.g. when handed to a thread pool."""
+    trace_id = _trace.get()
+    def run(*args, **kwargs):
+        with trace(trace_id):
+            return fn(*args, **kwargs)
+    return run
+
+
+def trace_headers(trace_id=None):
+    trace_id = trace_id or _trace.get()
+    return {TRACE_HEADER: trace_id} if trace_id else {}
+
+
+def trace_stages(trace_id):
+    with _traces_lock:
+        return {k: round(v, 3) for k, v in _traces.get(trace_id, {}).items()}
+
+
+# ── Stages ──
+def observe(name, seconds, trace_id=None):
+    STAGE_SECONDS.observe(seconds, service=SERVICE, stage=name)
+    trace_id = trace_id or _trace.get()
+    if trace_id:
+        with _traces_lock:
+            stages = _traces.get(trace_id)
+            if stages is None:
+                stages = _traces[trace_id] = {}
+                while len(_traces) > TRACES_KEPT:
+                    _traces.popitem(last=False)
+            stages[name] = stages.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name, trace_id=None):
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(service=SERVICE, stage=name)
+        raise
+    finally:
+        observe(name, time.perf_counter() - t0, trace_id)
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ── Flask ──
+def instrument(app, service):
+    """Trace id from X-Build-Id, per-endpoint latency, and GET /metrics on a Flask app."""
+    from flask import request, g, Response
+
+    global SERVICE
+    SERVICE = service
+
+    @app.before_request
+    def _start_trace():
+        g.metrics_started = time.perf_counter()
+        g.metrics_token = _trace.set(request.headers.get(TRACE_HEADER))
+
+    @app.after_request
+    def _finish_trace(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            HTTP_SECONDS.observe(time.perf_counter() - started, service=service,
+                                 endpoint=request.url_rule.rule if request.url_rule else "unmatched",
+                                 method=request.method, status=response.status_code)
+        trace_id = _trace.get()
+        if trace_id:
+            response.headers.setdefault(TRACE_HEADER, trace_id)
+        return response
+
+    @app.teardown_request
+    def _reset_trace(exc):
+        token = g.pop("metrics_token", None)
+        if token is not None:
+            try:
+                _trace.reset(token)
+            except ValueError:   # torn down from another context (streamed responses)
+                pass
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(render(), content_type=CONTENT_TYPE)
+
+    return app
@@ -0,0 +1,196 @@
+# PDF emitter for MdParser node streams, built on reportlab's platypus layout
+#
+# Nodes are turned into flowables and laid out as they arrive, so a live
+# Markdown stream is paginated while it is still being generated and only
+# headings waiting for their first paragraph (keepWithNext) are held back.
+import time
+import logging
+from xml.sax.saxutils import escape
+
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_CENTER
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import (BaseDocTemplate, Frame, PageTemplate, Paragraph, Preformatted,
+                                Spacer, Table, TableStyle, Image, PageBreak)
+
+from MdParser import BOLD, ITALIC, CODE
+
+log = logging.getLogger(__name__)
+
+ACCENT = colors.HexColor("#3B4B64")
+MARGIN = 0.9 * inch
+
+
+def _styles(font="Helvetica", bold="Helvetica-Bold", mono="Courier"):
+    body = ParagraphStyle("Body", fontName=font, fontSize=11, leading=15, spaceAfter=8)
+    styles = {
+        "body":    body,
+        "code":    ParagraphStyle("Code", fontName=mono, fontSize=9, leading=11.5, spaceAfter=8,
+                                  backColor=colors.HexColor("#F1F1F1"), borderPadding=4,
+                                  leftIndent=4, rightIndent=4),
+        "cell":    ParagraphStyle("Cell", parent=body, fontSize=9.5, leading=12, spaceAfter=0),
+        "title":   ParagraphStyle("Title", parent=body, fontName=bold, fontSize=28, leading=34,
+                                  alignment=TA_CENTER, textColor=ACCENT, spaceAfter=24),
+        "subtitle": ParagraphStyle("Subtitle", parent=body, fontName=bold, fontSize=14, leading=18,
+                                   alignment=TA_CENTER, spaceAfter=12),
+        "caption": ParagraphStyle("Caption", parent=body, fontSize=9, textColor=colors.grey,
+                                  alignment=TA_CENTER),
+    }
+    sizes = {1: 18, 2: 14, 3: 12.5, 4: 11.5, 5: 11, 6: 11}
+    for level, size in sizes.items():
+        styles[f"h{level}"] = ParagraphStyle(
+            f"Heading{level}", parent=body, fontName=bold, fontSize=size, leading=size * 1.25,
+            spaceBefore=size * 0.8, spaceAfter=12 if level == 1 else 8,
+            textColor=ACCENT if level == 1 else colors.black, keepWithNext=1)
+    for depth in range(3):
+        indent = 18 + depth * 16
+        styles[f"list{depth}"] = ParagraphStyle(f"List{depth}", parent=body, leftIndent=indent,
+                                                bulletIndent=indent - 12, spaceAfter=4)
+    return styles
+
+
+def markup(spans, mono="Courier"):
+    # (text, flags) spans -> platypus paragraph mini-markup
+    out = []
+    for text, flags in spans:
+        text = escape(text)
+        if flags & CODE:
+            text = f'<font face="{mono}">{text}</font>'
+        if flags & BOLD:
+            text = f"<b>{text}</b>"
+        if flags & ITALIC:
+            text = f"<i>{text}</i>"
+        out.append(text)
+    return "".join(out)
+
+
+class PdfEmitter:
+    """Lays out Markdown nodes and diagrams into a PDF; target is a path or a binary file object."""
+
+    def __init__(self, target, title="Technical Report", footer="DocuAgent | Confidential",
+                 pagesize=A4):
+        self.footer = footer
+        self.styles = _styles()
+        self.doc = BaseDocTemplate(target, pagesize=pagesize, title=title, author="DocuAgent",
+                                   leftMargin=MARGIN, rightMargin=MARGIN,
+                                   topMargin=MARGIN, bottomMargin=MARGIN, pageCompression=1)
+        frame = Frame(self.doc.leftMargin, self.doc.bottomMargin, self.doc.width, self.doc.height,
+                      id="body")
+        self.doc.addPageTemplates([PageTemplate(id="page", frames=[frame], onPage=self._decorate)])
+        self.doc._startBuild(target)
+        self.doc.canv._doctemplate = self.doc
+        self._pending = []     # flowables not laid out yet
+        self._code = []        # lines of the open code block
+        self._numbers = [0, 0, 0]
+        self.closed = False
+
+    # ── Layout ──
+    def _decorate(self, canv, doc):
+        canv.saveState()
+        canv.setFont("Helvetica", 8.5)
+        canv.setFillColor(colors.grey)
+        canv.drawString(doc.leftMargin, doc.bottomMargin / 2, self.footer)
+        canv.drawRightString(doc.leftMargin + doc.width, doc.bottomMargin / 2, str(doc.page))
+        canv.restoreState()
+
+    def _layout(self, final=False):
+        # handle_flowable consumes (and may split/requeue) the head of the list; a
+        # keepWithNext heading waits until the flowable it belongs with has arrived
+        doc, pending = self.doc, self._pending
+        while pending and (final or not pending[0].getKeepWithNext()
+                           or any(not f.getKeepWithNext() for f in pending[1:])):
+            doc.clean_hanging()
+            doc.handle_flowable(pending)
+
+    def add(self, *flowables):
+        self._flush_code()
+        self._pending.extend(flowables)
+        self._layout()
+
+    # ── Markdown ──
+    def _flush_code(self):
+        if self._code:
+            self._pending.append(Preformatted("\n".join(self._code), self.styles["code"]))
+            self._code = []
+
+    def feed(self, node):
+        kind, level, content = node
+        if kind == "code":
+            self._code.append(content)
+            return
+        if kind not in ("bullet", "number"):
+            self._numbers = [0, 0, 0]
+        styles = self.styles
+        if kind == "heading":
+            self.add(Paragraph(markup(content), styles[f"h{min(level, 6)}"]))
+        elif kind == "para":
+            self.add(Paragraph(markup(content), styles["body"]))
+        elif kind == "bullet":
+            self.add(Paragraph(markup(content), styles[f"list{level}"], bulletText="•"))
+        elif kind == "number":
+            self._numbers[level] += 1
+            self._numbers[level + 1:] = [0] * (2 - level)
+            self.add(Paragraph(markup(content), styles[f"list{level}"],
+                               bulletText=f"{self._numbers[level]}."))
+        elif kind == "table":
+            self.add(self._table(content, level))
+
+    def emit(self, nodes):
+        """Lay out nodes as they arrive; returns the number of nodes emitted."""
+        count = 0
+        for node in nodes:
+            self.feed(node)
+            count += 1
+        return count
+
+    def _table(self, rows, ncols):
+        cell = self.styles["cell"]
+        data = [[Paragraph(markup([(t, f | BOLD) for t, f in spans] if r == 0 else spans), cell)
+                 for spans in row[:ncols]] + [""] * (ncols - len(row))
+                for r, row in enumerate(rows)]
+        table = Table(data, colWidths=[self.doc.width / ncols] * ncols, repeatRows=1,
+                      hAlign="LEFT", spaceAfter=10)
+        table.setStyle(TableStyle([
+            ("GRID",       (0, 0), (-1, -1), 0.5, colors.grey),
+            ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#E8ECF2")),
+            ("VALIGN",     (0, 0), (-1, -1), "TOP"),
+        ]))
+        return table
+
+    # ── Report parts ──
+    def cover(self, project_title, heading="Technical Report", generated=None):
+        styles = self.styles
+        self.add(Spacer(1, 2.5 * inch),   # spaceBefore is dropped at the top of a frame
+                 Paragraph(escape(heading), styles["title"]),
+                 Paragraph(escape(project_title), styles["subtitle"]),
+                 Paragraph(f"Generated on: {generated or time.strftime('%B %d, %Y')}", styles["caption"]),
+                 PageBreak())
+
+    def heading(self, text, level=1):
+        self.add(Paragraph(escape(text), self.styles[f"h{level}"]))
+
+    def paragraph(self, text):
+        self.add(Paragraph(escape(text), self.styles["body"]))
+
+    def image(self, path, width=5.5 * inch):
+        iw, ih = ImageReader(path).getSize()
+        width = min(width, self.doc.width)
+        height = width * ih / iw
+        if height > self.doc.height * 0.85:
+            height = self.doc.height * 0.85
+            width = height * iw / ih
+        self.add(Image(path, width=width, height=height), Spacer(1, 10))
+
+    def close(self):
+        """Lay out whatever is still pending and write the PDF."""
+        if self.closed:
+            return
+        self._flush_code()
+        self._layout(final=True)
+        del self.doc.canv._doctemplate
+        self.doc._endBuild()
+        self.closed = True
+        log.info("PDF laid out: %d page(s)", self.doc.page)
@@ -0,0 +1,224 @@
+# PlantUML renderers
+import os
+import time
+import zlib
+import struct
+import hashlib
+import logging
+import subprocess
+import threading
+import tempfile
+from collections import OrderedDict
+
+import requests
+
+from Metrics import stage
+from CacheDir import CacheDir
+from Asgi import client, offload
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+PLANTUML_BACKEND      = os.getenv("PLANTUML_BACKEND", "remote")
+PLANTUML_SERVER       = os.getenv("PLANTUML_SERVER", "http://www.plantuml.com/plantuml/png")
+PLANTUML_LOCAL_SERVER = os.getenv("PLANTUML_LOCAL_SERVER", "http://localhost:8080/png")
+PLANTUML_JAR          = os.getenv("PLANTUML_JAR", "")
+RENDER_CACHE_DIR      = os.getenv("RENDER_CACHE_DIR", os.path.join("cache", "renders"))
+RENDER_CACHE_SIZE     = int(os.getenv("RENDER_CACHE_SIZE", 256))         # in-memory entries
+RENDER_CACHE_MAX_MB   = float(os.getenv("RENDER_CACHE_MAX_MB", 512))     # on-disk bound
+
+
+class RenderError(Exception):
+    pass
+
+
+# ── Backends ──
+class RemoteRenderer:
+    """Fetches PNGs from a PlantUML HTTP server (plantuml.com by default)."""
+    name = "remote"
+
+    def __init__(self, server=PLANTUML_SERVER, timeout=15):
+        self.server  = server.rstrip("/")
+        self.timeout = timeout
+
+    def render(self, uml, encoded):
+        try:
+            r = requests.get(f"{self.server}/{encoded}", timeout=self.timeout)
+        except Exception as e:
+            raise RenderError(f"fetch failed: {e}") from e
+        return self._check(r)
+
+    async def render_async(self, uml, encoded):
+        try:
+            r = await client().get(f"{self.server}/{encoded}", timeout=self.timeout)
+        except Exception as e:
+            raise RenderError(f"fetch failed: {e}") from e
+        return self._check(r)
+
+    def _check(self, r):
+        if r.status_code != 200 or "image" not in r.headers.get("Content-Type", ""):
+            raise RenderError(f"bad response {r.status_code} from {self.server}")
+        return r.content
+
+
+class LocalRenderer(RemoteRenderer):
+    """Renders with a self-hosted PlantUML server, or the plantuml.jar when one is configured."""
+    name = "local"
+
+    def __init__(self, server=PLANTUML_LOCAL_SERVER, jar=PLANTUML_JAR, java="java", timeout=30):
+        super().__init__(server, timeout)
+        self.jar  = jar
+        self.java = java
+
+    def render(self, uml, encoded):
+        if not self.jar:
+            return super().render(uml, encoded)
+        if "@start" not in uml:
+            uml = f"@startuml\n{uml}\n@enduml"
+        try:
+            proc = subprocess.run(
+                [self.java, "-Djava.awt.headless=true", "-jar", self.jar, "-tpng", "-pipe"],
+                input=uml.encode("utf-8"), capture_output=True, timeout=self.timeout
+            )
+        except Exception as e:
+            raise RenderError(f"plantuml.jar failed: {e}") from e
+        if proc.returncode != 0 or not proc.stdout.startswith(b"\x89PNG"):
+            raise RenderError(f"plantuml.jar exit {proc.returncode}: {proc.stderr[:200]!r}")
+        return proc.stdout
+
+    async def render_async(self, uml, encoded):
+        if not self.jar:
+            return await super().render_async(uml, encoded)
+        return await offload(self.render, uml, encoded)
+
+
+class FakeRenderer:
+    """In-process stand-in for tests and offline runs: returns a small deterministic PNG."""
+    name = "fake"
+
+    def __init__(self, latency=0.0, width=64, height=48):
+        self.latency = latency
+        self.width   = width
+        self.height  = height
+        self.calls   = 0
+
+    def render(self, uml, encoded):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        shade = hashlib.sha256(encoded.encode("ascii")).digest()[0]
+        return _solid_png(self.width, self.height, shade)
+
+
+def _solid_png(width, height, shade):
+    def chunk(tag, body):
+        return (struct.pack(">I", len(body)) + tag + body
+                + struct.pack(">I", zlib.crc32(tag + body) & 0xFFFFFFFF))
+    row  = b"\x00" + bytes([shade]) * width
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr)
+            + chunk(b"IDAT", zlib.compress(row * height)) + chunk(b"IEND", b""))
+
+
+# ── Content-addressed cache ──
+class CachedRenderer:
+    """LRU (in memory) + PNG-on-disk cache in front of a backend, keyed by the encoded source."""
+
+    def __init__(self, backend, cache_dir=RENDER_CACHE_DIR, max_entries=RENDER_CACHE_SIZE,
+                 max_bytes=int(RENDER_CACHE_MAX_MB * 1024 * 1024)):
+        self.backend     = backend
+        self.name        = backend.name
+        self.cache_dir   = cache_dir
+        self.max_entries = max_entries
+        self._lru  = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = 0
+        self._dir = CacheDir(cache_dir, max_bytes) if cache_dir else None
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.png")
+
+    def render(self, uml, encoded):
+        key = hashlib.sha256(encoded.encode("ascii")).hexdigest()
+        png = self._memory(key) or self._disk(key)
+        if png is not None:
+            return png
+        with stage("plantuml"):
+            png = self.backend.render(uml, encoded)
+        return self._store(key, png)
+
+    async def render_async(self, uml, encoded):
+        """render() for the event loop; backends without render_async run on a thread."""
+        key = hashlib.sha256(encoded.encode("ascii")).hexdigest()
+        png = self._memory(key) or (await offload(self._disk, key) if self.cache_dir else None)
+        if png is not None:
+            return png
+        with stage("plantuml"):
+            if hasattr(self.backend, "render_async"):
+                png = await self.backend.render_async(uml, encoded)
+            else:
+                png = await offload(self.backend.render, uml, encoded)
+        return await offload(self._store, key, png)
+
+    def _memory(self, key):
+        with self._lock:
+            png = self._lru.get(key)
+            if png is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+            return png
+
+    def _disk(self, key):
+        if not (self.cache_dir and os.path.isfile(self._path(key))):
+            return None
+        with open(self._path(key), "rb") as f:
+            png = f.read()
+        self._dir.touch(self._path(key))
+        with self._lock:
+            self.disk_hits += 1
+        self._remember(key, png)
+        return png
+
+    def _store(self, key, png):
+        with self._lock:
+            self.misses += 1
+        self._remember(key, png)
+        if self.cache_dir:
+            self._write(key, png)
+        return png
+
+    def _remember(self, key, png):
+        with self._lock:
+            self._lru[key] = png
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+
+    def _write(self, key, png):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(png)
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning("Render cache write failed %s: %s", path, e)
+            return
+        self._dir.added(len(png))
+
+    def stats(self):
+        with self._lock:
+            return {"backend": self.name, "hits": self.hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses, "entries": len(self._lru),
+                    "disk_evictions": self._dir.evictions if self._dir else 0}
+
+
+BACKENDS = {"remote": RemoteRenderer, "local": LocalRenderer, "fake": FakeRenderer}
+
+
+def make_renderer(backend=PLANTUML_BACKEND, cache_dir=RENDER_CACHE_DIR):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown PLANTUML_BACKEND: {backend}")
+    log.info("PlantUML renderer: %s (cache: %s)", backend, cache_dir or "memory only")
+    return CachedRenderer(BACKENDS[backend](), cache_dir=cache_dir)
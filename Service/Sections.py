@@ -0,0 +1,286 @@
+# Section-parallel report generation
+#
+# With the code's units (code_units) and a project key, a report is also incremental: each
+# section is stored with the units its text mentions, and a resubmission regenerates only
+# the sections whose outline or referenced units changed, reusing the rest verbatim.
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import Metrics
+from LlmCache import LlmCache, cached_generate
+from Metrics import REPORT_SECTIONS, carry
+from Singleflight import request_key
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+SECTION_WORKERS = int(os.getenv("SECTION_WORKERS", 7))
+SECTION_RETRIES = int(os.getenv("SECTION_RETRIES", 2))   # re-asks after an empty response
+SECTION_CACHE_ENABLED = os.getenv("SECTION_CACHE_ENABLED", "1") != "0"
+SECTION_CACHE_PATH    = os.getenv("SECTION_CACHE_PATH", os.path.join("cache", "sections.sqlite3"))
+
+_TOP_LEVEL = re.compile(r"^\s*(\d+)\.\s+\*{0,2}(.+?)\*{0,2}\s*$")
+_HEADING   = re.compile(r"^(#{1,6})\s*\**\s*(\d+)((?:\.\d+)*)\.?\s*(.*?)\**\s*$")
+_WORD      = re.compile(r"[A-Za-z_$][\w$]*")
+
+# previous report per project: {section number: {key, refs, text}} as JSON
+_reports = LlmCache(SECTION_CACHE_PATH, max_entries=64) if SECTION_CACHE_ENABLED else None
+
+
+class Section:
+    def __init__(self, number, title, outline):
+        self.number  = number
+        self.title   = title
+        self.outline = outline   # the subsection lines under the title, as written
+
+    def __repr__(self):
+        return f"Section({self.number}, {self.title!r})"
+
+
+def split_sections(instructions: str):
+    """Split numbered top-level TOC entries out of the instructions -> (preamble, [Section])."""
+    preamble, sections = [], []
+    for line in instructions.splitlines():
+        m = _TOP_LEVEL.match(line)
+        if m and not line.startswith((" ", "\t")):
+            sections.append(Section(int(m.group(1)), m.group(2).strip(), []))
+        elif sections and line.strip():
+            sections[-1].outline.append(line.rstrip())
+        elif not sections:
+            preamble.append(line)
+    # the TOC heading itself is noise once the sections are split out
+    text = "\n".join(preamble)
+    text = re.sub(r"#+\s*Table of Contents\s*$", "", text.rstrip(), flags=re.I | re.M)
+    return text.strip(), sections
+
+
+def group_sections(sections, groups=None):
+    if not groups or groups >= len(sections):
+        return [[s] for s in sections]
+    size = -(-len(sections) // groups)
+    return [sections[i:i + size] for i in range(0, len(sections), size)]
+
+
+def section_prompt(context_prompt, preamble, group, pages):
+    wanted = "\n".join(
+        f"{s.number}. **{s.title}**\n" + "\n".join(s.outline) for s in group
+    )
+    first = group[0]
+    return (
+        f"{context_prompt}\n\n"
+        f"General guidance for the whole report:\n{preamble}\n\n"
+        f"Write ONLY the following part of the report (about {pages:.1f} page(s)), "
+        "other sections are written separately:\n"
+        f"{wanted}\n\n"
+        f"Start with the heading `# {first.number}. {first.title}` and number every "
+        "subsection heading exactly as in the outline. Output Markdown only."
+    )
+
+
+def normalize_section(text, section):
+    # force the canonical top-level heading and renumber stray subsection headings
+    lines = text.strip().splitlines()
+    while lines and not lines[0].strip():
+        lines.pop(0)
+    if lines and _HEADING.match(lines[0]) and not _HEADING.match(lines[0]).group(3):
+        lines.pop(0)
+    out = [f"# {section.number}. {section.title}"]
+    for line in lines:
+        m = _HEADING.match(line)
+        if m and m.group(3) and int(m.group(2)) != section.number:
+            line = f"{m.group(1)} {section.number}{m.group(3)} {m.group(4)}".rstrip()
+        out.append(line)
+    return "\n".join(out)
+
+
+def _generate_text(model, prompt, label, retries):
+    # transient API errors are already retried (with jitter) by the Gemini scheduler, so
+    # they propagate; only a response that came back empty is asked for again
+    for attempt in range(retries + 1):
+        text = cached_generate(model, prompt)
+        if text.strip():
+            return text, attempt
+        log.warning("Section %s attempt %d returned an empty response", label, attempt + 1)
+    raise RuntimeError("empty response")
+
+
+def _generate_group(model, context_prompt, preamble, group, share, retries):
+    t0 = time.time()
+    label = ",".join(str(s.number) for s in group)
+    text, attempts = _generate_text(model, section_prompt(context_prompt, preamble, group, share), label, retries)
+    if len(group) == 1:
+        return [normalize_section(text, group[0])], attempts, time.time() - t0
+    # a grouped response is split back per section on its top-level headings; the
+    # sections it doesn't carry are generated one by one
+    parts = _split_group(text, group)
+    missing = [s for s in group if s.number not in parts]
+    if missing:
+        log.warning("Section %s response is missing %s, generating them separately",
+                    label, ",".join(str(s.number) for s in missing))
+    for s in missing:
+        try:
+            parts[s.number], retried = _generate_text(
+                model, section_prompt(context_prompt, preamble, [s], share), str(s.number), retries)
+            attempts += 1 + retried
+        except Exception as e:
+            # the sections the group did carry are kept
+            log.error("Section %s failed: %s", s.number, e)
+    return [normalize_section(parts[s.number], s) if s.number in parts else None for s in group], \
+        attempts, time.time() - t0
+
+
+def _split_group(text, group):
+    """-> {section number: text} for the group's sections whose heading the response carries."""
+    numbers = {s.number for s in group}
+    parts, current = {}, None
+    for line in text.splitlines():
+        m = _HEADING.match(line)
+        if m and not m.group(3) and int(m.group(2)) in numbers:
+            current = int(m.group(2))
+            parts[current] = []
+            continue
+        if current is not None:
+            parts[current].append(line)
+    return {number: "\n".join(lines) for number, lines in parts.items() if "\n".join(lines).strip()}
+
+
+# ── Incremental regeneration ──
+def code_units(code, analysis):
+    """{class or function name: fingerprint of its source} for an analyze_source() result.
+
+    A unit runs from its first line to the next unit's, so a method's edit changes the
+    method, not its class; trailing whitespace and blank lines don't count.
+    """
+    units = sorted((u["line"], u["name"]) for u in analysis.get("classes", []) + analysis.get("functions", []))
+    starts = sorted({line for line, _ in units})
+    lines = code.splitlines()
+    fingerprints = {}
+    for line, name in units:
+        end = next((start for start in starts if start > line), len(lines) + 1)
+        body = "\n".join(text.rstrip() for text in lines[line - 1:end - 1]).rstrip()
+        # JavaScript may define a name twice; both bodies count
+        fingerprints[name] = hashlib.sha256((fingerprints.get(name, "") + body).encode("utf-8")).hexdigest()[:16]
+    return fingerprints
+
+
+def summary_units(results):
+    """code_units() for an analyzed repository, whose prompt carries each unit's outline
+    (signature, docstring, calls) rather than its source."""
+    fingerprints = {}
+    for r in results:
+        for unit in r.get("classes", []) + r.get("functions", []):
+            outline = json.dumps({k: v for k, v in unit.items() if k != "line"}, sort_keys=True)
+            name = unit["name"]
+            fingerprints[name] = hashlib.sha256((fingerprints.get(name, "") + outline).encode("utf-8")).hexdigest()[:16]
+    return fingerprints
+
+
+def referenced_units(text, units):
+    """Names of the units a section's text mentions; a class brings its methods along."""
+    words = set(_WORD.findall(text))
+    refs = {name for name in units if name.rsplit(".", 1)[-1] in words}
+    refs.update(name for name in units if name.split(".", 1)[0] in refs)
+    return sorted(refs)
+
+
+def _section_key(section, preamble, share, project, units, refs, structure):
+    # a section that names no unit describes the code as a whole: it follows the
+    # structure (which units exist), not the bodies
+    return request_key(number=section.number, title=section.title, outline=section.outline,
+                       preamble=preamble, share=round(share, 2), project=project,
+                       units={name: units.get(name) for name in refs} if refs else structure)
+
+
+def _load_report(key):
+    text = _reports.get(key) if _reports is not None else None
+    try:
+        return json.loads(text) if text else {}
+    except ValueError:
+        return {}
+
+
+def iter_sections(model, context_prompt, instructions, pages=1, groups=None,
+                  workers=SECTION_WORKERS, retries=SECTION_RETRIES, report=None,
+                  units=None, project=None):
+    """Yield merged Markdown per section in order, generating all sections concurrently.
+
+    report (a dict) is filled with per-section timings, failures and reused sections as they
+    resolve. units ({name: fingerprint}, see code_units) and project (what identifies the
+    report across submissions) turn on incremental regeneration.
+    """
+    preamble, sections = split_sections(instructions)
+    report = report if report is not None else {}
+    report.update({"sections": [], "failed": [], "reused": []})
+    # the page share stays that of the full report, whichever sections are regenerated
+    share = max(0.5, pages / max(1, len(group_sections(sections, groups))))
+
+    incremental = units is not None and project is not None and _reports is not None
+    model_name = getattr(model, "model_name", type(model).__name__)
+    report_key = request_key(model=model_name, project=project, instructions=instructions,
+                             pages=pages, groups=groups)
+    # without units (no parser for the language) any change to the code counts
+    structure = request_key(units=sorted(units)) if units else request_key(context=context_prompt)
+    previous = _load_report(report_key) if incremental else {}
+    stored = {}
+    for s in sections:
+        entry = previous.get(str(s.number))
+        if entry and entry.get("key") == _section_key(s, preamble, share, project, units,
+                                                      entry.get("refs", []), structure):
+            stored[str(s.number)] = entry
+    if stored:
+        log.info("Reusing %d of %d sections from the previous report", len(stored), len(sections))
+
+    batches = group_sections([s for s in sections if str(s.number) not in stored], groups)
+    batch_of = {s.number: i for i, group in enumerate(batches) for s in group}
+    done = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(batches) or 1)),
+                            thread_name_prefix="section") as pool:
+        futures = [pool.submit(carry(_generate_group), model, context_prompt, preamble, group, share, retries)
+                   for group in batches]
+        for s in sections:
+            entry = stored.get(str(s.number))
+            if entry is not None:
+                report["reused"].append(s.number)
+                REPORT_SECTIONS.inc(service=Metrics.SERVICE, result="reused")
+                yield entry["text"] + "\n\n"
+                continue
+            i = batch_of[s.number]
+            if i not in done:
+                done[i] = _resolve(batches[i], futures[i], report)
+            text = done[i].get(s.number)
+            if text is None:
+                yield f"# {s.number}. {s.title}\n\n_This section could not be generated._\n\n"
+                continue
+            REPORT_SECTIONS.inc(service=Metrics.SERVICE, result="generated")
+            if incremental:
+                refs = referenced_units("\n".join([s.title, *s.outline, text]), units)
+                stored[str(s.number)] = {"key": _section_key(s, preamble, share, project, units, refs, structure),
+                                         "refs": refs, "text": text}
+            yield text + "\n\n"
+
+    if incremental and batches and stored:
+        # failed sections are left out, so the next submission retries them
+        _reports.put(report_key, "sections", json.dumps(stored))
+
+
+def _resolve(group, future, report):
+    """-> {section number: Markdown} of a generated group, without the sections that failed."""
+    numbers = [s.number for s in group]
+    try:
+        texts, retried, seconds = future.result()
+    except Exception as e:
+        log.error("Sections %s failed after retries: %s", numbers, e)
+        report["failed"].extend(numbers)
+        return {}
+    report["failed"].extend(n for n, text in zip(numbers, texts) if text is None)
+    report["sections"].append({"sections": numbers, "retries": retried, "seconds": round(seconds, 2)})
+    return {n: text for n, text in zip(numbers, texts) if text is not None}
+
+
+def sectioned(instructions):
+    return len(split_sections(instructions)[1]) >= 2
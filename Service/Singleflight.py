@@ -0,0 +1,222 @@
+# Request coalescing: identical requests that arrive while one is in flight share its work
+#
+#   flights = Singleflight("generate-uml-image")
+#   key = request_key(abstract=..., instructions=...)
+#   result, shared = flights.call(key, fn, *args)        # one caller runs fn, the rest wait for it
+#   for item in flights.stream(key, produce, *args):     # one producer thread, every caller replays it
+#   result, shared = await flights.call_async(key, coro_fn, *args)   # ASGI mode
+#   async for item in flights.stream_async(key, agen_fn, *args):
+#
+# Each caller that joins instead of running counts as a follower in
+# docuagent_singleflight_requests_total: one computation (and its model/render calls) saved.
+import os
+import json
+import asyncio
+import hashlib
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future
+
+import Metrics
+from Metrics import SINGLEFLIGHT_REQUESTS
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "1") != "0"
+
+
+def _normalize(value):
+    if isinstance(value, str):
+        return value.replace("\r\n", "\n").strip()
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def request_key(**fields):
+    """Hash of the fields that decide a result; line endings and outer whitespace don't count."""
+    blob = json.dumps(_normalize(fields), sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    """Items published by one producer, replayed to any number of readers."""
+
+    def __init__(self):
+        self.items = []
+        self.done  = False
+        self.error = None
+        self._cond = threading.Condition()
+
+    def publish(self, item):
+        with self._cond:
+            self.items.append(item)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done, self.error = True, error
+            self._cond.notify_all()
+
+    def follow(self):
+        n = 0
+        while True:
+            with self._cond:
+                while n == len(self.items) and not self.done:
+                    self._cond.wait()
+                batch, done, error = self.items[n:], self.done, self.error
+            n += len(batch)
+            yield from batch
+            if done and n == len(self.items):
+                if error is not None:
+                    raise error
+                return
+
+
+class _AsyncFlight:
+    """_Flight for the event loop: producer and readers are tasks on one loop."""
+
+    def __init__(self):
+        self.items = []
+        self.done  = False
+        self.error = None
+        self.task  = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, item):
+        self.items.append(item)
+        self._notify()
+
+    def finish(self, error=None):
+        self.done, self.error = True, error
+        self._notify()
+
+    async def follow(self):
+        n = 0
+        while True:
+            if n == len(self.items) and not self.done:
+                await self._changed.wait()
+                continue
+            batch = self.items[n:]
+            n += len(batch)
+            for item in batch:
+                yield item
+            if self.done and n == len(self.items):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class Singleflight:
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = self.followers = 0
+
+    def _join(self, key, factory):
+        """-> (flight, leader); the first caller for a key becomes its leader."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = factory()
+                self.leaders += 1
+            else:
+                self.followers += 1
+        SINGLEFLIGHT_REQUESTS.inc(service=Metrics.SERVICE, flight=self.name,
+                                  role="leader" if leader else "follower")
+        if not leader:
+            log.info("Joined in-flight %s %s…", self.name, key[:12])
+        return flight, leader
+
+    def _land(self, key, flight):
+        # later identical requests start a fresh flight (and usually hit the LLM cache)
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def stats(self):
+        with self._lock:
+            return {"leaders": self.leaders, "followers": self.followers, "in_flight": len(self._flights)}
+
+    # ── Threads (WSGI mode) ──
+    def call(self, key, fn, *args, **kwargs):
+        """-> (result, shared); fn runs on the leader's thread, followers block on its Future."""
+        if not SINGLEFLIGHT_ENABLED:
+            return fn(*args, **kwargs), False
+        future, leader = self._join(key, Future)
+        if not leader:
+            return future.result(), True
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            self._land(key, future)
+        return future.result(), False
+
+    def stream(self, key, produce, *args, **kwargs):
+        """Items of produce(*args), generated once on its own thread and replayed to every caller.
+
+        The producer does not depend on any one reader, so a leader whose client goes away
+        does not cut off the followers; it runs to completion under the leader's context.
+        """
+        if not SINGLEFLIGHT_ENABLED:
+            yield from produce(*args, **kwargs)
+            return
+        flight, leader = self._join(key, _Flight)
+        if leader:
+            def run():
+                try:
+                    for item in produce(*args, **kwargs):
+                        flight.publish(item)
+                except Exception as e:
+                    flight.finish(e)
+                else:
+                    flight.finish()
+                finally:
+                    self._land(key, flight)
+            context = contextvars.copy_context()
+            threading.Thread(target=context.run, args=(run,), name=f"flight-{self.name}", daemon=True).start()
+        yield from flight.follow()
+
+    # ── Event loop (ASGI mode) ──
+    async def call_async(self, key, fn, *args, **kwargs):
+        """-> (result, shared); the leader's coroutine runs as a task, so a cancelled caller
+        does not cancel it for the others."""
+        if not SINGLEFLIGHT_ENABLED:
+            return await fn(*args, **kwargs), False
+        task, leader = self._join(key, lambda: asyncio.ensure_future(fn(*args, **kwargs)))
+        if leader:
+            task.add_done_callback(lambda _: self._land(key, task))
+        return await asyncio.shield(task), not leader
+
+    async def stream_async(self, key, produce, *args, **kwargs):
+        if not SINGLEFLIGHT_ENABLED:
+            async for item in produce(*args, **kwargs):
+                yield item
+            return
+        flight, leader = self._join(key, _AsyncFlight)
+        if leader:
+            async def run():
+                try:
+                    async for item in produce(*args, **kwargs):
+                        flight.publish(item)
+                except Exception as e:
+                    flight.finish(e)
+                else:
+                    flight.finish()
+                finally:
+                    self._land(key, flight)
+            flight.task = asyncio.ensure_future(run())   # held, or the loop may drop it
+        async for item in flight.follow():
+            yield item
@@ -0,0 +1,191 @@
+# Token-budgeted map-reduce condensation of large source inputs
+import os
+import re
+import ast
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from LlmCache import cached_generate
+from Metrics import carry
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+CODE_TOKEN_BUDGET    = int(os.getenv("CODE_TOKEN_BUDGET", 30000))
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", 8000))
+SUMMARY_WORKERS      = int(os.getenv("SUMMARY_WORKERS", 4))
+SUMMARY_MAX_ROUNDS   = 3
+CHARS_PER_TOKEN      = 4   # Gemini averages ~4 chars/token on source code
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+# ── Split ──
+def _split_lines(lines, max_tokens):
+    chunks, current, size = [], [], 0
+    for line in lines:
+        cost = estimate_tokens(line) + 1
+        if current and size + cost > max_tokens:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += cost
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def _python_units(code):
+    # top-level statements with their leading comments/decorators, as source slices
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    lines = code.splitlines()
+    units, prev_end = [], 0
+    for node in tree.body:
+        start = min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])]) - 1
+        units.append("\n".join(lines[prev_end:start] + lines[start:node.end_lineno]))
+        prev_end = node.end_lineno
+    if prev_end < len(lines):
+        units.append("\n".join(lines[prev_end:]))
+    return units
+
+
+_BOUNDARY = re.compile(r"^(?:## |(?:export\s+)?(?:async\s+)?(?:function|class|const|let|var|def)\b)")
+
+
+def _generic_units(code):
+    # break before unindented declarations and file headers of an analyzer summary
+    units, current = [], []
+    for line in code.splitlines():
+        if current and _BOUNDARY.match(line):
+            units.append("\n".join(current))
+            current = []
+        current.append(line)
+    if current:
+        units.append("\n".join(current))
+    return units
+
+
+def split_code(code: str, ext: str = "", max_tokens: int = SUMMARY_CHUNK_TOKENS):
+    units = (_python_units(code) if ext == ".py" else None) or _generic_units(code)
+    chunks, current, size = [], [], 0
+    for unit in units:
+        cost = estimate_tokens(unit)
+        if cost > max_tokens:
+            # a single oversized unit (huge class, minified file) falls back to line splits
+            if current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            chunks.extend(_split_lines(unit.splitlines(), max_tokens))
+            continue
+        if current and size + cost > max_tokens:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(unit)
+        size += cost
+    if current:
+        chunks.append("\n".join(current))
+    return [c for c in chunks if c.strip()]
+
+
+# ── Map / reduce ──
+def _map_prompt(chunk, target_tokens):
+    return (
+        "You are summarising part of a software project for a technical report writer.\n"
+        f"In at most {target_tokens} tokens, describe the modules, classes and functions below: "
+        "their responsibilities, key signatures, data flow, external dependencies and notable "
+        "algorithms. Keep identifiers verbatim. Output plain bullet points only.\n\n"
+        f"```\n{chunk}\n```"
+    )
+
+
+def _reduce_prompt(summaries, target_tokens):
+    joined = "\n\n".join(summaries)
+    return (
+        "Merge these partial summaries of one software project into a single coherent "
+        f"architecture summary of at most {target_tokens} tokens. Keep identifiers verbatim, "
+        "remove repetition, group by module. Output plain bullet points only.\n\n" + joined
+    )
+
+
+def _truncated(text, target_tokens):
+    if estimate_tokens(text) <= target_tokens:
+        return text
+    return text[:target_tokens * CHARS_PER_TOKEN] + "\n[... summary unavailable, truncated]"
+
+
+def _summarize_all(model, jobs, workers, report):
+    """jobs: [(prompt, source, target_tokens)] -> summaries in order.
+
+    A chunk whose call fails (or comes back empty) is replaced by its source cut to the
+    target, so one bad chunk doesn't fail the whole request; report["failed_chunks"] counts them.
+    """
+    def summarize(job):
+        prompt, source, target = job
+        try:
+            text = cached_generate(model, prompt).strip()
+            if text:
+                return text, False
+            error = "empty response"
+        except Exception as e:
+            error = e
+        log.warning("Summary of a %d-token chunk failed (%s), using it truncated", estimate_tokens(source), error)
+        return _truncated(source, target), True
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs))),
+                            thread_name_prefix="summary") as pool:
+        results = list(pool.map(carry(summarize), jobs))
+    report["failed_chunks"] += sum(failed for _, failed in results)
+    return [text for text, _ in results]
+
+
+def condense(model, code: str, ext: str = "", budget: int = CODE_TOKEN_BUDGET,
+             chunk_tokens: int = SUMMARY_CHUNK_TOKENS, workers: int = SUMMARY_WORKERS):
+    """Return (context, report); context is code itself when it already fits the budget."""
+    started = time.time()
+    tokens_in = estimate_tokens(code)
+    report = {"tokens_in": tokens_in, "tokens_out": tokens_in, "tokens_saved": 0,
+              "chunks": 0, "rounds": 0, "failed_chunks": 0, "timings": {}}
+    if tokens_in <= budget:
+        return code, report
+
+    t0 = time.time()
+    chunks = split_code(code, ext, chunk_tokens)
+    report["chunks"] = len(chunks)
+    report["timings"]["split"] = round(time.time() - t0, 3)
+
+    # each chunk gets a share of the budget so the map output usually fits without reducing
+    per_chunk = max(200, budget // max(1, len(chunks)))
+    t0 = time.time()
+    summaries = _summarize_all(model, [(_map_prompt(c, per_chunk), c, per_chunk) for c in chunks],
+                               workers, report)
+    report["timings"]["map"] = round(time.time() - t0, 3)
+
+    t0 = time.time()
+    while estimate_tokens("\n\n".join(summaries)) > budget and report["rounds"] < SUMMARY_MAX_ROUNDS:
+        report["rounds"] += 1
+        # tree reduction: merge neighbours in groups that fit one chunk each
+        groups = split_code("\n\n".join(f"## part {i}\n{s}" for i, s in enumerate(summaries)),
+                            "", chunk_tokens)
+        per_group = max(200, budget // max(1, len(groups)))
+        summaries = _summarize_all(model, [(_reduce_prompt([g], per_group), g, per_group) for g in groups],
+                                   workers, report)
+        if len(groups) == 1:
+            break
+    context = "\n\n".join(summaries)
+    if estimate_tokens(context) > budget:
+        context = context[:budget * CHARS_PER_TOKEN]
+    report["timings"]["reduce"] = round(time.time() - t0, 3)
+
+    report["tokens_out"]   = estimate_tokens(context)
+    report["tokens_saved"] = tokens_in - report["tokens_out"]
+    report["timings"]["total"] = round(time.time() - started, 3)
+    log.info("Condensed code context %d → %d tokens (%d chunks, %d failed, %d reduce rounds) in %.2fs",
+             tokens_in, report["tokens_out"], len(chunks), report["failed_chunks"], report["rounds"],
+             time.time() - started)
+    return context, report
@@ -0,0 +1,143 @@
+# Pre-built DOCX skeletons, one per tenant, cloned per build
+import os
+import io
+import re
+import zipfile
+import logging
+import threading
+
+from docx import Document
+from docx.shared import Pt, RGBColor
+from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from docx.oxml.ns import qn
+from docx.oxml import OxmlElement
+
+from DocxEmitter import DocxEmitter
+
+log = logging.getLogger(__name__)
+
+# ── Config ──
+TEMPLATE_DIR   = os.getenv("TEMPLATE_DIR", os.path.join(os.path.dirname(__file__), "templates"))
+DEFAULT_TENANT = "default"
+_TENANT_NAME   = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+_DOTX_TYPE = b"application/vnd.openxmlformats-officedocument.wordprocessingml.template.main+xml"
+_DOCX_TYPE = b"application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"
+
+
+def _dotx_as_docx(path):
+    # python-docx refuses .dotx only because of its main content type; rewrite it in memory
+    out = io.BytesIO()
+    with zipfile.ZipFile(path) as src, zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as dst:
+        for item in src.infolist():
+            data = src.read(item)
+            if item.filename == "[Content_Types].xml":
+                data = data.replace(_DOTX_TYPE, _DOCX_TYPE)
+            dst.writestr(item, data)
+    out.seek(0)
+    return out
+
+
+def add_page_number_footer(doc, text=" DocuAgent | Confidential\t"):
+    footer = doc.sections[0].footer
+    p = footer.paragraphs[0] if footer.paragraphs else footer.add_paragraph()
+    p.text = text
+    run = p.add_run()
+    fldChar1 = OxmlElement('w:fldChar')
+    fldChar1.set(qn('w:fldCharType'), 'begin')
+    instrText = OxmlElement('w:instrText')
+    instrText.set(qn('xml:space'), 'preserve')
+    instrText.text = 'PAGE'
+    fldChar2 = OxmlElement('w:fldChar')
+    fldChar2.set(qn('w:fldCharType'), 'end')
+    run._r.append(fldChar1)
+    run._r.append(instrText)
+    run._r.append(fldChar2)
+    p.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+
+
+def default_skeleton():
+    doc = Document()
+
+    # Define Styles
+    style_normal = doc.styles['Normal']
+    font = style_normal.font
+    font.name = 'Poppins'
+    font.size = Pt(11)
+
+    style_h1 = doc.styles['Heading 1']
+    style_h1.font.name = 'Poppins'
+    style_h1.font.size = Pt(18)
+    style_h1.font.bold = True
+    style_h1.font.color.rgb = RGBColor(0x3B, 0x4B, 0x64)
+    style_h1.paragraph_format.space_after = Pt(12)
+
+    style_h2 = doc.styles['Heading 2']
+    style_h2.font.name = 'Poppins'
+    style_h2.font.size = Pt(14)
+    style_h2.font.bold = True
+    style_h2.paragraph_format.space_after = Pt(10)
+
+    add_page_number_footer(doc)
+    return doc
+
+
+class TemplateCache:
+    """Keeps each tenant's styled skeleton as serialized bytes; clone() parses a fresh copy."""
+
+    def __init__(self, template_dir=TEMPLATE_DIR):
+        self.template_dir = template_dir
+        self._bytes = {}
+        self._lock  = threading.Lock()
+
+    def _template_path(self, tenant):
+        for ext in (".dotx", ".docx"):
+            path = os.path.join(self.template_dir, tenant + ext)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def _build(self, tenant):
+        path = self._template_path(tenant)
+        if path:
+            doc = Document(_dotx_as_docx(path) if path.endswith(".dotx") else path)
+            log.info("Loaded template for tenant [%s] from %s", tenant, path)
+        else:
+            doc = default_skeleton()
+        DocxEmitter(doc)   # bake the emitter's code/body styles into the skeleton too
+        buffer = io.BytesIO()
+        doc.save(buffer)
+        return buffer.getvalue()
+
+    def skeleton(self, tenant=DEFAULT_TENANT):
+        if not tenant or not _TENANT_NAME.match(tenant):
+            tenant = DEFAULT_TENANT
+        with self._lock:
+            data = self._bytes.get(tenant)
+        if data is None:
+            if tenant != DEFAULT_TENANT and not self._template_path(tenant):
+                log.warning("No template for tenant [%s], using default", tenant)
+                return self.skeleton(DEFAULT_TENANT)
+            data = self._build(tenant)
+            with self._lock:
+                self._bytes.setdefault(tenant, data)
+        return data
+
+    def clone(self, tenant=DEFAULT_TENANT):
+        return Document(io.BytesIO(self.skeleton(tenant)))
+
+    def warm(self):
+        tenants = {DEFAULT_TENANT}
+        if os.path.isdir(self.template_dir):
+            tenants.update(os.path.splitext(name)[0] for name in os.listdir(self.template_dir)
+                           if name.endswith((".dotx", ".docx")))
+        for tenant in sorted(tenants):
+            self.skeleton(tenant)
+        log.info("Prepared DOCX skeletons for %d tenant(s)", len(tenants))
+
+    def invalidate(self, tenant=None):
+        with self._lock:
+            if tenant is None:
+                self._bytes.clear()
+            else:
+                self._bytes.pop(tenant, None)
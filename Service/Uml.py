@@ -3,9 +3,10 @@
 import os
 import re
 import time
-import zlib
+import asyncio
 import logging
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import google.generativeai as genai
@@ -13,13 +14,30 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+from Encoder import plantuml_encode
+from Renderer import make_renderer, RenderError
+from LlmCache import cached_generate, cached_generate_async, cache_stats
+from GeminiScheduler import scheduler, check_priority
+from BlobStore import BlobStore
+from Metrics import instrument, stage, carry, trace_headers
+from Singleflight import Singleflight, request_key
+from Asgi import AsgiApp, SERVER_MODE, client, offload, json_body, json_response, serve
+
 # ── Config ──
+PORT            = int(os.getenv("PORT", 5001))
 DOCBUILDER_URL  = os.getenv("DOCBUILDER_URL", "http://localhost:5002")
 GEMINI_API_KEY  = os.getenv("GEMINI_API_KEY")
-PLANTUML_SERVER = "http://www.plantuml.com/plantuml/png"
-EXPORT_STATIC   = os.getenv("STATIC_DIR", "static")
-
-os.makedirs(EXPORT_STATIC, exist_ok=True)
+GEMINI_ENDPOINT = os.getenv("GEMINI_ENDPOINT")   # another API host, e.g. benchmarks/fakes.py
+UML_WORKERS     = int(os.getenv("UML_WORKERS", 4))
+UML_MAX_WORKERS = int(os.getenv("UML_MAX_WORKERS", 16))
+UML_PRIORITY    = check_priority(os.getenv("UML_PRIORITY", "background"))   # Gemini priority; documents come first
+# "batched": all diagrams of a request from one Gemini call (plus a follow-up call for the
+# blocks that were missing or did not render), instead of one call per diagram type
+UML_MODE          = os.getenv("UML_MODE", "per-type")
+UML_BATCH_RETRIES = int(os.getenv("UML_BATCH_RETRIES", 1))   # follow-up batches
+# "reference" when DocBuilder shares our BLOB_DIR (same host/volume): diagrams are
+# handed over by digest in the manifest; "upload" posts them to /ingest-diagram
+DIAGRAM_HANDOFF = os.getenv("DIAGRAM_HANDOFF", "upload")
 
 # ── Logging ──
 logging.basicConfig(
@@ -32,134 +50,472 @@ log = logging.getLogger(__name__)
 # ── Flask & CORS ──
 app = Flask(__name__)
 CORS(app)
+instrument(app, "uml")
 
 # ── Gemini setup ──
 if not GEMINI_API_KEY:
     log.critical("GEMINI_API_KEY not set")
     raise RuntimeError("GEMINI_API_KEY not set")
-genai.configure(api_key=GEMINI_API_KEY)
+if GEMINI_ENDPOINT:
+    genai.configure(api_key=GEMINI_API_KEY, transport="rest", client_options={"api_endpoint": GEMINI_ENDPOINT})
+else:
+    genai.configure(api_key=GEMINI_API_KEY)
 model = genai.GenerativeModel("models/gemini-1.5-flash")
 
-// Send data in chunks
-def plantuml_encode(text: str) -> str:
-    data = zlib.compress(text.encode("utf-8"))[2:-4]
-    alphabet = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-_"
-    out = ""
-    for i in range(0, len(data), 3):
-        chunk = data[i:i+3].ljust(3, b'\x00')
-        b1,b2,b3 = chunk
-        out += alphabet[b1>>2]
-        out += alphabet[((b1&0x3)<<4)|(b2>>4)]
-        out += alphabet[((b2&0xF)<<2)|(b3>>6)]
-        out += alphabet[b3&0x3F]
-    return out
+# ── PlantUML renderer (PLANTUML_BACKEND=remote|local|fake, cached) ──
+renderer = make_renderer()
 
+# ── Content-addressed diagram store ──
+# Uploaded diagrams are referenced by no manifest here, so they go once BLOB_GRACE has
+# passed; with DIAGRAM_HANDOFF=reference DocBuilder's manifests keep them alive
+blobs = BlobStore().start_collector()
 
-@app.route("/generate-uml-image", methods=["POST"])
-def generate_uml_image():
-    start = time.time()
-    payload      = request.get_json(force=True) or {}
-    abstract     = payload.get("abstract", "").strip()
-    instructions = payload.get("instructions", "").strip()
+def push_diagram(build_id, dtype, desc, index, digest):
+    meta = {"build_id": build_id, "diagramType": dtype, "description": desc, "index": index}
+    with stage("ingest"):
+        if DIAGRAM_HANDOFF == "reference":
+            blobs.record(build_id, digest, diagramType=dtype, description=desc, index=index)
+            return "reference"
+        # offer the digest first; DocBuilder only needs the bytes for a diagram it has never seen
+        headers = trace_headers(build_id)
+        r = requests.post(f"{DOCBUILDER_URL}/ingest-diagram", data=dict(meta, blob=digest),
+                          headers=headers, timeout=10)
+        if r.status_code == 404:
+            r = requests.post(
+                f"{DOCBUILDER_URL}/ingest-diagram",
+                files={"image": (f"{digest}.png", blobs.get(digest), "image/png")},
+                data=dict(meta, blob=digest), headers=headers, timeout=10
+            )
+            return f"upload {r.status_code}"
+        return f"known {r.status_code}"
 
-    log.info("UML request: abstract len=%d, instr len=%d",
-             len(abstract), len(instructions))
+async def push_diagram_async(build_id, dtype, desc, index, digest):
+    meta = {"build_id": build_id, "diagramType": dtype, "description": desc, "index": index}
+    with stage("ingest"):
+        if DIAGRAM_HANDOFF == "reference":
+            await offload(blobs.record, build_id, digest, diagramType=dtype, description=desc, index=index)
+            return "reference"
+        headers = trace_headers(build_id)
+        r = await client().post(f"{DOCBUILDER_URL}/ingest-diagram", data=dict(meta, blob=digest),
+                                headers=headers, timeout=10)
+        if r.status_code == 404:
+            r = await client().post(
+                f"{DOCBUILDER_URL}/ingest-diagram",
+                files={"image": (f"{digest}.png", await offload(blobs.get, digest), "image/png")},
+                data=dict(meta, blob=digest), headers=headers, timeout=10
+            )
+            return f"upload {r.status_code}"
+        return f"known {r.status_code}"
 
-    # Phase 1: list diagram types
-    prompt_list = (
+# ── Prompts and parsing, shared by the threaded and the async handlers ──
+def list_prompt(abstract):
+    return (
         "You are a UML expert. From this description, list ALL useful UML "
         "diagram types and a one-line description each, in format:\n"
         "- Type: desc\n\n"
         f"System description:\n{abstract}"
     )
-    try:
-        resp = model.generate_content(prompt_list)
-        list_text = resp.text.strip()
-    except Exception as e:
-        log.error("Phase 1 error: %s", e)
-        return jsonify({"error": "diagram-list-failed"}), 500
 
+def parse_specs(list_text):
     specs = []
     for line in list_text.splitlines():
         m = re.match(r"[-*]\s*(.+?):\s*(.+)$", line)
         if m:
             specs.append((m.group(1).strip(), m.group(2).strip()))
-    if not specs:
-        log.warning("No diagram specs parsed")
-        return jsonify({"error": "no-diagrams"}), 400
+    return specs
+
+def diagram_prompt(dtype, desc):
+    return (
+        f"You are a PlantUML syntax expert. Output a fenced ```plantuml``` block "
+        f"for a {dtype} diagram:\n{desc}\nOnly the fenced block."
+    )
 
-    diagrams = []
+def plantuml_blocks(text):
+    return re.findall(r"```plantuml\s*(.*?)```", text, re.DOTALL)
 
-    # Phase 2: generate each diagram
-    for idx, (dtype, desc) in enumerate(specs, start=1):
-        # clean dtype for filenames
-        dtype_clean = re.sub(r"[^0-9A-Za-z _-]", "", dtype).strip().replace(" ", "_")
-        log.info("Generating diagram [%d/%d]: %s", idx, len(specs), dtype_clean)
+def batch_prompt(numbered, failures=None):
+    """numbered: [(number, (type, desc))]; failures {number: reason} makes it a follow-up batch."""
+    specs = "\n".join(f"{n}. {dtype}: {desc}" + (f" (previous attempt: {failures[n]})" if failures else "")
+                      for n, (dtype, desc) in numbered)
+    return (
+        "You are a PlantUML syntax expert writing several diagrams at once. For EACH numbered "
+        "diagram below, output a heading line `### <number>. <type>` followed by one fenced "
+        "```plantuml``` block, in the same order, and nothing else.\n"
+        + ("Your previous answer had no usable block for these; write them again in valid PlantUML.\n"
+           if failures else "")
+        + f"\n{specs}"
+    )
 
-        prompt_uml = (
-            f"You are a PlantUML syntax expert. Output a fenced ```plantuml``` block "
-            f"for a {dtype} diagram:\n{desc}\nOnly the fenced block."
-        )
-        try:
-            uml_resp = model.generate_content(prompt_uml).text or ""
-        except Exception as e:
-            log.error("Phase 2 error for %s: %s", dtype_clean, e)
-            continue
+def parse_batch(text):
+    """-> {spec number: [PlantUML sources]} of a batched response"""
+    parts = re.split(r"^#{1,6}\s*\**\s*(\d+)[.):]", text, flags=re.M)
+    blocks = {}
+    for number, body in zip(parts[1::2], parts[2::2]):
+        found = [b for b in plantuml_blocks(body) if b.strip()]
+        if found:
+            blocks.setdefault(int(number), []).extend(found)
+    return blocks
 
-        for j, uml in enumerate(re.findall(r"```plantuml\s*(.*?)```", uml_resp, re.DOTALL), start=1):
-            encoded = plantuml_encode(uml)
-            url     = f"{PLANTUML_SERVER}/{encoded}"
+def batch_failures(pending, results):
+    """{number: reason} of the specs in this round that produced no diagram"""
+    return {n: " ".join(results[n][1].get("error", "no diagram block in the response").split())
+            for n, _ in pending if not results[n][0]}
+
+def worker_count(payload, specs):
+    try:
+        workers = int(payload.get("workers", UML_WORKERS))
+    except (TypeError, ValueError):
+        workers = UML_WORKERS
+    return max(1, min(workers, UML_MAX_WORKERS, len(specs)))
+
+# ── Phase 2 worker: one spec → model call, render, store, hand off ──
+# Plain helpers shared by the threaded and the async worker; only the waits differ
+def clean_type(dtype):
+    # clean dtype for filenames
+    return re.sub(r"[^0-9A-Za-z _-]", "", dtype).strip().replace(" ", "_")
+
+def new_timing(idx, dtype_clean):
+    return {"diagramType": dtype_clean, "spec": idx,
+            "model": 0.0, "render": 0.0, "ingest": 0.0, "status": "ok"}
+
+def diagram_entry(dtype_clean, desc, index, digest):
+    return {
+        "diagramType": dtype_clean,
+        "description": desc,
+        "index":       index,
+        "blob":        digest,
+        "path_local":  blobs.path(digest)
+    }
+
+def finish_timing(timing, diagrams, started):
+    if not diagrams and timing["status"] == "ok":
+        timing["status"] = "no-image"
+    timing["diagrams"] = len(diagrams)
+    timing["total"]    = round(time.time() - started, 3)
+    return diagrams, timing
+
+def generate_diagram(idx, total, dtype, desc, build_id, blocks=None):
+    """blocks: the spec's PlantUML sources when a batched call already produced them"""
+    started = time.time()
+    dtype_clean = clean_type(dtype)
+    timing, diagrams = new_timing(idx, dtype_clean), []
+    log.info("Generating diagram [%d/%d]: %s", idx, total, dtype_clean)
+
+    try:
+        if blocks is None:
+            t0 = time.time()
             try:
-                img_r = requests.get(url, timeout=15)
-                if img_r.status_code!=200 or "image" not in img_r.headers.get("Content-Type",""):
-                    log.warning("Bad image for %s #%d", dtype_clean, j)
-                    continue
+                uml_resp = cached_generate(model, diagram_prompt(dtype, desc), UML_PRIORITY)
             except Exception as e:
-                log.warning("Fetch error for %s #%d: %s", dtype_clean, j, e)
+                log.error("Phase 2 error for %s: %s", dtype_clean, e)
+                timing["status"] = "model-failed"
+                uml_resp = ""
+            finally:
+                timing["model"] = round(time.time() - t0, 3)
+            blocks = plantuml_blocks(uml_resp)
+
+        for j, uml in enumerate(blocks, start=1):
+            encoded = plantuml_encode(uml)
+            t0 = time.time()
+            try:
+                png = renderer.render(uml, encoded)
+            except RenderError as e:
+                log.warning("Render error for %s #%d: %s", dtype_clean, j, e)
+                timing["error"] = str(e)[:200]
                 continue
+            finally:
+                timing["render"] += round(time.time() - t0, 3)
 
-            # save file
-            filename = f"{dtype_clean}_{j}.png"
-            filepath = os.path.join(EXPORT_STATIC, filename)
+            # store once by content; identical diagrams across builds share one file
             try:
-                with open(filepath,'wb') as f:
-                    f.write(img_r.content)
-                log.info("Saved image: %s", filepath)
+                digest = blobs.put(png)
+                log.info("Stored image %s #%d: %s", dtype_clean, j, digest[:12])
             except Exception as e:
-                log.error("Save failed %s: %s", filepath, e)
+                log.error("Store failed %s #%d: %s", dtype_clean, j, e)
                 continue
 
-            # ingest to DocBuilder
+            # hand off to DocBuilder
+            t0 = time.time()
             try:
-                r = requests.post(
-                    f"{DOCBUILDER_URL}/ingest-diagram",
-                    files={"image": (filename, img_r.content, "image/png")},
-                    data={
-                        "build_id":    payload.get("build_id","default"),
-                        "diagramType": dtype_clean,
-                        "description": desc,
-                        "index":       j
-                    }, timeout=10
-                )
-                log.info("Ingest %s #%d → %s", dtype_clean, j, r.status_code)
+                log.info("Ingest %s #%d → %s", dtype_clean, j, push_diagram(build_id, dtype_clean, desc, j, digest))
             except Exception as e:
                 log.error("Push error for %s #%d: %s", dtype_clean, j, e)
+            finally:
+                timing["ingest"] += round(time.time() - t0, 3)
+
+            diagrams.append(diagram_entry(dtype_clean, desc, j, digest))
+    except Exception as e:
+        # isolate unexpected failures to this spec so siblings still complete
+        log.exception("Diagram %s failed: %s", dtype_clean, e)
+        timing["status"] = "failed"
+
+    return finish_timing(timing, diagrams, started)
+
+
+# ── Coalescing: identical requests in flight share one run ──
+flights = Singleflight("generate-uml-image")
+
+def flight_key(abstract, instructions):
+    return request_key(abstract=abstract, instructions=instructions)
+
+def rehome(body, build_id):
+    """The diagrams of a shared run, also handed to this request's build (known digests: no upload)."""
+    for d in body.get("diagrams", []):
+        try:
+            push_diagram(build_id, d["diagramType"], d["description"], d["index"], d["blob"])
+        except Exception as e:
+            log.error("Push error for %s #%d: %s", d["diagramType"], d["index"], e)
+
+def read_payload(payload):
+    """-> (abstract, instructions, build_id) of a /generate-uml-image body"""
+    abstract     = payload.get("abstract", "").strip()
+    instructions = payload.get("instructions", "").strip()
+    log.info("UML request: abstract len=%d, instr len=%d", len(abstract), len(instructions))
+    return abstract, instructions, payload.get("build_id", "default")
+
+def coalesced(body, status, shared):
+    return (dict(body, coalesced=shared) if status == 200 else body), status
+
+
+@app.route("/generate-uml-image", methods=["POST"])
+def generate_uml_image():
+    start = time.time()
+    payload = request.get_json(force=True) or {}
+    abstract, instructions, build_id = read_payload(payload)
+
+    (body, status), shared = flights.call(flight_key(abstract, instructions), run_uml, payload, abstract, start)
+    if status == 200 and shared and body.get("build_id") != build_id:
+        rehome(body, build_id)
+    body, status = coalesced(body, status, shared)
+    return jsonify(body), status
+
+def plan_specs(payload, list_text):
+    """Phase 1 result -> (specs, workers, build_id), or (None, (error, status))"""
+    specs = parse_specs(list_text)
+    if not specs:
+        log.warning("No diagram specs parsed")
+        return None, ({"error": "no-diagrams"}, 400)
+    return (specs, worker_count(payload, specs), payload.get("build_id", "default")), None
+
+def run_uml(payload, abstract, start):
+    # Phase 1: list diagram types
+    try:
+        list_text = cached_generate(model, list_prompt(abstract), UML_PRIORITY).strip()
+    except Exception as e:
+        log.error("Phase 1 error: %s", e)
+        return {"error": "diagram-list-failed"}, 500
+    plan, error = plan_specs(payload, list_text)
+    if error:
+        return error
+    specs, workers, build_id = plan
+
+    # Phase 2: generate diagrams on a bounded worker pool
+    if UML_MODE == "batched":
+        log.info("Phase 2: %d diagram specs in one batch, rendered on %d worker(s)", len(specs), workers)
+        return uml_response(run_batches(specs, workers, build_id), workers, start, build_id), 200
+    log.info("Phase 2: %d diagram specs on %d worker(s)", len(specs), workers)
+
+    jobs = [(idx, len(specs), dtype, desc, build_id)
+            for idx, (dtype, desc) in enumerate(specs, start=1)]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="uml") as pool:
+        # map() yields in submission order, so output order matches the spec list
+        results = list(pool.map(carry(lambda job: generate_diagram(*job)), jobs))
+
+    return uml_response(results, workers, start, build_id), 200
+
+def batch_blocks(text_or_error, batch):
+    if isinstance(text_or_error, Exception):
+        log.error("Batch %d error: %s", batch, text_or_error)
+        return {}
+    return parse_batch(text_or_error)
 
-            diagrams.append({
-                "diagramType": dtype_clean,
-                "description": desc,
-                "index":       j,
-                "path_local":  filepath
-            })
+def record_batch(batch, seconds, pending, done, results):
+    """Files one round's results -> the specs still without a diagram, and their failures"""
+    for (n, _), result in zip(pending, done):
+        result[1].update(model=seconds, batch=batch)
+        results[n] = result
+    failures = batch_failures(pending, results)
+    still = [(n, spec) for n, spec in pending if n in failures]
+    if still:
+        log.info("Batch %d: %d of %d specs without a diagram", batch, len(still), len(pending))
+    return still, failures
+
+def run_batches(specs, workers, build_id):
+    """Phase 2 in UML_MODE=batched: one model call for every spec, then follow-up calls
+    for the specs whose block was missing or did not render -> results in spec order."""
+    numbered = list(enumerate(specs, start=1))
+    pending, failures, results = numbered, None, {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="uml") as pool:
+        for batch in range(1, UML_BATCH_RETRIES + 2):
+            t0 = time.time()
+            try:
+                text = cached_generate(model, batch_prompt(pending, failures), UML_PRIORITY)
+            except Exception as e:
+                text = e
+            blocks, seconds = batch_blocks(text, batch), round(time.time() - t0, 3)
+            jobs = [(n, len(specs), dtype, desc, build_id, blocks.get(n, [])) for n, (dtype, desc) in pending]
+            done = pool.map(carry(lambda job: generate_diagram(*job)), jobs)
+            pending, failures = record_batch(batch, seconds, pending, done, results)
+            if not pending:
+                break
+    return [results[n] for n, _ in numbered]
+
+def uml_response(results, workers, start, build_id):
+    diagrams, timings = [], []
+    for spec_diagrams, timing in results:
+        diagrams.extend(spec_diagrams)
+        timings.append(timing)
 
     duration = time.time()-start
     log.info("UML complete: %d diagrams in %.2fs", len(diagrams), duration)
-    return jsonify({
+    return {
         "status":   "completed",
+        "build_id": build_id,
         "diagrams": diagrams,
+        "timings":  timings,
+        "workers":  workers,
+        "render":   renderer.stats(),
+        "blobs":    blobs.stats(),
+        "llm_cache": cache_stats(),
+        "gemini":   scheduler.stats(),
+        "singleflight": flights.stats(),
         "duration": round(duration,2)
-    }), 200
+    }
+
+
+# ── ASGI mode: the same steps as awaits, so waiting on Gemini and PlantUML holds no thread ──
+async def generate_diagram_async(idx, total, dtype, desc, build_id, blocks=None):
+    started = time.time()
+    dtype_clean = clean_type(dtype)
+    timing, diagrams = new_timing(idx, dtype_clean), []
+    log.info("Generating diagram [%d/%d]: %s", idx, total, dtype_clean)
+
+    try:
+        if blocks is None:
+            t0 = time.time()
+            try:
+                uml_resp = await cached_generate_async(model, diagram_prompt(dtype, desc), UML_PRIORITY)
+            except Exception as e:
+                log.error("Phase 2 error for %s: %s", dtype_clean, e)
+                timing["status"] = "model-failed"
+                uml_resp = ""
+            finally:
+                timing["model"] = round(time.time() - t0, 3)
+            blocks = plantuml_blocks(uml_resp)
+
+        for j, uml in enumerate(blocks, start=1):
+            t0 = time.time()
+            try:
+                png = await renderer.render_async(uml, plantuml_encode(uml))
+            except RenderError as e:
+                log.warning("Render error for %s #%d: %s", dtype_clean, j, e)
+                timing["error"] = str(e)[:200]
+                continue
+            finally:
+                timing["render"] += round(time.time() - t0, 3)
+
+            try:
+                digest = await offload(blobs.put, png)
+                log.info("Stored image %s #%d: %s", dtype_clean, j, digest[:12])
+            except Exception as e:
+                log.error("Store failed %s #%d: %s", dtype_clean, j, e)
+                continue
+
+            t0 = time.time()
+            try:
+                outcome = await push_diagram_async(build_id, dtype_clean, desc, j, digest)
+                log.info("Ingest %s #%d → %s", dtype_clean, j, outcome)
+            except Exception as e:
+                log.error("Push error for %s #%d: %s", dtype_clean, j, e)
+            finally:
+                timing["ingest"] += round(time.time() - t0, 3)
+
+            diagrams.append(diagram_entry(dtype_clean, desc, j, digest))
+    except Exception as e:
+        log.exception("Diagram %s failed: %s", dtype_clean, e)
+        timing["status"] = "failed"
+
+    return finish_timing(timing, diagrams, started)
+
+
+async def rehome_async(body, build_id):
+    async def push(d):
+        try:
+            await push_diagram_async(build_id, d["diagramType"], d["description"], d["index"], d["blob"])
+        except Exception as e:
+            log.error("Push error for %s #%d: %s", d["diagramType"], d["index"], e)
+    await asyncio.gather(*(push(d) for d in body.get("diagrams", [])))
+
+
+async def generate_uml_image_async(req):
+    start = time.time()
+    payload = await json_body(req) or {}
+    abstract, instructions, build_id = read_payload(payload)
+
+    (body, status), shared = await flights.call_async(flight_key(abstract, instructions),
+                                                      run_uml_async, payload, abstract, start)
+    if status == 200 and shared and body.get("build_id") != build_id:
+        await rehome_async(body, build_id)
+    return json_response(*coalesced(body, status, shared))
+
+
+def bounded(workers, coro_fn):
+    """coro_fn with at most `workers` calls in flight, like a pool of that size"""
+    gate = asyncio.Semaphore(workers)
+
+    async def call(*args):
+        async with gate:
+            return await coro_fn(*args)
+    return call
+
+
+async def run_uml_async(payload, abstract, start):
+    try:
+        list_text = (await cached_generate_async(model, list_prompt(abstract), UML_PRIORITY)).strip()
+    except Exception as e:
+        log.error("Phase 1 error: %s", e)
+        return {"error": "diagram-list-failed"}, 500
+    plan, error = plan_specs(payload, list_text)
+    if error:
+        return error
+    specs, workers, build_id = plan
+
+    if UML_MODE == "batched":
+        log.info("Phase 2: %d diagram specs in one batch, %d rendered at a time", len(specs), workers)
+        return uml_response(await run_batches_async(specs, workers, build_id), workers, start, build_id), 200
+    log.info("Phase 2: %d diagram specs, %d at a time", len(specs), workers)
+
+    # gather() keeps submission order, so output order matches the spec list
+    generate = bounded(workers, generate_diagram_async)
+    results = await asyncio.gather(*(generate(idx, len(specs), dtype, desc, build_id)
+                                     for idx, (dtype, desc) in enumerate(specs, start=1)))
+    return uml_response(results, workers, start, build_id), 200
+
+
+async def run_batches_async(specs, workers, build_id):
+    numbered = list(enumerate(specs, start=1))
+    pending, failures, results = numbered, None, {}
+    generate = bounded(workers, generate_diagram_async)
+    for batch in range(1, UML_BATCH_RETRIES + 2):
+        t0 = time.time()
+        try:
+            text = await cached_generate_async(model, batch_prompt(pending, failures), UML_PRIORITY)
+        except Exception as e:
+            text = e
+        blocks, seconds = batch_blocks(text, batch), round(time.time() - t0, 3)
+        done = await asyncio.gather(*(generate(n, len(specs), dtype, desc, build_id, blocks.get(n, []))
+                                      for n, (dtype, desc) in pending))
+        pending, failures = record_batch(batch, seconds, pending, done, results)
+        if not pending:
+            break
+    return [results[n] for n, _ in numbered]
+
+
+asgi = AsgiApp(app, {("POST", "/generate-uml-image"): generate_uml_image_async})
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5001, debug=True)
+    if SERVER_MODE == "asgi":
+        serve(asgi, PORT)
+    else:
+        app.run(host="0.0.0.0", port=PORT, debug=True)
@@ -0,0 +1,420 @@
+# End-to-end load benchmark: the three services against the fakes.py stand-ins
+#
+#   python benchmarks/bench_e2e.py [--scenarios generate-doc,generate-uml-image,build-document]
+#                                  [--concurrency 1,2,4,8] [--requests 16] [--out report.json]
+#                                  [--check benchmarks/thresholds.json]
+#                                  [--baseline previous.json --tolerance 0.25]
+#
+# Each service runs in its own process, as deployed (--server wsgi|asgi), from a scratch directory so caches
+# and exports start empty. Payloads are derived from (scenario, concurrency, request #),
+# so every request is a cache miss and repeated runs send the same traffic.
+#
+# Per scenario and concurrency level it reports p50/p95/p99 latency, throughput, errors,
+# peak RSS of each service (process tree, from /proc; reset per level where the kernel
+# allows it) and, for /build-document, the size and on-demand render time of each format.
+#
+# --check compares against absolute limits; --baseline against an earlier --out report.
+# Either exits 1 on a regression, so the run can gate a deploy.
+import os
+import sys
+import signal
+import json
+import math
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import serve_gemini, serve_plantuml      # noqa: E402
+from bench_encoder import synthetic_diagram         # noqa: E402
+
+SERVICE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+FORMATS     = ("docx", "pdf", "pptx")
+LAUNCH      = {
+    "wsgi": ("import sys; sys.path.insert(0, {path!r}); import {module} as m; "
+             "m.app.run(host='127.0.0.1', port={port}, threaded=True)"),
+    "asgi": ("import sys; sys.path.insert(0, {path!r}); import {module} as m; import uvicorn; "
+             "uvicorn.run(m.asgi, host='127.0.0.1', port={port}, log_level='warning')"),
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ── Services ──
+class Service:
+    def __init__(self, name, module, port, workdir, env, server="wsgi"):
+        self.name = name
+        self.port = port
+        self.url  = f"http://127.0.0.1:{self.port}"
+        self.log_path = os.path.join(workdir, f"{name}.log")
+        self._log = open(self.log_path, "wb")
+        self.proc = subprocess.Popen(
+            [sys.executable, "-c", LAUNCH[server].format(path=SERVICE_DIR, module=module, port=self.port)],
+            cwd=workdir, env=env, stdout=self._log, stderr=subprocess.STDOUT
+        )
+
+    def wait_ready(self, timeout=60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                break
+            try:
+                if requests.get(self.url + "/metrics", timeout=1).status_code == 200:
+                    return self
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        with open(self.log_path, "rb") as f:
+            tail = f.read()[-2000:].decode("utf-8", "replace")
+        raise RuntimeError(f"{self.name} did not start:\n{tail}")
+
+    def pids(self):
+        # the service and its descendants (export worker processes, analyzer pool, ...)
+        pids, todo = [], [self.proc.pid]
+        while todo:
+            pid = todo.pop()
+            pids.append(pid)
+            try:
+                for tid in os.listdir(f"/proc/{pid}/task"):
+                    with open(f"/proc/{pid}/task/{tid}/children") as f:
+                        todo.extend(int(c) for c in f.read().split())
+            except OSError:
+                pass
+        return pids
+
+    def reset_peak(self):
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/clear_refs", "w") as f:
+                    f.write("5")
+            except OSError:
+                pass
+
+    def peak_rss_mb(self):
+        """Sum of VmHWM over the process tree (an upper bound on the tree's peak), or None."""
+        total, seen = 0, False
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmHWM:"):
+                            total += int(line.split()[1])
+                            seen = True
+            except OSError:
+                pass
+        return round(total / 1024, 1) if seen else None
+
+    def stop(self):
+        # pool workers outlive a terminated parent; left behind, they pile up over runs
+        children = self.pids()[1:]
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self._log.close()
+
+
+def start_services(workdir, gemini, plantuml, args):
+    ports = {name: free_port() for name in ("aiagent", "uml", "docbuilder")}
+    env = dict(
+        os.environ,
+        PYTHONUNBUFFERED      = "1",
+        GEMINI_API_KEY        = "benchmark",
+        GEMINI_ENDPOINT       = gemini.url,
+        PLANTUML_BACKEND      = "local",
+        PLANTUML_LOCAL_SERVER = plantuml.url + "/png",
+        BLOB_DIR              = os.path.join(workdir, "blobs"),
+        EXPORT_DIR            = os.path.join(workdir, "exports"),
+        REPORT_MODE           = args.report_mode,
+        DIAGRAM_HANDOFF       = args.handoff,
+        UML_MODE              = args.uml_mode,
+    )
+    # the services find each other through the same env the deployment uses
+    env.update(PARENT_AGENT_URL=f"http://127.0.0.1:{ports['aiagent']}",
+               UML_AGENT_URL=f"http://127.0.0.1:{ports['uml']}",
+               DOCBUILDER_URL=f"http://127.0.0.1:{ports['docbuilder']}")
+    return {name: Service(name, module, ports[name], workdir, env, args.server)
+            for name, module in (("aiagent", "AiAgent"), ("uml", "Uml"), ("docbuilder", "Docbuilder"))}
+
+
+# ── Scenarios ──
+def source_code(i, kb):
+    # a Python module of about `kb` KiB that parses, so /generate-doc accepts it
+    lines, size, n = [f'"""Benchmark module {i}."""', "import os", ""], 0, 0
+    while size < kb * 1024:
+        n += 1
+        block = (f"class Worker{i}_{n}:\n    def run_{n}(self, value):\n"
+                 f"        return os.path.join(str(value), 'step_{n}')\n")
+        lines.append(block)
+        size += len(block)
+    return "\n".join(lines)
+
+
+def payload(scenario, level, i, args):
+    tag = f"{scenario}-c{level}-r{i}"
+    return {
+        "code":             source_code(i, args.code_kb),
+        "extension":        ".py",
+        "project_info":     f"Benchmark project {tag}",
+        "instructions":     f"Benchmark report {tag}\n1. Introduction\n2. Architecture\n3. Evaluation",
+        "pages":            args.pages,
+        "return_format":    "markdown",
+        "abstract":         f"A document generation pipeline ({tag}) with an LLM, a diagram "
+                            f"renderer and an exporter. {synthetic_diagram(400, i)}",
+        "uml_instructions": "Class and sequence diagrams",
+        "build_id":         f"bench-{tag}",
+        "format":           "docx",
+    }
+
+
+def call(services, scenario, body):
+    if scenario == "generate-doc":
+        r = requests.post(services["aiagent"].url + "/generate-doc", json=body, timeout=600)
+    elif scenario == "generate-uml-image":
+        r = requests.post(services["uml"].url + "/generate-uml-image", json=body, timeout=600)
+    else:
+        r = requests.post(services["docbuilder"].url + "/build-document", json=body, timeout=900)
+    return r
+
+
+def artifact_sizes(services, build_id):
+    sizes, seconds = {}, {}
+    for fmt in FORMATS:
+        t0 = time.perf_counter()
+        r = requests.get(f"{services['docbuilder'].url}/download/{fmt}/{build_id}.{fmt}", timeout=600)
+        seconds[fmt] = round(time.perf_counter() - t0, 3)
+        sizes[fmt] = len(r.content) if r.status_code == 200 else None
+    return sizes, seconds
+
+
+def diagram_count(body):
+    return body.get("diagrams_count", len(body.get("diagrams", [])))
+
+
+def percentile(values, p):
+    # nearest-rank
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)], 3)
+
+
+def run_level(services, scenario, level, args):
+    for service in services.values():
+        service.reset_peak()
+
+    def one(i):
+        t0 = time.perf_counter()
+        try:
+            r = call(services, scenario, payload(scenario, level, i, args))
+            ok = r.status_code == 200
+            body = r.json() if ok and r.headers.get("Content-Type", "").startswith("application/json") else {}
+            return ok, time.perf_counter() - t0, len(r.content), body
+        except requests.RequestException:
+            return False, time.perf_counter() - t0, 0, {}
+
+    n = max(args.requests, level)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=level) as pool:
+        results = list(pool.map(one, range(n)))
+    wall = time.perf_counter() - started
+
+    latencies = [seconds for ok, seconds, _, _ in results if ok]
+    errors = sum(1 for ok, *_ in results if not ok)
+    row = {
+        "concurrency":    level,
+        "requests":       n,
+        "errors":         errors,
+        "error_rate":     round(errors / n, 4),
+        "throughput_rps": round(len(latencies) / wall, 3),
+        "p50_s":          percentile(latencies, 50),
+        "p95_s":          percentile(latencies, 95),
+        "p99_s":          percentile(latencies, 99),
+        "mean_s":         round(sum(latencies) / len(latencies), 3) if latencies else None,
+        "max_s":          round(max(latencies), 3) if latencies else None,
+        "response_bytes": round(sum(size for ok, _, size, _ in results if ok) / max(1, len(latencies))),
+        # diagrams per successful response; drops below --diagrams when model or render calls fail
+        "diagrams_mean":  round(sum(diagram_count(body) for ok, _, _, body in results if ok)
+                                / max(1, len(latencies)), 2) if scenario != "generate-doc" else None,
+        "rss_mb":         {name: service.peak_rss_mb() for name, service in services.items()},
+    }
+    if scenario == "build-document":
+        built = next((body["build_id"] for ok, _, _, body in results if ok and body.get("build_id")), None)
+        if built:
+            row["artifact_bytes"], row["download_s"] = artifact_sizes(services, built)
+    return row
+
+
+# ── Checks ──
+def lookup(row, metric):
+    value = row
+    for part in metric.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def check_thresholds(report, thresholds):
+    failures = []
+    for key, expected in thresholds.get("profile", {}).items():
+        if report["fakes"].get(key) != expected:
+            print(f"warning: thresholds calibrated with {key}={expected}, this run used {report['fakes'].get(key)}")
+    for scenario, levels in thresholds.get("scenarios", {}).items():
+        for row in report["scenarios"].get(scenario, []):
+            limits = dict(levels.get("*", {}), **levels.get(str(row["concurrency"]), {}))
+            for name, limit in limits.items():
+                bound, metric = name.split("_", 1)
+                value = lookup(row, metric)
+                if value is None:
+                    continue
+                if (bound == "max" and value > limit) or (bound == "min" and value < limit):
+                    failures.append(f"{scenario} c={row['concurrency']}: {metric} {value} violates {name} {limit}")
+    return failures
+
+
+def check_baseline(report, baseline, tolerance):
+    failures = []
+    for scenario, rows in report["scenarios"].items():
+        before = {row["concurrency"]: row for row in baseline.get("scenarios", {}).get(scenario, [])}
+        for row in rows:
+            old = before.get(row["concurrency"])
+            if not old:
+                continue
+            where = f"{scenario} c={row['concurrency']}"
+            for metric in ("p50_s", "p95_s", "p99_s"):
+                if old.get(metric) and row.get(metric) and row[metric] > old[metric] * (1 + tolerance):
+                    failures.append(f"{where}: {metric} {old[metric]} -> {row[metric]}")
+            if old.get("throughput_rps") and row["throughput_rps"] < old["throughput_rps"] / (1 + tolerance):
+                failures.append(f"{where}: throughput_rps {old['throughput_rps']} -> {row['throughput_rps']}")
+            for name, mb in row["rss_mb"].items():
+                was = old.get("rss_mb", {}).get(name)
+                if was and mb and mb > was * (1 + tolerance):
+                    failures.append(f"{where}: rss_mb.{name} {was} -> {mb}")
+            if row.get("error_rate", 0) > old.get("error_rate", 0):
+                failures.append(f"{where}: error_rate {old.get('error_rate', 0)} -> {row['error_rate']}")
+    return failures
+
+
+def print_table(report):
+    print(f"{'scenario':<20} {'conc':>4} {'reqs':>5} {'err':>4} {'rps':>7} {'p50':>7} {'p95':>7} {'p99':>7}"
+          f"  rss MB aiagent/uml/docbuilder")
+    for scenario, rows in report["scenarios"].items():
+        for row in rows:
+            rss = "/".join(str(row["rss_mb"].get(name)) for name in ("aiagent", "uml", "docbuilder"))
+            fmt = lambda v: f"{v:>7.3f}" if v is not None else f"{'-':>7}"
+            print(f"{scenario:<20} {row['concurrency']:>4} {row['requests']:>5} {row['errors']:>4} "
+                  f"{row['throughput_rps']:>7.2f} {fmt(row['p50_s'])} {fmt(row['p95_s'])} {fmt(row['p99_s'])}  {rss}")
+            if row.get("artifact_bytes"):
+                sizes = ", ".join(f"{k} {v or 0:,} B in {row['download_s'][k]:.2f}s"
+                                  for k, v in row["artifact_bytes"].items())
+                print(f"{'':<20} artifacts: {sizes}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scenarios", default="generate-doc,generate-uml-image,build-document")
+    ap.add_argument("--concurrency", default="1,2,4,8")
+    ap.add_argument("--requests", type=int, default=16, help="requests per level (at least the concurrency)")
+    ap.add_argument("--pages", type=int, default=8, help="report length the fake model produces")
+    ap.add_argument("--code-kb", type=int, default=8, help="size of the source sent per request")
+    ap.add_argument("--gemini-latency", type=float, default=0.5)
+    ap.add_argument("--chars-per-sec", type=float, default=20000)
+    ap.add_argument("--diagrams", type=int, default=4)
+    ap.add_argument("--plantuml-latency", type=float, default=0.1)
+    ap.add_argument("--png-size", default="1600x1200")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="share of model calls answered with 429")
+    ap.add_argument("--rpm-quota", type=int, default=0, help="fake Gemini answers 429 beyond this many calls/min")
+    ap.add_argument("--report-mode", default="single", choices=("single", "sections"))
+    ap.add_argument("--handoff", default="upload", choices=("upload", "reference"))
+    ap.add_argument("--uml-mode", default="per-type", choices=("per-type", "batched"))
+    ap.add_argument("--batch-miss", type=float, default=0.0, help="share of diagrams a batched answer leaves out")
+    ap.add_argument("--server", default="wsgi", choices=("wsgi", "asgi"),
+                    help="Flask's threaded server, or uvicorn with the services' async routes")
+    ap.add_argument("--out", help="write the JSON report here")
+    ap.add_argument("--check", help="thresholds JSON; exit 1 when a limit is violated")
+    ap.add_argument("--baseline", help="earlier --out report; exit 1 on a regression beyond --tolerance")
+    ap.add_argument("--tolerance", type=float, default=0.25)
+    ap.add_argument("--keep", action="store_true", help="keep the scratch directory (service logs, exports)")
+    args = ap.parse_args()
+
+    width, height = map(int, args.png_size.split("x"))
+    gemini = serve_gemini(latency=args.gemini_latency, chars_per_sec=args.chars_per_sec, pages=args.pages,
+                          diagrams=args.diagrams, error_rate=args.error_rate, rpm_quota=args.rpm_quota,
+                          batch_miss=args.batch_miss)
+    plantuml = serve_plantuml(latency=args.plantuml_latency, width=width, height=height)
+    workdir = tempfile.mkdtemp(prefix="docuagent-bench-")
+    services = {}
+    report = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host":    {"python": platform.python_version(), "platform": platform.platform(),
+                    "cpus": os.cpu_count()},
+        "fakes":   {"gemini_latency": args.gemini_latency, "chars_per_sec": args.chars_per_sec,
+                    "pages": args.pages, "diagrams": args.diagrams, "code_kb": args.code_kb,
+                    "plantuml_latency": args.plantuml_latency, "png_size": args.png_size,
+                    "error_rate": args.error_rate, "rpm_quota": args.rpm_quota,
+                    "report_mode": args.report_mode, "handoff": args.handoff, "server": args.server,
+                    "uml_mode": args.uml_mode, "batch_miss": args.batch_miss},
+        "scenarios": {},
+    }
+    try:
+        services = start_services(workdir, gemini, plantuml, args)
+        for service in services.values():
+            service.wait_ready()
+        for scenario in args.scenarios.split(","):
+            report["scenarios"][scenario] = []
+            for level in map(int, args.concurrency.split(",")):
+                calls = gemini.stats()["calls"]
+                row = run_level(services, scenario, level, args)
+                row["gemini_calls"] = round((gemini.stats()["calls"] - calls) / row["requests"], 2)
+                report["scenarios"][scenario].append(row)
+                print(f"{scenario} c={level}: p95 {row['p95_s']}s, {row['throughput_rps']} req/s, "
+                      f"{row['errors']} error(s)", flush=True)
+        report["upstream"] = {"gemini": gemini.stats(), "plantuml": plantuml.stats()}
+    finally:
+        for service in services.values():
+            service.stop()
+        gemini.shutdown()
+        plantuml.shutdown()
+        if args.keep:
+            print(f"scratch directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print_table(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+
+    failures = []
+    if args.check:
+        with open(args.check, encoding="utf-8") as f:
+            failures += check_thresholds(report, json.load(f))
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            failures += check_baseline(report, json.load(f), args.tolerance)
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    if args.check or args.baseline:
+        print("FAIL" if failures else "PASS")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Encoder micro-benchmark: Encoder.plantuml_encode vs the original per-byte loop
+#
+#   python benchmarks/bench_encoder.py [--repeat N] [--sizes 1024,65536,...]
+import os
+import sys
+import time
+import zlib
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from Encoder import plantuml_encode, plantuml_decode  # noqa: E402
+
+
+# The implementation Uml.py shipped with, kept here as the baseline.
+def legacy_encode(text: str) -> str:
+    data = zlib.compress(text.encode("utf-8"))[2:-4]
+    alphabet = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-_"
+    out = ""
+    for i in range(0, len(data), 3):
+        chunk = data[i:i+3].ljust(3, b'\x00')
+        b1,b2,b3 = chunk
+        out += alphabet[b1>>2]
+        out += alphabet[((b1&0x3)<<4)|(b2>>4)]
+        out += alphabet[((b2&0xF)<<2)|(b3>>6)]
+        out += alphabet[b3&0x3F]
+    return out
+
+
+def synthetic_diagram(size, seed=0):
+    # class diagram with random identifiers so deflate can't collapse it
+    rnd = random.Random(seed)
+    word = lambda: "".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rnd.randint(4, 12)))
+    lines, total, n = ["@startuml"], 9, 0
+    while total < size:
+        n += 1
+        block = (f"class {word().title()}{n} {{\n  +{word()}: {word()}\n  -{word()}(): void\n}}\n"
+                 f"{word().title()}{n} --> {word().title()}{max(1, n - 1)} : {word()}")
+        lines.append(block)
+        total += len(block) + 1
+    lines.append("@enduml")
+    return "\n".join(lines)[:size]
+
+
+def best_of(fn, arg, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="1024,16384,131072,1048576")
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    print(f"{'size':>9} {'legacy ms':>10} {'encoder ms':>11} {'speedup':>8} {'MB/s':>8}")
+    for size in map(int, args.sizes.split(",")):
+        text = synthetic_diagram(size)
+        assert plantuml_encode(text) == legacy_encode(text)
+        assert plantuml_decode(plantuml_encode(text)) == text
+        old = best_of(legacy_encode, text, args.repeat)
+        new = best_of(plantuml_encode, text, args.repeat)
+        print(f"{size:>9} {old * 1e3:>10.2f} {new * 1e3:>11.2f} {old / new:>7.1f}x "
+              f"{size / new / 1e6:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Markdown -> DOCX micro-benchmark: MdParser + DocxEmitter vs the original DocBuilder loop
+#
+#   python benchmarks/bench_markdown.py [--pages 50,200,500]
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from docx import Document                                  # noqa: E402
+from docx.shared import Pt                                 # noqa: E402
+from docx.enum.text import WD_PARAGRAPH_ALIGNMENT          # noqa: E402
+from docx.oxml import OxmlElement                          # noqa: E402
+from docx.oxml.ns import qn                                # noqa: E402
+from MdParser import parse                                 # noqa: E402
+from DocxEmitter import DocxEmitter                        # noqa: E402
+
+
+# The loop build_document shipped with, kept here as the baseline.
+def set_shading_for_paragraph(paragraph, fill_color):
+    p_pr = paragraph._p.get_or_add_pPr()
+    shd = OxmlElement('w:shd')
+    shd.set(qn('w:val'), 'clear')
+    shd.set(qn('w:color'), 'auto')
+    shd.set(qn('w:fill'), fill_color)
+    p_pr.append(shd)
+
+
+def legacy_render(doc, raw_md):
+    is_code_block = False
+    for line in raw_md.splitlines():
+        clean_line = line.strip()
+        if '```' in clean_line:
+            is_code_block = not is_code_block
+            continue
+        if is_code_block:
+            p = doc.add_paragraph()
+            run = p.add_run(clean_line)
+            run.font.name = 'Courier New'
+            run.font.size = Pt(10)
+            set_shading_for_paragraph(p, "F1F1F1")
+            p.paragraph_format.space_after = Pt(4)
+        elif clean_line.startswith('# '):
+            doc.add_heading(clean_line[2:].strip(), level=1)
+        elif clean_line.startswith('## '):
+            doc.add_heading(clean_line[3:].strip(), level=2)
+        elif clean_line.startswith('### '):
+            doc.add_heading(clean_line[4:].strip(), level=3)
+        elif clean_line:
+            p = doc.add_paragraph(clean_line.replace('*', ''))
+            p.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
+            p.paragraph_format.space_after = Pt(8)
+
+
+def synthetic_report(pages, seed=0):
+    # roughly one page: a heading, four ~80-word paragraphs, a short code block, a few bullets
+    rnd = random.Random(seed)
+    words = ("system module request latency cache service document diagram render model "
+             "pipeline **throughput** queue *worker* `build_id` storage schema client").split()
+    para = lambda: " ".join(rnd.choice(words) for _ in range(80))
+    out = []
+    for page in range(1, pages + 1):
+        out.append(f"## {page}. Section {page}" if page % 5 else f"# Chapter {page // 5}")
+        out.extend(para() + "\n" for _ in range(4))
+        out.append("```python")
+        out.extend(f"    value_{i} = compute(value_{i - 1}, step={i})" for i in range(6))
+        out.append("```")
+        out.extend(f"- {para()[:60]}" for _ in range(3))
+    return "\n".join(out)
+
+
+def timed(fn, md):
+    doc = Document()
+    t0 = time.perf_counter()
+    fn(doc, md)
+    return time.perf_counter() - t0, len(doc.paragraphs)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pages", default="50,200,500")
+    args = ap.parse_args()
+
+    print(f"{'pages':>6} {'paragraphs':>10} {'legacy p/s':>11} {'emitter p/s':>12} {'speedup':>8}")
+    for pages in map(int, args.pages.split(",")):
+        md = synthetic_report(pages)
+        old, n_old = timed(legacy_render, md)
+        new, n_new = timed(lambda doc, text: DocxEmitter(doc).emit(parse(text.splitlines())), md)
+        print(f"{pages:>6} {n_new:>10} {n_old / old:>11.0f} {n_new / new:>12.0f} {old / new:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# Peak RSS of rendering very large reports: spooled output vs the whole document in memory
+#
+#   python benchmarks/bench_memory.py [--pages 200,800 --diagrams 40]
+#
+# Every case runs in a fresh interpreter; "peak" is ru_maxrss above the RSS once the
+# report text and diagram PNGs are built, so it is what rendering and sending cost.
+# "in-memory" sets DOCX_SPOOL_NODES=0 and a huge OUTPUT_SPOOL_MB, i.e. the lxml body tree
+# and the output file are held whole, as before. The aiagent-* cases drain the output in
+# ASGI_FILE_CHUNK blocks the way the routes send it.
+#
+# Measured on a 1-CPU box (Python 3.11), 40 diagrams of 1600x1200 (peak MB / seconds):
+#
+#   case           pages  md KB  in-memory         spooled
+#   aiagent-pdf      200    596     3.8   3.57s       3.8   3.44s
+#   aiagent-pdf      800   2386    13.6  14.66s      13.5  10.03s
+#   aiagent-docx     200    596    34.8   0.45s      14.6   0.53s
+#   aiagent-docx     800   2386   119.1   2.86s      22.4   1.77s
+#   export-docx      200    596    45.5   0.84s      23.2   0.83s
+#   export-docx      800   2386   137.4   4.59s      35.4   2.12s
+#   export-pdf       200    596    45.1   6.65s      45.2   6.51s
+#   export-pdf       800   2386    61.9  13.99s      61.8  13.97s
+#   export-pptx      200    596    16.1   1.19s      16.0   1.20s
+#   export-pptx      800   2386    46.5   5.01s      46.4   4.99s
+#
+# reportlab keeps every page's objects until it writes the file and python-pptx has no
+# streaming writer, so the pdf and pptx peaks still grow with the report.
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CASES = ("aiagent-pdf", "aiagent-docx", "export-docx", "export-pdf", "export-pptx")
+MODES = {
+    "in-memory": {"DOCX_SPOOL_NODES": "0", "OUTPUT_SPOOL_MB": "1000000"},
+    "spooled":   {},
+}
+
+
+def run_case(case, pages, diagrams, workdir):
+    """Runs in the child: render one case and report the peak above the inputs."""
+    import time
+    import resource
+
+    sys.path[:0] = [os.path.join(HERE, ".."), HERE]
+    from bench_markdown import synthetic_report
+    from fakes import diagram_png
+
+    def rss_mb():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    md = synthetic_report(pages, 1)
+    images = []
+    for n in range(diagrams):
+        path = os.path.join(workdir, f"diagram{n}.png")
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(diagram_png(f"diagram {n}"))
+        images.append(path)
+
+    import Asgi
+    import AiAgent
+    import Exporters
+    from MdParser import parse
+    from DocModel import DocModel
+
+    base = rss_mb()
+    start = time.perf_counter()
+    if case.startswith("aiagent-"):
+        render = AiAgent.generate_pdf_from_text if case == "aiagent-pdf" else AiAgent.generate_docx_from_text
+        output = render(md)
+        size = 0
+        while chunk := output.read(Asgi.ASGI_FILE_CHUNK):
+            size += len(chunk)
+        output.close()
+    else:
+        fmt = case.split("-", 1)[1]
+        model = DocModel("Benchmark report")
+        model.extend(parse(md.splitlines()))
+        for n, path in enumerate(images):
+            model.add_diagram(f"Diagram {n}", "A generated diagram.", path)
+        target = os.path.join(workdir, f"out.{fmt}")
+        Exporters.export(fmt, model, target)
+        size = os.path.getsize(target)
+    return {"peak_mb": round(rss_mb() - base, 1), "seconds": round(time.perf_counter() - start, 2),
+            "md_kb": len(md) // 1024, "out_kb": size // 1024}
+
+
+def measure(case, mode, pages, diagrams, workdir):
+    env = dict(os.environ, GEMINI_API_KEY=os.environ.get("GEMINI_API_KEY", "benchmark"), **MODES[mode])
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", case,
+                           "--pages", str(pages), "--diagrams", str(diagrams), "--workdir", workdir],
+                          cwd=workdir, env=env, capture_output=True, text=True, check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pages", default="200,800")
+    ap.add_argument("--diagrams", type=int, default=40, help="diagrams in the export-* cases")
+    ap.add_argument("--cases", default=",".join(CASES))
+    ap.add_argument("--child", help=argparse.SUPPRESS)
+    ap.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        print(json.dumps(run_case(args.child, int(args.pages), args.diagrams, args.workdir)))
+        return
+
+    # AiAgent opens its sqlite caches under ./cache, keep them out of the tree
+    with tempfile.TemporaryDirectory(prefix="bench_memory_") as workdir:
+        print(f"{'case':<14} {'pages':>5} {'md KB':>6}  " + "  ".join(f"{mode:<18}" for mode in MODES))
+        for case in args.cases.split(","):
+            for pages in map(int, args.pages.split(",")):
+                cells, md_kb = [], 0
+                for mode in MODES:
+                    r = measure(case, mode, pages, args.diagrams, workdir)
+                    md_kb = r["md_kb"]
+                    cells.append(f"{r['peak_mb']:>6.1f} MB {r['seconds']:>6.2f}s")
+                print(f"{case:<14} {pages:>5} {md_kb:>6}  " + "  ".join(f"{cell:<18}" for cell in cells),
+                      flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# Deterministic stand-ins for Gemini and PlantUML, so the services can be benchmarked offline
+#
+#   python benchmarks/fakes.py gemini   --port 8090 [--latency 0.5 --chars-per-sec 4000 --pages 8]
+#   python benchmarks/fakes.py plantuml --port 8091 [--latency 0.1 --width 1600 --height 1200]
+#
+# Point the services at them with
+#   GEMINI_ENDPOINT=http://127.0.0.1:8090
+#   PLANTUML_BACKEND=local PLANTUML_LOCAL_SERVER=http://127.0.0.1:8091/png
+#
+# Responses depend only on the request (prompt or encoded diagram) and the options,
+# so two runs with the same settings see byte-identical upstream traffic.
+import os
+import io
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_encoder import synthetic_diagram    # noqa: E402
+from bench_markdown import synthetic_report    # noqa: E402
+
+DIAGRAM_TYPES = ("Class", "Sequence", "Component", "Activity", "Use Case", "State", "Deployment", "Object")
+
+
+def _seed(text):
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 512   # the default backlog of 5 turns bursts into SYN-retry stalls
+
+    def __init__(self, port, handler, **options):
+        super().__init__(("127.0.0.1", port), handler)
+        self.options = options
+        self.calls = self.errors = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+
+    def count(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "errors": self.errors, "bytes_out": self.bytes_out}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(bytes_out=len(body))
+
+
+# ── Gemini ──
+def answer(prompt, pages=8, diagrams=4, diagram_bytes=1500, batch_miss=0.0):
+    """The text the fake model gives for a prompt, shaped like what each caller parses.
+
+    batch_miss: share of the diagrams a batched (UML_MODE=batched) answer leaves out.
+    """
+    seed = _seed(prompt)
+    if "list ALL useful UML diagram types" in prompt:
+        rnd = random.Random(seed)
+        kinds = rnd.sample(DIAGRAM_TYPES, min(diagrams, len(DIAGRAM_TYPES)))
+        return "\n".join(f"- {kind}: the {kind.lower()} view of the system, variant {rnd.randint(1, 999)}"
+                         for kind in kinds)
+    if "writing several diagrams at once" in prompt:
+        parts = []
+        for n, kind in re.findall(r"^(\d+)\. ([^:\n]+):", prompt, flags=re.M):
+            if (_seed(f"{n}:{prompt}") % 10_000) / 10_000 >= batch_miss:
+                source = synthetic_diagram(diagram_bytes, _seed(kind + prompt))
+                parts.append(f"### {n}. {kind}\n```plantuml\n{source}\n```")
+        return "\n\n".join(parts)
+    if "PlantUML syntax expert" in prompt:
+        return f"```plantuml\n{synthetic_diagram(diagram_bytes, seed)}\n```"
+    if prompt.startswith(("You are summarising part of", "Merge these partial summaries")):
+        return synthetic_report(1, seed)[:1200]
+    return synthetic_report(pages, seed)
+
+
+def _candidate(text, final):
+    body = {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}]}
+    if final:
+        body["candidates"][0]["finishReason"] = "STOP"
+        body["usageMetadata"] = {"promptTokenCount": 0, "candidatesTokenCount": len(text) // 4,
+                                 "totalTokenCount": len(text) // 4}
+    return body
+
+
+class GeminiHandler(_Handler):
+    # REST shape of models/<name>:generateContent and :streamGenerateContent
+    def do_POST(self):
+        opts = self.server.options
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        prompt = "".join(part.get("text", "")
+                         for content in request.get("contents", [])
+                         for part in content.get("parts", []))
+        self.server.count(calls=1)
+
+        # failures are drawn from the prompt hash and how often it was asked before, so every
+        # run fails the same attempts and a retry can get through; rpm_quota is a 60s window
+        with self.server._lock:
+            attempt = self.server.attempts[prompt] = self.server.attempts.get(prompt, 0) + 1
+            now, window = time.monotonic(), self.server.window
+            while window and window[0] < now - 60:
+                window.popleft()
+            over_quota = bool(opts["rpm_quota"]) and len(window) >= opts["rpm_quota"]
+            if not over_quota:
+                window.append(now)
+        flaky = opts["error_rate"] and (_seed(f"{attempt}:{prompt}") % 10_000) / 10_000 < opts["error_rate"]
+        if over_quota or flaky:
+            self.server.count(errors=1)
+            time.sleep(opts["latency"] / 4)
+            body = {"error": {"code": 429, "message": "Resource has been exhausted", "status": "RESOURCE_EXHAUSTED"}}
+            return self._send(429, json.dumps(body).encode(), "application/json")
+
+        text = answer(prompt, opts["pages"], opts["diagrams"], opts["diagram_bytes"], opts["batch_miss"])
+        time.sleep(opts["latency"])
+        cps = opts["chars_per_sec"]
+
+        if ":streamGenerateContent" not in self.path:
+            if cps:
+                time.sleep(len(text) / cps)
+            return self._send(200, json.dumps(_candidate(text, True)).encode(), "application/json")
+
+        # a JSON array written element by element (or server-sent events with ?alt=sse),
+        # paced like token generation
+        sse = "alt=sse" in self.path
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream" if sse else "application/json")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        step = opts["chunk_chars"]
+        pieces = [text[i:i + step] for i in range(0, len(text), step)] or [""]
+        for n, piece in enumerate(pieces):
+            if cps and n:
+                time.sleep(len(piece) / cps)
+            out = json.dumps(_candidate(piece, n == len(pieces) - 1))
+            if sse:
+                out = f"data: {out}\r\n\r\n"
+            else:
+                out = ("[" if n == 0 else ",") + out + ("]" if n == len(pieces) - 1 else "")
+            data = out.encode()
+            self.wfile.write(data)
+            self.wfile.flush()
+            self.server.count(bytes_out=len(data))
+        self.close_connection = True
+
+
+def serve_gemini(port=0, latency=0.5, chars_per_sec=4000.0, pages=8, diagrams=4, diagram_bytes=1500,
+                 chunk_chars=400, error_rate=0.0, rpm_quota=0, batch_miss=0.0):
+    server = _Server(port, GeminiHandler, latency=latency, chars_per_sec=chars_per_sec, pages=pages,
+                     diagrams=diagrams, diagram_bytes=diagram_bytes, chunk_chars=chunk_chars,
+                     error_rate=error_rate, rpm_quota=rpm_quota, batch_miss=batch_miss)
+    server.attempts, server.window = {}, deque()
+    return server.start()
+
+
+# ── PlantUML ──
+def diagram_png(encoded, width=1600, height=1200):
+    """A deterministic RGBA diagram-like PNG: boxes and connectors placed by the source hash."""
+    from PIL import Image, ImageDraw
+
+    rnd = random.Random(_seed(encoded))
+    img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    boxes = []
+    for _ in range(rnd.randint(6, 14)):
+        x, y = rnd.randrange(0, width - 220), rnd.randrange(0, height - 120)
+        boxes.append((x, y))
+        draw.rectangle((x, y, x + 200, y + 100), fill=(254, 254, 206, 255), outline=(168, 0, 54, 255), width=2)
+        for line in range(3):
+            draw.text((x + 10, y + 10 + 25 * line), f"{rnd.getrandbits(40):x}", fill=(0, 0, 0, 255))
+    for (x1, y1), (x2, y2) in zip(boxes, boxes[1:]):
+        draw.line((x1 + 100, y1 + 100, x2 + 100, y2), fill=(168, 0, 54, 255), width=2)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class PlantUmlHandler(_Handler):
+    # GET <server>/png/<encoded>, as served by plantuml.com and the plantuml-server image
+    def do_GET(self):
+        opts = self.server.options
+        self.server.count(calls=1)
+        encoded = self.path.rstrip("/").rsplit("/", 1)[-1]
+        if not self.path.startswith("/png/") or not encoded:
+            self.server.count(errors=1)
+            return self._send(404, b"not found", "text/plain")
+        time.sleep(opts["latency"])
+        cache = self.server.pngs
+        with self.server._lock:
+            png = cache.get(encoded)
+        if png is None:
+            png = diagram_png(encoded, opts["width"], opts["height"])
+            with self.server._lock:
+                cache[encoded] = png
+                while len(cache) > 256:
+                    cache.popitem(last=False)
+        self._send(200, png, "image/png")
+
+
+def serve_plantuml(port=0, latency=0.1, width=1600, height=1200):
+    server = _Server(port, PlantUmlHandler, latency=latency, width=width, height=height)
+    server.pngs = OrderedDict()
+    return server.start()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    sub = ap.add_subparsers(dest="which", required=True)
+    g = sub.add_parser("gemini")
+    g.add_argument("--port", type=int, default=8090)
+    g.add_argument("--latency", type=float, default=0.5, help="seconds before the first token")
+    g.add_argument("--chars-per-sec", type=float, default=4000, help="generation speed, 0 = instant")
+    g.add_argument("--pages", type=int, default=8, help="size of generated reports")
+    g.add_argument("--diagrams", type=int, default=4, help="diagram types listed per UML request")
+    g.add_argument("--diagram-bytes", type=int, default=1500, help="size of generated PlantUML sources")
+    g.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with 429")
+    g.add_argument("--rpm-quota", type=int, default=0, help="429 beyond this many calls per minute, 0 = none")
+    g.add_argument("--batch-miss", type=float, default=0.0, help="share of diagrams left out of a batched answer")
+    p = sub.add_parser("plantuml")
+    p.add_argument("--port", type=int, default=8091)
+    p.add_argument("--latency", type=float, default=0.1)
+    p.add_argument("--width", type=int, default=1600)
+    p.add_argument("--height", type=int, default=1200)
+    args = ap.parse_args()
+
+    if args.which == "gemini":
+        server = serve_gemini(args.port, args.latency, args.chars_per_sec, args.pages, args.diagrams,
+                              args.diagram_bytes, error_rate=args.error_rate, rpm_quota=args.rpm_quota,
+                              batch_miss=args.batch_miss)
+    else:
+        server = serve_plantuml(args.port, args.latency, args.width, args.height)
+    print(f"fake {args.which} on {server.url}")
+    try:
+        while True:
+            time.sleep(60)
+            print(json.dumps(server.stats()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()